@@ -0,0 +1,178 @@
+import os
+import random
+import zipfile
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List
+
+import yaml  # type: ignore
+
+
+@dataclass
+class EnvScale:
+    """
+    Size knobs for a generated env. Counts are per env.
+    """
+
+    # Jars besides the named ones below, each with a small plugin folder of its own
+    generic_plugins: int
+    # Config files in each generic plugin folder, split between the root and a lang/ subdir
+    files_per_plugin: int
+    # Tiles per zoom level per world under dynmap/renderdata
+    dynmap_tiles: int
+    essentials_users: int
+    luckperms_users: int
+
+
+SCALES = {
+    "small": EnvScale(
+        generic_plugins=20,
+        files_per_plugin=10,
+        dynmap_tiles=50,
+        essentials_users=200,
+        luckperms_users=200,
+    ),
+    "medium": EnvScale(
+        generic_plugins=80,
+        files_per_plugin=25,
+        dynmap_tiles=400,
+        essentials_users=2000,
+        luckperms_users=2000,
+    ),
+    "large": EnvScale(
+        generic_plugins=250,
+        files_per_plugin=40,
+        dynmap_tiles=2000,
+        essentials_users=15000,
+        luckperms_users=15000,
+    ),
+}
+
+DYNMAP_WORLDS = ["world", "world_nether", "world_the_end"]
+DYNMAP_ZOOM_LEVELS = 4
+
+# Filler so jars aren't trivially small - real plugin jars are mostly classes.
+JAR_FILLER_CLASSES = 20
+JAR_FILLER_CLASS_SIZE = 4096
+
+
+def write_jar(jar_path: Path, name: str, version: str, depend: List[str]) -> None:
+    plugin_yml = {
+        "name": name,
+        "version": version,
+        "main": f"net.example.{name.lower()}.Main",
+        "api-version": "1.18",
+        "depend": depend,
+        "commands": {
+            name.lower(): {"description": f"{name} main command", "usage": "/<command>"}
+        },
+    }
+    with zipfile.ZipFile(jar_path, "w", compression=zipfile.ZIP_DEFLATED) as jar:
+        for i in range(JAR_FILLER_CLASSES):
+            jar.writestr(
+                f"net/example/{name.lower()}/Class{i}.class",
+                os.urandom(JAR_FILLER_CLASS_SIZE),
+            )
+        jar.writestr("plugin.yml", yaml.safe_dump(plugin_yml))
+
+
+def write_file(path: Path, data: bytes) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+
+
+def yml_blob(rng: random.Random, keys: int) -> bytes:
+    return yaml.safe_dump(
+        {f"key{i}": rng.choice([True, False, i, f"value-{i}"]) for i in range(keys)}
+    ).encode()
+
+
+def generate_generic_plugin(
+    plugin_dir: Path, rng: random.Random, files_per_plugin: int
+) -> None:
+    write_file(plugin_dir / "config.yml", yml_blob(rng, 50))
+    for i in range(files_per_plugin - 1):
+        subdir = plugin_dir / "lang" if i % 2 else plugin_dir
+        suffix = rng.choice([".yml", ".yml", ".lang", ".txt"])
+        write_file(subdir / f"file{i}{suffix}", yml_blob(rng, 10))
+
+    # Runtime data that should be discarded rather than treated as config.
+    write_file(plugin_dir / "data.db", os.urandom(8192))
+    write_file(plugin_dir / "logs" / "latest.log", b"[INFO] Started\n" * 100)
+
+
+def generate_dynmap(plugin_dir: Path, rng: random.Random, tiles: int) -> None:
+    write_file(plugin_dir / "configuration.txt", yml_blob(rng, 200))
+    write_file(plugin_dir / "worlds.txt", yml_blob(rng, 30))
+    for world in DYNMAP_WORLDS:
+        for zoom in range(DYNMAP_ZOOM_LEVELS):
+            for tile in range(tiles):
+                # Deep x/z bucketed tree, like dynmap's tile layout.
+                x, z = divmod(tile, 32)
+                write_file(
+                    plugin_dir
+                    / "renderdata"
+                    / world
+                    / "flat"
+                    / f"z{zoom}"
+                    / f"{x // 8}_{z // 8}"
+                    / f"{x}_{z}.png",
+                    os.urandom(rng.randint(64, 512)),
+                )
+
+
+def generate_essentials(plugin_dir: Path, rng: random.Random, users: int) -> None:
+    write_file(plugin_dir / "config.yml", yml_blob(rng, 300))
+    write_file(plugin_dir / "kits.yml", yml_blob(rng, 20))
+    write_file(plugin_dir / "worth.yml", yml_blob(rng, 500))
+    userdata = plugin_dir / "userdata"
+    userdata.mkdir(parents=True, exist_ok=True)
+    for _ in range(users):
+        write_file(userdata / f"{rng.getrandbits(128):032x}.yml", yml_blob(rng, 15))
+
+
+def generate_luckperms(plugin_dir: Path, rng: random.Random, users: int) -> None:
+    write_file(plugin_dir / "config.yml", yml_blob(rng, 150))
+    storage = plugin_dir / "json-storage"
+    for group in ["default", "mod", "admin"]:
+        write_file(storage / "groups" / f"{group}.json", b'{"permissions": []}')
+    write_file(storage / "tracks" / "staff.json", b'{"groups": ["mod", "admin"]}')
+    users_dir = storage / "users"
+    users_dir.mkdir(parents=True, exist_ok=True)
+    for _ in range(users):
+        write_file(users_dir / f"{rng.getrandbits(128):032x}.json", b'{"nodes": []}')
+    write_file(plugin_dir / "libs" / "h2.jar", os.urandom(16384))
+
+
+def generate_env(env_path: Path, scale: EnvScale, seed: int = 0) -> None:
+    """
+    Writes a fake env at env_path with a plugins folder shaped like a real server's - a jar and
+    folder per plugin, plus the large data trees patchouli_config.yml ignores.
+    """
+    rng = random.Random(seed)
+    plugins_path = env_path / "plugins"
+    plugins_path.mkdir(parents=True, exist_ok=True)
+
+    write_jar(plugins_path / "dynmap-3.4.jar", "dynmap", "3.4", [])
+    generate_dynmap(plugins_path / "dynmap", rng, scale.dynmap_tiles)
+
+    write_jar(plugins_path / "EssentialsX-2.19.2.jar", "Essentials", "2.19.2", [])
+    generate_essentials(plugins_path / "Essentials", rng, scale.essentials_users)
+
+    write_jar(plugins_path / "LuckPerms-Bukkit-5.4.jar", "LuckPerms", "5.4", [])
+    generate_luckperms(plugins_path / "LuckPerms", rng, scale.luckperms_users)
+
+    for i in range(scale.generic_plugins):
+        name = f"Plugin{i:04d}"
+        write_jar(
+            plugins_path / f"{name}-1.0.{i}.jar",
+            name,
+            f"1.0.{i}",
+            ["Essentials"] if i % 3 == 0 else [],
+        )
+        generate_generic_plugin(plugins_path / name, rng, scale.files_per_plugin)
+
+    # Folders Patchouli ignores outright.
+    write_file(plugins_path / "bStats" / "config.yml", yml_blob(rng, 5))
+    write_file(plugins_path / "Updater" / "config.yml", yml_blob(rng, 5))
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+Benchmarks Patchouli's discovery and copy paths against generated envs.
+
+Run from the repo root:
+    python -m benchmarks.run -o before.json
+    python -m benchmarks.run -o after.json --compare before.json
+    python -m benchmarks.run --compare before.json after.json
+"""
+
+import os
+import sys
+import grp
+import json
+import shutil
+import time
+import getpass
+import logging
+import platform
+import statistics
+import tempfile
+
+from argparse import ArgumentParser
+from dataclasses import asdict
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import src.utils as utils
+from src.mytypes import Environment, get_patchouli_config, set_patchouli_config
+from src.patchouli import Patchouli
+from benchmarks.envgen import SCALES, generate_env
+
+logger = logging.getLogger("benchmarks")
+
+RESULTS_FORMAT_VERSION = 1
+SRC_ENV = "prod"
+DEST_ENV = "dev1"
+
+# Benchmark -> scale -> timing summary
+Results = Dict[str, Dict[str, Dict]]
+
+
+class BenchConfig:
+    """
+    The patchouli config with a few keys overridden, so everything runs against the generated
+    base path, a throwaway cache dir and the current user rather than the real server.
+    """
+
+    def __init__(self, config, **overrides):
+        self.__config = config
+        self.__overrides = overrides
+
+    def __getattr__(self, name: str):
+        if name in self.__overrides:
+            return self.__overrides[name]
+        return getattr(self.__config, name)
+
+    def __getitem__(self, key: str):
+        if key in self.__overrides:
+            return self.__overrides[key]
+        return self.__config[key]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.__overrides or key in self.__config
+
+    def items(self):
+        return {
+            **{key: value for key, value in self.__config.items()},
+            **self.__overrides,
+        }.items()
+
+    def get_or_default(self, key: str):
+        if key in self.__overrides:
+            return self.__overrides[key]
+        return self.__config.get_or_default(key)
+
+
+def time_runs(func: Callable, repeat: int, setup: Optional[Callable] = None) -> Dict:
+    runs = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        runs.append(time.perf_counter() - start)
+
+    return {
+        "runs": runs,
+        "min": min(runs),
+        "median": statistics.median(runs),
+        "mean": statistics.mean(runs),
+    }
+
+
+def bench_scale(base_path: Path, repeat: int, jobs: Optional[int]) -> Dict[str, Dict]:
+    config = get_patchouli_config()
+    src_env = Environment(SRC_ENV)
+    plugins_path = base_path / SRC_ENV / "plugins"
+    results = {}
+
+    jars = sorted(plugins_path.glob("*.jar"))
+    results["get_plugin_name_from_jar"] = time_runs(
+        lambda: [utils.get_plugin_name_from_jar(jar) for jar in jars], repeat
+    )
+
+    pluginscfg = config.plugins
+    paths_to_ignore = pluginscfg.configs.paths_to_ignore
+    folders_to_ignore = utils.NameFilter(pluginscfg.folders_to_ignore)
+    plugin_dirs = sorted(
+        path
+        for path in plugins_path.iterdir()
+        if path.is_dir() and not folders_to_ignore.matches(path.name)
+    )
+
+    def find_all_files():
+        for plugin_dir in plugin_dirs:
+            utils.find_all_files_with_exts(
+                base_path=plugin_dir,
+                extensions=set(pluginscfg.configs.suffixes),
+                paths_to_ignore=(
+                    [str(path) for path in paths_to_ignore[plugin_dir.name]]
+                    if plugin_dir.name in paths_to_ignore
+                    else []
+                ),
+                suffixes_override=pluginscfg.configs.suffixes_override.get_or_default(
+                    plugin_dir.name
+                ),
+            )
+
+    results["find_all_files_with_exts"] = time_runs(find_all_files, repeat)
+
+    def make_patchouli(**kwargs) -> Patchouli:
+        return Patchouli(config, logger=logger, target_env=src_env, jobs=jobs, **kwargs)
+
+    results["populate_plugin_data_cold"] = time_runs(
+        lambda: make_patchouli(use_jar_cache=False, use_file_index=False), repeat
+    )
+    # Prime the jar cache and file index once so every timed run is a warm one.
+    make_patchouli()
+    results["populate_plugin_data_warm"] = time_runs(make_patchouli, repeat)
+
+    if getpass.getuser() != "root":
+        logger.warning("Not running as root - Skipping copy_plugin_data benchmarks.")
+        return results
+
+    patchy = make_patchouli()
+    dest_env = Environment(DEST_ENV)
+    dest_plugins_path = base_path / DEST_ENV / "plugins"
+
+    def clear_dest():
+        shutil.rmtree(dest_plugins_path)
+        dest_plugins_path.mkdir()
+
+    results["copy_plugin_data_full"] = time_runs(
+        lambda: patchy.copy_plugin_data(dest_env, incremental=False),
+        repeat,
+        setup=clear_dest,
+    )
+    # The dest is left populated by the last full copy, so nothing needs copying.
+    results["copy_plugin_data_incremental"] = time_runs(
+        lambda: patchy.copy_plugin_data(dest_env, incremental=True), repeat
+    )
+
+    return results
+
+
+def run_benchmarks(scales: List[str], repeat: int, jobs: Optional[int]) -> Dict:
+    base_config = get_patchouli_config()
+    results: Results = {}
+
+    for scale_name in scales:
+        scale = SCALES[scale_name]
+        with tempfile.TemporaryDirectory(prefix="patchouli-bench-") as tmp_dir:
+            base_path = Path(tmp_dir) / "base"
+            logger.info(f"Generating '{scale_name}' env at {base_path}")
+            generate_env(base_path / SRC_ENV, scale)
+            (base_path / DEST_ENV / "plugins").mkdir(parents=True)
+
+            set_patchouli_config(
+                BenchConfig(
+                    base_config,
+                    base_path=str(base_path),
+                    cache_dir=str(Path(tmp_dir) / "cache"),
+                    default_env=SRC_ENV,
+                    default_copy_to_env=DEST_ENV,
+                    default_create_missing_dirs=False,
+                    mc_data_user=getpass.getuser(),
+                    mc_data_group=grp.getgrgid(os.getgid()).gr_name,
+                )
+            )
+            utils.clear_config_caches()
+            try:
+                logger.info(f"Running '{scale_name}' benchmarks")
+                for bench_name, timing in bench_scale(base_path, repeat, jobs).items():
+                    results.setdefault(bench_name, {})[scale_name] = timing
+            finally:
+                set_patchouli_config(None)
+                utils.clear_config_caches()
+
+    return {
+        "version": RESULTS_FORMAT_VERSION,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "jobs": jobs,
+        "scales": {name: asdict(SCALES[name]) for name in scales},
+        "results": results,
+    }
+
+
+def print_results(data: Dict) -> None:
+    print(f"{'benchmark':<32} {'scale':<8} {'median':>10} {'min':>10}")
+    for bench_name, by_scale in data["results"].items():
+        for scale_name, timing in by_scale.items():
+            print(
+                f"{bench_name:<32} {scale_name:<8} {timing['median']:>9.4f}s {timing['min']:>9.4f}s"
+            )
+
+
+def compare_results(old: Dict, new: Dict, threshold: float) -> bool:
+    """
+    Prints the median of every benchmark in both runs side by side.
+
+    Returns True if any benchmark got slower by more than threshold (a fraction, eg 0.1 = 10%).
+    """
+    regressed = False
+    print(f"{'benchmark':<32} {'scale':<8} {'old':>10} {'new':>10} {'change':>8}")
+    for bench_name, by_scale in new["results"].items():
+        for scale_name, timing in by_scale.items():
+            old_timing = old["results"].get(bench_name, {}).get(scale_name)
+            if old_timing is None:
+                print(
+                    f"{bench_name:<32} {scale_name:<8} {'-':>10} {timing['median']:>9.4f}s {'new':>8}"
+                )
+                continue
+
+            change = timing["median"] / old_timing["median"] - 1
+            flag = ""
+            if change > threshold:
+                flag = "  REGRESSION"
+                regressed = True
+            print(
+                f"{bench_name:<32} {scale_name:<8} {old_timing['median']:>9.4f}s {timing['median']:>9.4f}s {change:>+7.1%}{flag}"
+            )
+
+    return regressed
+
+
+def load_results(path: str) -> Dict:
+    with open(path, "r") as f:
+        data = json.load(f)
+    if data.get("version") != RESULTS_FORMAT_VERSION:
+        print(f"{path} is not a results file this version can read.")
+        sys.exit(2)
+    return data
+
+
+def main() -> None:
+    parser = ArgumentParser(
+        description="Benchmarks Patchouli against generated envs.",
+    )
+    parser.add_argument(
+        "--scales",
+        nargs="+",
+        choices=list(SCALES),
+        default=["small", "medium"],
+    )
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    parser.add_argument("-j", "--jobs", type=int, default=None)
+    parser.add_argument("-o", "--output", help="Write the results as JSON here.")
+    parser.add_argument(
+        "--compare",
+        nargs="+",
+        metavar="RESULTS",
+        help="Compare against a previous results file. Given two files, compares them without running anything.",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Slowdown of a benchmark's median, as a fraction, that counts as a regression.",
+    )
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format="%(message)s",
+    )
+
+    if args.compare is not None and len(args.compare) > 2:
+        parser.error("--compare takes one or two results files")
+
+    if args.compare is not None and len(args.compare) == 2:
+        data = load_results(args.compare[1])
+    else:
+        data = run_benchmarks(args.scales, args.repeat, args.jobs)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(data, f, indent=2)
+
+    if args.compare is None:
+        print_results(data)
+        return
+
+    if compare_results(load_results(args.compare[0]), data, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+import io
+import os
+import json
+import time
+import tarfile
+import logging
+
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path, PurePosixPath
+from typing import BinaryIO, Dict, Iterator, Optional
+
+import src.utils as utils
+from src.exceptions import BundleException
+from src.instrumentation import run_stats
+from src.mytypes import PluginName
+from src.patchouli import Patchouli
+from src.sync import CopyStats, FileCopier
+
+try:
+    import zstandard  # type: ignore
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# First entry of every bundle, describing where it came from.
+BUNDLE_MANIFEST_NAME = ".patchouli-bundle.json"
+BUNDLE_VERSION = 1
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+COMPRESSIONS = ["zst", "gz", "xz", "none"]
+SUFFIX_COMPRESSIONS = {
+    ".zst": "zst",
+    ".tzst": "zst",
+    ".gz": "gz",
+    ".tgz": "gz",
+    ".xz": "xz",
+    ".txz": "xz",
+    ".tar": "none",
+}
+
+
+@dataclass
+class BundleStats:
+    files: int = 0
+    jars: int = 0
+    bytes: int = 0
+
+    def __str__(self) -> str:
+        return f"{self.files} config files and {self.jars} jars ({self.bytes} bytes)"
+
+
+def get_default_compression(output_path: Optional[str] = None) -> str:
+    """
+    Picks the compression from output_path's suffix, or zstd if available and gzip otherwise.
+    """
+    if output_path is not None and output_path != "-":
+        compression = SUFFIX_COMPRESSIONS.get(Path(output_path).suffix)
+        if compression is not None:
+            return compression
+    return "zst" if zstandard is not None else "gz"
+
+
+def ensure_compression_available(compression: str) -> None:
+    if compression == "zst" and zstandard is None:
+        raise BundleException(
+            "zstd compression requires the 'zstandard' package - Use --compression gz or xz instead."
+        )
+
+
+@contextmanager
+def open_bundle_writer(
+    fileobj: BinaryIO, compression: str
+) -> Iterator[tarfile.TarFile]:
+    """
+    Opens a streaming tar writer on fileobj. Nothing is seeked, so fileobj may be a pipe.
+    """
+    ensure_compression_available(compression)
+    if compression == "zst":
+        writer = zstandard.ZstdCompressor(threads=-1).stream_writer(
+            fileobj, closefd=False
+        )
+        with writer:
+            with tarfile.open(
+                fileobj=writer, mode="w|", format=tarfile.PAX_FORMAT
+            ) as tar:
+                yield tar
+        return
+
+    mode = "w|" if compression == "none" else f"w|{compression}"
+    with tarfile.open(fileobj=fileobj, mode=mode, format=tarfile.PAX_FORMAT) as tar:
+        yield tar
+
+
+@contextmanager
+def open_bundle_reader(fileobj: io.BufferedReader) -> Iterator[tarfile.TarFile]:
+    """
+    Opens a streaming tar reader on fileobj, detecting zstd, gzip, xz or no compression.
+    """
+    if fileobj.peek(len(ZSTD_MAGIC))[: len(ZSTD_MAGIC)] == ZSTD_MAGIC:
+        if zstandard is None:
+            raise BundleException(
+                "This bundle is zstd compressed, which requires the 'zstandard' package."
+            )
+        reader = zstandard.ZstdDecompressor().stream_reader(fileobj, closefd=False)
+        with reader:
+            with tarfile.open(fileobj=reader, mode="r|") as tar:
+                yield tar
+        return
+
+    with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+        yield tar
+
+
+def __add_file(tar: tarfile.TarFile, file_path: Path, arcname: str) -> int:
+    """
+    Streams file_path into tar. Ownership is left out since import sets it per env anyway.
+    """
+    with open(file_path, "rb") as f:
+        file_stat = os.fstat(f.fileno())
+        info = tarfile.TarInfo(arcname)
+        info.size = file_stat.st_size
+        # Permission bits only - setuid, setgid and sticky bits are never carried between envs.
+        info.mode = file_stat.st_mode & 0o777
+        info.mtime = file_stat.st_mtime_ns / 1e9
+        tar.addfile(info, f)
+    return file_stat.st_size
+
+
+def export_bundle(
+    patchy: Patchouli, fileobj: BinaryIO, compression: str, include_jars: bool = False
+) -> BundleStats:
+    """
+    Writes patchy's config files, and optionally its jars, as a compressed tar to fileobj.
+
+    Paths in the bundle are relative to the plugins dir, so it can be imported into any env.
+    Files are read straight into the archive - nothing is staged on disk.
+    """
+    stats = BundleStats()
+    manifest = {
+        "version": BUNDLE_VERSION,
+        "env": patchy.target_env.value,
+        "created": time.time(),
+        "plugins": sorted(patchy.plugin_config_mapping),
+        "include_jars": include_jars,
+    }
+    manifest_data = json.dumps(manifest).encode()
+
+    with run_stats.phase("export"), open_bundle_writer(fileobj, compression) as tar:
+        info = tarfile.TarInfo(BUNDLE_MANIFEST_NAME)
+        info.size = len(manifest_data)
+        info.mtime = int(manifest["created"])
+        tar.addfile(info, io.BytesIO(manifest_data))
+
+        for plugin_name in sorted(patchy.plugin_config_mapping):
+            plugin_dir = patchy.plugin_path_base / plugin_name
+            for file_path in sorted(patchy.plugin_config_mapping[plugin_name]):
+                arcname = f"{plugin_name}/{file_path.relative_to(plugin_dir)}"
+                stats.bytes += __add_file(tar, file_path, arcname)
+                stats.files += 1
+
+        if include_jars:
+            for plugin_name in sorted(patchy.plugin_jar_mapping):
+                jar_path = patchy.plugin_jar_mapping[plugin_name]
+                arcname = str(jar_path.relative_to(patchy.plugin_path_base))
+                stats.bytes += __add_file(tar, jar_path, arcname)
+                stats.jars += 1
+
+    run_stats.add_many(
+        files_exported=stats.files + stats.jars, bytes_exported=stats.bytes
+    )
+    return stats
+
+
+def __get_member_path(member: tarfile.TarInfo) -> PurePosixPath:
+    """
+    Rejects anything that could land outside the plugins dir.
+    """
+    path = PurePosixPath(member.name)
+    if path.is_absolute() or not path.parts or ".." in path.parts:
+        raise BundleException(f"Refusing unsafe path in bundle: {member.name}")
+    return path
+
+
+@utils.ensure_root
+def import_bundle(
+    patchy: Patchouli, fileobj: io.BufferedReader, skip_jars: bool = False
+) -> CopyStats:
+    """
+    Extracts a bundle made by export_bundle into patchy's target env in a single streaming pass.
+
+    Each file is chowned to mc_data_user:mc_data_group on the handle it's written through, and
+    only dirs the import creates are chowned, so there's no recursive chown afterwards. Every file
+    is written to a temp file and renamed into place, so a running server never sees a partial
+    jar or config.
+
+    Jars are skipped if patchy has a plugin whitelist or blacklist, since which plugin a jar
+    belongs to isn't known without reading it.
+    """
+    if not skip_jars and (patchy.plugins_whitelist or patchy.plugins_blacklist):
+        logger.info("Skipping jars since a plugin whitelist or blacklist is set")
+        skip_jars = True
+
+    user, group = patchy.config.mc_data_user, patchy.config.mc_data_group
+    copier = FileCopier(*utils.get_uid_gid(user, group))
+    plugin_path_base = patchy.plugin_path_base
+    # Ordered set of the plugins configs were imported for.
+    imported_plugins: Dict[PluginName, None] = {}
+
+    with run_stats.phase("import"), open_bundle_reader(fileobj) as tar:
+        for member in tar:
+            if member.name == BUNDLE_MANIFEST_NAME:
+                manifest = json.load(tar.extractfile(member))  # type: ignore
+                if manifest.get("version") != BUNDLE_VERSION:
+                    raise BundleException(
+                        f"Unsupported bundle version {manifest.get('version')}"
+                    )
+                logger.info(
+                    f"Importing bundle of {manifest['env']} from {time.ctime(manifest['created'])}"
+                )
+                continue
+            if not member.isfile():
+                # Dirs are created as needed. Links and devices never come from export.
+                continue
+
+            path = __get_member_path(member)
+            is_jar = len(path.parts) == 1
+            if is_jar and (skip_jars or path.suffix != ".jar"):
+                continue
+
+            plugin_name = path.parts[0] if not is_jar else None
+            if plugin_name is not None:
+                if (
+                    patchy.plugins_whitelist
+                    and plugin_name not in patchy.plugins_whitelist
+                ):
+                    continue
+                elif (
+                    patchy.plugins_blacklist and plugin_name in patchy.plugins_blacklist
+                ):
+                    continue
+
+            dest_path = plugin_path_base / Path(*path.parts)
+            mtime_ns = int(member.mtime * 1e9)
+            write_path = dest_path.with_name(f".{dest_path.name}.patchouli-tmp")
+            try:
+                copier.write_stream(
+                    write_path,
+                    tar.extractfile(member),  # type: ignore
+                    member.mode & 0o777,
+                    (mtime_ns, mtime_ns),
+                )
+                os.replace(write_path, dest_path)
+            finally:
+                write_path.unlink(missing_ok=True)
+            if not is_jar:
+                imported_plugins.setdefault(plugin_name, None)  # type: ignore
+            logger.debug(f"{member.name} => {dest_path}")
+
+    if patchy.file_index is not None:
+        patchy.file_index.refresh(
+            patchy.scan_config_files(imported_plugins, plugin_path_base),
+            plugin_path_base,
+            complete=False,
+        )
+        patchy.file_index.mark_synced(imported_plugins)
+
+    run_stats.add_many(
+        files_copied=copier.stats.copied,
+        bytes_copied=copier.stats.bytes_copied,
+        dirs_created=copier.stats.dirs_created,
+        chowned=copier.stats.chowned,
+    )
+    return copier.stats
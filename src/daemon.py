@@ -0,0 +1,378 @@
+import os
+import socket
+import signal
+import logging
+import selectors
+
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from src.common.config import Config
+from src.constants import VCS_ENV
+from src.daemon_client import (
+    DAEMON_PROTOCOL_VERSION,
+    DAEMON_TIMEOUT_SECONDS,
+    DaemonClient,
+    recv_message,
+    send_message,
+)
+from src.exceptions import DaemonException
+from src.inotify import (
+    IN_ATTRIB,
+    IN_CLOSE_WRITE,
+    IN_CREATE,
+    IN_DELETE,
+    IN_DELETE_SELF,
+    IN_IGNORED,
+    IN_ISDIR,
+    IN_MOVE_SELF,
+    IN_MOVED_FROM,
+    IN_MOVED_TO,
+    IN_ONLYDIR,
+    IN_Q_OVERFLOW,
+    Inotify,
+    InotifyEvent,
+    get_inotify,
+)
+from src.jarcache import JarMetadataCache, get_jar_cache_path
+from src.mytypes import Environment, PluginName
+from src.patchouli import Patchouli
+from src.utils import NameFilter, forget_validated_env
+
+logger = logging.getLogger(__name__)
+
+# Only changes to which files exist matter to the mappings - contents are the file index's job.
+PLUGIN_WATCH_MASK = (
+    IN_CREATE
+    | IN_DELETE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+)
+# Jars replaced in place change the plugin metadata, so also watch writes in the plugins dir.
+ROOT_WATCH_MASK = PLUGIN_WATCH_MASK | IN_CLOSE_WRITE | IN_ATTRIB
+
+# Lets the loop notice a stop request even if no events or connections arrive.
+SELECT_TIMEOUT_SECONDS = 1.0
+
+
+class EnvWatcher:
+    """
+    Scan results for one env, kept current by marking what inotify events touch as dirty and
+    rescanning only that on the next request.
+
+    A change in the plugins dir itself (a jar or plugin dir added, removed or replaced)
+    re-identifies jars, which is cheap with the jar cache, but only re-walks new or dirty plugin
+    dirs. A change inside a plugin dir only re-walks that plugin.
+    """
+
+    daemon: "PatchyDaemon"
+    env: Environment
+    patchy: Optional[Patchouli]
+
+    root_dirty: bool
+    dirty_plugins: Set[PluginName]
+    # False if some dir couldn't be watched, eg the inotify watch limit was hit.
+    fully_watched: bool
+
+    def __init__(self, daemon: "PatchyDaemon", env: Environment):
+        self.daemon = daemon
+        self.env = env
+        self.patchy = None
+        self.root_dirty = True
+        self.dirty_plugins = set()
+        self.fully_watched = True
+
+    def mark_all_dirty(self) -> None:
+        self.root_dirty = True
+        if self.patchy is not None:
+            self.dirty_plugins.update(self.patchy.plugin_names)
+
+    def handle_event(
+        self, plugin_name: Optional[PluginName], event: InotifyEvent
+    ) -> None:
+        if plugin_name is not None:
+            self.dirty_plugins.add(plugin_name)
+            return
+
+        # Only jars and plugin dirs in the plugins dir affect the mappings.
+        is_dir = bool(event.mask & IN_ISDIR)
+        if event.name.endswith(".jar") or (
+            is_dir and not self.daemon.folders_to_ignore.matches(event.name)
+        ):
+            self.root_dirty = True
+        if event.mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            self.root_dirty = True
+            # The rescan must not trust the env's earlier validation.
+            forget_validated_env(self.env)
+
+    def get_state(self) -> Dict:
+        self.refresh()
+        assert self.patchy is not None
+        return self.patchy.dump_state()
+
+    def refresh(self) -> None:
+        if not self.fully_watched:
+            self.mark_all_dirty()
+            self.fully_watched = True
+
+        if self.root_dirty:
+            self.__rescan_root()
+        elif self.dirty_plugins:
+            assert self.patchy is not None
+            for plugin_name in sorted(self.dirty_plugins):
+                if plugin_name in self.patchy.plugin_dir_mapping:
+                    self.__walk_plugin(self.patchy, plugin_name)
+        self.dirty_plugins.clear()
+
+    def __rescan_root(self) -> None:
+        previous = self.patchy
+        # The root is left dirty if this raises, so the next request retries.
+        patchy = self.daemon.make_patchouli(self.env)
+        self.daemon.watch(patchy.plugin_path_base, self, None, ROOT_WATCH_MASK)
+
+        reused = 0
+        for plugin_name, plugin_dir in patchy.plugin_dir_mapping.items():
+            if (
+                previous is not None
+                and plugin_name not in self.dirty_plugins
+                and previous.plugin_dir_mapping.get(plugin_name) == plugin_dir
+                and plugin_name in previous.plugin_config_mapping
+            ):
+                patchy.plugin_config_mapping[plugin_name] = (
+                    previous.plugin_config_mapping[plugin_name]
+                )
+                patchy.plugin_discarded_mapping[plugin_name] = (
+                    previous.plugin_discarded_mapping[plugin_name]
+                )
+                reused += 1
+            else:
+                self.__walk_plugin(patchy, plugin_name)
+
+        self.patchy = patchy
+        self.root_dirty = False
+        if self.daemon.jar_cache is not None:
+            self.daemon.jar_cache.save()
+        logger.info(
+            f"Scanned {self.env} - {len(patchy.plugin_dir_mapping) - reused} plugin dirs walked, {reused} unchanged"
+        )
+
+    def __walk_plugin(self, patchy: Patchouli, plugin_name: PluginName) -> None:
+        plugin_dir = patchy.plugin_dir_mapping[plugin_name]
+
+        # Each dir the walk descends into is watched before it's listed, so nothing created
+        # while walking is missed. Ignored paths are never walked, so they're never watched.
+        def watch_dir(path: str) -> None:
+            self.daemon.watch(Path(path), self, plugin_name, PLUGIN_WATCH_MASK)
+
+        files, discarded = patchy.get_config_files_from_plugin_dir(
+            plugin_name, plugin_dir, on_dir=watch_dir
+        )
+        patchy.plugin_config_mapping[plugin_name] = files
+        patchy.plugin_discarded_mapping[plugin_name] = discarded
+
+
+class PatchyDaemon:
+    """
+    Scans envs once and keeps their plugin, jar and config file mappings current through inotify,
+    serving them over a Unix socket to git-patchy commands.
+
+    The daemon is single threaded - pending inotify events are always applied before answering
+    a request, so a request sees every change that finished before it was sent.
+    """
+
+    config: Config
+    envs: List[Environment]
+    socket_path: Path
+    jobs: Optional[int]
+
+    jar_cache: Optional[JarMetadataCache]
+    folders_to_ignore: NameFilter
+
+    inotify: Inotify
+    watchers: Dict[Environment, EnvWatcher]
+    # Watch descriptor -> (env, plugin the dir belongs to, or None for the plugins dir)
+    watches: Dict[int, Tuple[EnvWatcher, Optional[PluginName]]]
+
+    server: Optional[socket.socket]
+    stopping: bool
+
+    def __init__(
+        self,
+        config: Config,
+        envs: List[Environment],
+        socket_path: Path,
+        jobs: Optional[int] = None,
+    ):
+        self.config = config
+        self.envs = [env for env in envs if env.value != VCS_ENV]
+        self.socket_path = socket_path
+        self.jobs = jobs
+
+        self.jar_cache = (
+            JarMetadataCache(get_jar_cache_path(config.cache_dir))
+            if config.use_jar_cache
+            else None
+        )
+        self.folders_to_ignore = NameFilter(config.plugins.folders_to_ignore)
+
+        inotify = get_inotify()
+        if inotify is None:
+            raise DaemonException("The daemon requires Linux inotify.")
+        self.inotify = inotify
+
+        self.watchers = {env: EnvWatcher(self, env) for env in self.envs}
+        self.watches = {}
+        self.server = None
+        self.stopping = False
+
+    def make_patchouli(self, env: Environment) -> Patchouli:
+        return Patchouli(
+            config=self.config,
+            logger=logger,
+            target_env=env,
+            jar_cache=self.jar_cache,
+            jobs=self.jobs,
+            use_file_index=False,
+            discover_files=False,
+            use_daemon=False,
+        )
+
+    def watch(
+        self,
+        path: Path,
+        watcher: EnvWatcher,
+        plugin_name: Optional[PluginName],
+        mask: int,
+    ) -> None:
+        try:
+            wd = self.inotify.add_watch(str(path), mask)
+        except FileNotFoundError:
+            # Deleted since it was listed. Its parent's watch reports that.
+            return
+        except OSError as e:
+            if watcher.fully_watched:
+                logger.warning(
+                    f"Could not watch {path} ({e}) - {watcher.env} will be rescanned on every request."
+                )
+            watcher.fully_watched = False
+            return
+        self.watches[wd] = (watcher, plugin_name)
+
+    def process_events(self) -> None:
+        for event in self.inotify.read_events():
+            if event.mask & IN_Q_OVERFLOW:
+                logger.warning("inotify queue overflowed - Rescanning all envs.")
+                for watcher in self.watchers.values():
+                    watcher.mark_all_dirty()
+                continue
+
+            entry = self.watches.get(event.wd)
+            if entry is None:
+                continue
+            if event.mask & IN_IGNORED:
+                del self.watches[event.wd]
+                continue
+
+            watcher, plugin_name = entry
+            watcher.handle_event(plugin_name, event)
+
+    def handle_request(self, message: Dict) -> Dict:
+        if message.get("version") != DAEMON_PROTOCOL_VERSION:
+            return {"ok": False, "error": "Unsupported protocol version"}
+
+        op = message.get("op")
+        if op == "ping":
+            return {
+                "ok": True,
+                "pid": os.getpid(),
+                "envs": [env.value for env in self.envs],
+                "watches": len(self.watches),
+            }
+        elif op == "shutdown":
+            self.stopping = True
+            return {"ok": True}
+        elif op == "get_env":
+            watchers = [
+                watcher
+                for env, watcher in self.watchers.items()
+                if env.value == message.get("env")
+            ]
+            if not watchers:
+                return {"ok": False, "error": f"Not watching env {message.get('env')}"}
+            try:
+                return {"ok": True, "state": watchers[0].get_state()}
+            except Exception as e:
+                logger.warning(f"Could not scan {watchers[0].env}: {e}")
+                return {"ok": False, "error": str(e)}
+
+        return {"ok": False, "error": f"Unknown op {op}"}
+
+    def handle_connection(self) -> None:
+        assert self.server is not None
+        conn, _ = self.server.accept()
+        with conn:
+            conn.settimeout(DAEMON_TIMEOUT_SECONDS)
+            try:
+                message = recv_message(conn)
+                if message is None:
+                    return
+                # Apply anything that happened before the request first.
+                self.process_events()
+                send_message(conn, self.handle_request(message))
+            except (OSError, ValueError) as e:
+                logger.debug(f"Dropped a client connection: {e}")
+
+    def __bind(self) -> socket.socket:
+        if self.socket_path.exists():
+            if DaemonClient(self.socket_path).ping() is not None:
+                raise DaemonException(
+                    f"A daemon is already running on {self.socket_path}"
+                )
+            # Left behind by a daemon that didn't exit cleanly.
+            self.socket_path.unlink()
+
+        self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(str(self.socket_path))
+        # The mappings expose the server's file layout, so only our own user may connect.
+        os.chmod(self.socket_path, 0o600)
+        server.listen()
+        server.setblocking(False)
+        return server
+
+    def stop(self, *_) -> None:
+        self.stopping = True
+
+    def serve_forever(self) -> None:
+        self.server = self.__bind()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        try:
+            for watcher in self.watchers.values():
+                watcher.refresh()
+            if self.jar_cache is not None:
+                self.jar_cache.save()
+            logger.info(
+                f"Watching {', '.join(env.value for env in self.envs)} with {len(self.watches)} watches on {self.socket_path}"
+            )
+
+            with selectors.DefaultSelector() as selector:
+                selector.register(self.inotify, selectors.EVENT_READ)
+                selector.register(self.server, selectors.EVENT_READ)
+                while not self.stopping:
+                    for key, _ in selector.select(timeout=SELECT_TIMEOUT_SECONDS):
+                        if key.fileobj is self.inotify:
+                            self.process_events()
+                        else:
+                            self.handle_connection()
+        finally:
+            self.server.close()
+            self.socket_path.unlink(missing_ok=True)
+            self.inotify.close()
+            if self.jar_cache is not None:
+                self.jar_cache.save()
+            logger.info("Daemon stopped.")
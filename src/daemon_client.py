@@ -0,0 +1,104 @@
+import os
+import json
+import socket
+import struct
+import logging
+
+from pathlib import Path
+from typing import Dict, Optional
+
+from src.common.config import Config
+from src.mytypes import Environment
+
+logger = logging.getLogger(__name__)
+
+# Requests are answered from memory, so anything slower than this means the daemon is wedged.
+DAEMON_TIMEOUT_SECONDS = 10.0
+DAEMON_PROTOCOL_VERSION = 1
+
+
+def get_daemon_socket_path(config: Config) -> Path:
+    return Path(os.path.expanduser(config.daemon_socket_path))
+
+
+def get_peer_uid(sock: socket.socket) -> Optional[int]:
+    """
+    The uid of the process at the other end of a connected Unix socket, or None if the platform
+    can't tell.
+    """
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    creds = sock.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+    )
+    _, uid, _ = struct.unpack("3i", creds)
+    return uid
+
+
+def send_message(sock: socket.socket, message: Dict) -> None:
+    sock.sendall(json.dumps(message).encode() + b"\n")
+
+
+def recv_message(sock: socket.socket) -> Optional[Dict]:
+    """
+    Reads one newline terminated JSON message. Returns None if the peer closed first.
+    """
+    chunks = []
+    while True:
+        chunk = sock.recv(64 * 1024)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        if chunk.endswith(b"\n"):
+            return json.loads(b"".join(chunks))
+
+
+class DaemonClient:
+    """
+    Talks to a running `git patchy daemon` over its Unix socket.
+
+    Every method returns None if the daemon isn't running or misbehaves, so callers can always
+    fall back to scanning the env themselves. A daemon running as anyone but the current user is
+    never trusted - root can connect to any user's socket.
+    """
+
+    socket_path: Path
+
+    def __init__(self, socket_path: Path):
+        self.socket_path = socket_path
+
+    def request(self, message: Dict) -> Optional[Dict]:
+        if not self.socket_path.exists():
+            return None
+
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(DAEMON_TIMEOUT_SECONDS)
+                sock.connect(str(self.socket_path))
+                peer_uid = get_peer_uid(sock)
+                if peer_uid != os.geteuid():
+                    logger.warning(
+                        f"Ignoring the daemon at {self.socket_path} - It runs as uid {peer_uid}, not {os.geteuid()}."
+                    )
+                    return None
+                send_message(sock, {"version": DAEMON_PROTOCOL_VERSION, **message})
+                response = recv_message(sock)
+        except (OSError, ValueError) as e:
+            logger.debug(f"Could not reach daemon at {self.socket_path}: {e}")
+            return None
+
+        if response is None or not response.get("ok"):
+            error = response.get("error") if response is not None else "no response"
+            logger.debug(f"Daemon at {self.socket_path} refused {message}: {error}")
+            return None
+        return response
+
+    def ping(self) -> Optional[Dict]:
+        return self.request({"op": "ping"})
+
+    def get_env_state(self, env: Environment) -> Optional[Dict]:
+        response = self.request({"op": "get_env", "env": env.value})
+        return response["state"] if response is not None else None
+
+    def shutdown(self) -> bool:
+        return self.request({"op": "shutdown"}) is not None
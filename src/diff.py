@@ -0,0 +1,232 @@
+import os
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import src.utils as utils
+from src.instrumentation import run_stats
+from src.index import IndexRows, PluginFileChanges
+from src.mytypes import Environment, PluginName
+from src.patchouli import Patchouli
+from src.semdiff import UNPARSEABLE, KeyChange, ParseCache, diff_trees, is_structured
+
+logger = logging.getLogger(__name__)
+
+# relpath from the plugin dir -> absolute path
+RelpathMapping = Dict[str, Path]
+
+
+@dataclass
+class EnvDiffStats:
+    compared: int = 0
+    hashed: int = 0
+    hash_cache_hits: int = 0
+    # Files that differ byte for byte but not by structure, eg reordered keys or comments.
+    formatting_only: int = 0
+
+
+def get_relpath_mapping(patchy: Patchouli) -> Dict[PluginName, RelpathMapping]:
+    return {
+        plugin_name: {
+            str(file_path.relative_to(patchy.plugin_path_base / plugin_name)): file_path
+            for file_path in files
+        }
+        for plugin_name, files in patchy.plugin_config_mapping.items()
+    }
+
+
+class EnvDiffer:
+    """
+    Compares the config files found in two envs.
+
+    Files are compared by size first, then by mtime. Only files with matching sizes and differing
+    mtimes are hashed, and hashes are taken from the env's file index when its row still matches
+    the file's size and mtime.
+
+    If semantic, YAML and JSON files that still differ are parsed and compared by structure, so
+    only key path changes count - reordered keys, comments and reformatting don't. Parsed trees
+    come from parse_cache, which can be shared between differs so a file is parsed once however
+    many env pairs it's diffed in. Files that can't be parsed are compared byte for byte.
+    """
+
+    src: Patchouli
+    dest: Patchouli
+    jobs: int
+    semantic: bool
+    parse_cache: ParseCache
+    stats: EnvDiffStats
+    lock: threading.Lock
+
+    src_index_rows: IndexRows
+    dest_index_rows: IndexRows
+
+    def __init__(
+        self,
+        src: Patchouli,
+        dest: Patchouli,
+        jobs: int = 1,
+        semantic: bool = False,
+        parse_cache: Optional[ParseCache] = None,
+    ):
+        self.src = src
+        self.dest = dest
+        self.jobs = max(1, jobs)
+        self.semantic = semantic
+        self.parse_cache = parse_cache if parse_cache is not None else ParseCache()
+        self.stats = EnvDiffStats()
+        self.lock = threading.Lock()
+
+        self.src_index_rows = (
+            src.file_index.get_rows() if src.file_index is not None else {}
+        )
+        self.dest_index_rows = (
+            dest.file_index.get_rows() if dest.file_index is not None else {}
+        )
+
+    @staticmethod
+    def __get_indexed_hash(
+        key: Tuple[PluginName, str], file_stat: os.stat_result, rows: IndexRows
+    ) -> Optional[str]:
+        row = rows.get(key)
+        if (
+            row is not None
+            and row[0] == file_stat.st_size
+            and row[1] == file_stat.st_mtime_ns
+        ):
+            return row[2]
+        return None
+
+    def __get_hash(
+        self,
+        key: Tuple[PluginName, str],
+        path: Path,
+        file_stat: os.stat_result,
+        rows: IndexRows,
+    ) -> str:
+        file_hash = self.__get_indexed_hash(key, file_stat, rows)
+        if file_hash is not None:
+            with self.lock:
+                self.stats.hash_cache_hits += 1
+            return file_hash
+
+        with self.lock:
+            self.stats.hashed += 1
+        return utils.hash_file(path)
+
+    def __compare(self, item) -> Tuple[bool, Optional[List[KeyChange]]]:
+        """
+        Returns whether the file is modified, and its key changes if it was diffed by structure.
+        """
+        key, src_path, dest_path = item
+        src_stat = os.stat(src_path)
+        dest_stat = os.stat(dest_path)
+
+        if src_stat.st_size == dest_stat.st_size:
+            if src_stat.st_mtime_ns == dest_stat.st_mtime_ns:
+                return False, None
+            if self.__get_hash(
+                key, src_path, src_stat, self.src_index_rows
+            ) == self.__get_hash(key, dest_path, dest_stat, self.dest_index_rows):
+                return False, None
+
+        if not self.semantic or not is_structured(src_path):
+            return True, None
+
+        src_tree = self.parse_cache.get_tree(
+            src_path, self.__get_indexed_hash(key, src_stat, self.src_index_rows)
+        )
+        dest_tree = self.parse_cache.get_tree(
+            dest_path, self.__get_indexed_hash(key, dest_stat, self.dest_index_rows)
+        )
+        if src_tree is UNPARSEABLE or dest_tree is UNPARSEABLE:
+            return True, None
+
+        key_changes = diff_trees(src_tree, dest_tree)
+        if not key_changes:
+            with self.lock:
+                self.stats.formatting_only += 1
+            return False, None
+        return True, key_changes
+
+    def diff(self) -> Dict[PluginName, PluginFileChanges]:
+        """
+        "added" files only exist in dest, "removed" files only exist in src.
+        """
+        with run_stats.phase("diff"):
+            return self.__diff()
+
+    def __diff(self) -> Dict[PluginName, PluginFileChanges]:
+        src_mapping = get_relpath_mapping(self.src)
+        dest_mapping = get_relpath_mapping(self.dest)
+
+        changes: Dict[PluginName, PluginFileChanges] = {}
+        to_compare = []
+        for plugin_name in sorted(src_mapping.keys() | dest_mapping.keys()):
+            src_files = src_mapping.get(plugin_name, {})
+            dest_files = dest_mapping.get(plugin_name, {})
+            plugin_changes = PluginFileChanges(
+                added=sorted(dest_files.keys() - src_files.keys()),
+                removed=sorted(src_files.keys() - dest_files.keys()),
+            )
+            changes[plugin_name] = plugin_changes
+
+            for relpath in sorted(src_files.keys() & dest_files.keys()):
+                to_compare.append(
+                    ((plugin_name, relpath), src_files[relpath], dest_files[relpath])
+                )
+
+        self.stats.compared = len(to_compare)
+        if self.jobs <= 1:
+            results = [self.__compare(item) for item in to_compare]
+        else:
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                results = list(executor.map(self.__compare, to_compare))
+
+        for (key, _, _), (is_modified, key_changes) in zip(to_compare, results):
+            if is_modified:
+                changes[key[0]].modified.append(key[1])
+                if key_changes is not None:
+                    changes[key[0]].key_changes[key[1]] = key_changes
+
+        return {
+            plugin_name: plugin_changes
+            for plugin_name, plugin_changes in changes.items()
+            if plugin_changes
+        }
+
+
+def print_env_diff(
+    src_env: Environment,
+    dest_env: Environment,
+    changes: Dict[PluginName, PluginFileChanges],
+    stats: Optional[EnvDiffStats] = None,
+) -> None:
+    logger.info(f"Config differences from '{src_env.value}' to '{dest_env.value}':")
+
+    for plugin_name, plugin_changes in changes.items():
+        logger.info("")
+        logger.info(f"Plugin: {plugin_name}")
+        for relpath in plugin_changes.added:
+            logger.info(f"  added:    {relpath}")
+        for relpath in plugin_changes.removed:
+            logger.info(f"  removed:  {relpath}")
+        for relpath in plugin_changes.modified:
+            logger.info(f"  modified: {relpath}")
+            for key_change in plugin_changes.key_changes.get(relpath, []):
+                logger.info(f"    {key_change}")
+
+    if not changes:
+        logger.info("No differences.")
+
+    if stats is not None:
+        logger.debug(
+            f"Compared {stats.compared} files - {stats.hashed} hashed, {stats.hash_cache_hits} hashes from the file index"
+        )
+        if stats.formatting_only:
+            logger.info(
+                f"{stats.formatting_only} files differ only in formatting, comments or key order."
+            )
@@ -0,0 +1,153 @@
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+# Paths kept per directory as examples of what was discarded there.
+DISCARD_SAMPLE_SIZE = 3
+# Suffixes listed per directory when printing a summary.
+DISCARD_TOP_SUFFIXES = 3
+
+
+@dataclass
+class DirDiscards:
+    count: int = 0
+    bytes: int = 0
+    suffixes: Counter = field(default_factory=Counter)
+    samples: List[Path] = field(default_factory=list)
+
+
+class DiscardSummary:
+    """
+    Per-directory rollup of discarded files - count, total bytes, suffixes and a few sample paths -
+    so a plugin with a huge data tree costs one entry per directory rather than one per file.
+
+    Dirs that were never descended into - ignored via paths_to_ignore, or unreadable - are listed
+    as-is in ignored_paths.
+    Every discarded path is also kept if keep_paths is set.
+
+    Nothing is stat'ed here - the walker passes along what its DirEntry already knows.
+    """
+
+    dirs: Dict[Path, DirDiscards]
+    ignored_paths: List[Path]
+    keep_paths: bool
+    paths: List[Path]
+
+    def __init__(self, keep_paths: bool = False):
+        self.dirs = {}
+        self.ignored_paths = []
+        self.keep_paths = keep_paths
+        self.paths = []
+
+    def add(self, path: Path, is_dir: bool = False, size: int = 0) -> None:
+        if self.keep_paths:
+            self.paths.append(path)
+
+        if is_dir:
+            self.ignored_paths.append(path)
+            return
+
+        rollup = self.dirs.get(path.parent)
+        if rollup is None:
+            rollup = self.dirs[path.parent] = DirDiscards()
+        rollup.count += 1
+        rollup.bytes += size
+        rollup.suffixes[path.suffix or "(none)"] += 1
+        if len(rollup.samples) < DISCARD_SAMPLE_SIZE:
+            rollup.samples.append(path)
+
+    def update(self, other: "DiscardSummary") -> None:
+        if self.keep_paths:
+            self.paths.extend(other.paths)
+        self.ignored_paths.extend(other.ignored_paths)
+        for dir_path, other_rollup in other.dirs.items():
+            rollup = self.dirs.get(dir_path)
+            if rollup is None:
+                rollup = self.dirs[dir_path] = DirDiscards()
+            rollup.count += other_rollup.count
+            rollup.bytes += other_rollup.bytes
+            rollup.suffixes.update(other_rollup.suffixes)
+            rollup.samples.extend(
+                other_rollup.samples[: DISCARD_SAMPLE_SIZE - len(rollup.samples)]
+            )
+
+    @property
+    def count(self) -> int:
+        """
+        Discarded files only - skipped dirs are counted separately, since their contents aren't.
+        """
+        return sum(rollup.count for rollup in self.dirs.values())
+
+    @property
+    def bytes(self) -> int:
+        return sum(rollup.bytes for rollup in self.dirs.values())
+
+    def __bool__(self) -> bool:
+        return bool(self.dirs or self.ignored_paths)
+
+    def get_top_suffixes(
+        self, dir_path: Path, limit: int = DISCARD_TOP_SUFFIXES
+    ) -> List[Tuple[str, int]]:
+        return self.dirs[dir_path].suffixes.most_common(limit)
+
+    def as_dict(self, relative_to: Optional[Path] = None) -> Dict:
+        def fmt(path: Path) -> str:
+            return str(path.relative_to(relative_to) if relative_to else path)
+
+        data: Dict = {
+            "count": self.count,
+            "bytes": self.bytes,
+            "ignored_paths": [fmt(path) for path in self.ignored_paths],
+            "dirs": [
+                {
+                    "path": fmt(dir_path),
+                    "count": rollup.count,
+                    "bytes": rollup.bytes,
+                    "top_suffixes": dict(self.get_top_suffixes(dir_path)),
+                    "samples": [fmt(path) for path in rollup.samples],
+                }
+                for dir_path, rollup in sorted(self.dirs.items())
+            ],
+        }
+        if self.keep_paths:
+            data["paths"] = [fmt(path) for path in self.paths]
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "DiscardSummary":
+        """
+        Inverse of as_dict, for summaries with absolute paths.
+        """
+        summary = cls(keep_paths="paths" in data)
+        summary.ignored_paths = [Path(path) for path in data["ignored_paths"]]
+        summary.paths = [Path(path) for path in data.get("paths", [])]
+        for rollup in data["dirs"]:
+            summary.dirs[Path(rollup["path"])] = DirDiscards(
+                count=rollup["count"],
+                bytes=rollup["bytes"],
+                suffixes=Counter(rollup["top_suffixes"]),
+                samples=[Path(path) for path in rollup["samples"]],
+            )
+        return summary
+
+    def format_lines(self) -> List[str]:
+        if self.dirs:
+            summary = f"Discarded {self.count} files ({self.bytes} bytes) in {len(self.dirs)} dirs"
+        else:
+            summary = "Discarded no files"
+        if self.ignored_paths:
+            summary += f", skipped {len(self.ignored_paths)} dirs"
+        lines = [summary]
+        for path in self.ignored_paths:
+            lines.append(f"- Skipped dir: {path}")
+        for dir_path, rollup in sorted(self.dirs.items()):
+            suffixes = ", ".join(
+                f"{suffix} x{count}"
+                for suffix, count in self.get_top_suffixes(dir_path)
+            )
+            samples = ", ".join(path.name for path in rollup.samples)
+            lines.append(
+                f"- {dir_path}: {rollup.count} files, {rollup.bytes} bytes ({suffixes}) eg: {samples}"
+            )
+        return lines
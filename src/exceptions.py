@@ -20,3 +20,19 @@ class InvalidConfigurationException(Exception):
 
 class MustBeRunAsRootException(Exception):
     pass
+
+
+class VcsException(Exception):
+    pass
+
+
+class DaemonException(Exception):
+    pass
+
+
+class SnapshotException(Exception):
+    pass
+
+
+class BundleException(Exception):
+    pass
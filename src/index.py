@@ -0,0 +1,237 @@
+import os
+import time
+import sqlite3
+import logging
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import src.utils as utils
+from src.instrumentation import run_stats
+from src.mytypes import Environment, PluginName, PluginConfigFile
+from src.semdiff import KeyChange
+
+logger = logging.getLogger(__name__)
+
+INDEX_DIRNAME = ".patchouli"
+INDEX_SCHEMA_VERSION = 1
+
+# (plugin, relpath) -> (size, mtime_ns, hash)
+IndexRows = Dict[Tuple[PluginName, str], Tuple[int, int, str]]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+-- Last known state of every tracked config file in the env.
+CREATE TABLE IF NOT EXISTS files (
+    plugin TEXT NOT NULL,
+    relpath TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    PRIMARY KEY (plugin, relpath)
+);
+-- State of the tracked config files as of the last sync to or from this env.
+CREATE TABLE IF NOT EXISTS synced (
+    plugin TEXT NOT NULL,
+    relpath TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    PRIMARY KEY (plugin, relpath)
+);
+"""
+
+
+def get_env_index_path(base_path: Path, env: Environment) -> Path:
+    return base_path / INDEX_DIRNAME / f"{env.value}.index.sqlite3"
+
+
+@dataclass
+class PluginFileChanges:
+    added: List[str] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+    modified: List[str] = field(default_factory=list)
+    # Key paths that changed in modified files, for files that were diffed by structure.
+    key_changes: Dict[str, List[KeyChange]] = field(default_factory=dict)
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.removed or self.modified)
+
+
+class EnvIndex:
+    """
+    SQLite index of the tracked config files of a single env.
+
+    Every walk refreshes the `files` table, but a file is only re-hashed if its size or mtime
+    changed since it was last indexed. A sync snapshots `files` into `synced`, so working out what
+    changed since the last sync is a table comparison rather than a rehash of the whole env.
+    """
+
+    db_path: Path
+    conn: sqlite3.Connection
+
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        # The index may be built on a worker thread and read from the main thread afterwards.
+        # It's never used by two threads at once.
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        self.__check_schema_version()
+
+    def __check_schema_version(self) -> None:
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = 'schema_version'"
+        ).fetchone()
+        if row is not None and int(row[0]) == INDEX_SCHEMA_VERSION:
+            return
+
+        with self.conn:
+            self.conn.execute("DELETE FROM files")
+            self.conn.execute("DELETE FROM synced")
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('schema_version', ?)",
+                (str(INDEX_SCHEMA_VERSION),),
+            )
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def get_rows(self, plugins: Optional[Iterable[PluginName]] = None) -> IndexRows:
+        rows = self.conn.execute(
+            "SELECT plugin, relpath, size, mtime_ns, hash FROM files"
+        ).fetchall()
+        plugin_set = set(plugins) if plugins is not None else None
+        return {
+            (plugin, relpath): (size, mtime_ns, file_hash)
+            for plugin, relpath, size, mtime_ns, file_hash in rows
+            if plugin_set is None or plugin in plugin_set
+        }
+
+    def refresh(
+        self,
+        plugin_config_mapping: Dict[PluginName, List[PluginConfigFile]],
+        plugin_path_base: Path,
+        complete: bool,
+        map_func: Callable = lambda func, items: [func(item) for item in items],
+    ) -> int:
+        """
+        Brings the `files` table in line with plugin_config_mapping, hashing only files whose
+        size or mtime differ from the index. map_func lets the caller parallelize the hashing.
+
+        Rows of plugins in the mapping that no longer have the file are dropped. If complete is
+        set, the mapping is a full scan of the env and rows of plugins not in it are dropped too.
+
+        Returns the number of files that had to be hashed.
+        """
+        known = self.get_rows(plugin_config_mapping.keys())
+
+        current = {}
+        to_hash = []
+        for plugin_name, files in plugin_config_mapping.items():
+            plugin_dir = plugin_path_base / plugin_name
+            for file_path in files:
+                relpath = str(file_path.relative_to(plugin_dir))
+                try:
+                    file_stat = os.stat(file_path)
+                except FileNotFoundError:
+                    continue
+
+                key = (plugin_name, relpath)
+                row = known.get(key)
+                if (
+                    row is not None
+                    and row[0] == file_stat.st_size
+                    and row[1] == file_stat.st_mtime_ns
+                ):
+                    current[key] = row
+                else:
+                    to_hash.append((key, file_path, file_stat))
+
+        run_stats.add_many(
+            entries_stated=len(current) + len(to_hash), hashes_avoided=len(current)
+        )
+
+        hashes = map_func(lambda item: utils.hash_file(item[1]), to_hash)
+        for (key, _, file_stat), file_hash in zip(to_hash, hashes):
+            current[key] = (file_stat.st_size, file_stat.st_mtime_ns, file_hash)
+
+        with self.conn:
+            if complete:
+                self.conn.execute("DELETE FROM files")
+            else:
+                self.conn.executemany(
+                    "DELETE FROM files WHERE plugin = ?",
+                    [(plugin_name,) for plugin_name in plugin_config_mapping],
+                )
+            self.conn.executemany(
+                "INSERT INTO files (plugin, relpath, size, mtime_ns, hash) VALUES (?, ?, ?, ?, ?)",
+                [(plugin, relpath, *row) for (plugin, relpath), row in current.items()],
+            )
+
+        return len(to_hash)
+
+    def mark_synced(self, plugins: Optional[Iterable[PluginName]] = None) -> None:
+        """
+        Snapshots the current `files` rows as the synced state, for all plugins or just plugins.
+        """
+        with self.conn:
+            if plugins is None:
+                self.conn.execute("DELETE FROM synced")
+                self.conn.execute(
+                    "INSERT INTO synced (plugin, relpath, hash) SELECT plugin, relpath, hash FROM files"
+                )
+            else:
+                for plugin_name in plugins:
+                    self.conn.execute(
+                        "DELETE FROM synced WHERE plugin = ?", (plugin_name,)
+                    )
+                    self.conn.execute(
+                        "INSERT INTO synced (plugin, relpath, hash) SELECT plugin, relpath, hash FROM files WHERE plugin = ?",
+                        (plugin_name,),
+                    )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('last_synced', ?)",
+                (str(time.time()),),
+            )
+
+    def get_last_synced(self) -> Optional[float]:
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = 'last_synced'"
+        ).fetchone()
+        return float(row[0]) if row is not None else None
+
+    def get_changes_since_sync(
+        self, plugins: Optional[Iterable[PluginName]] = None
+    ) -> Dict[PluginName, PluginFileChanges]:
+        plugin_set = set(plugins) if plugins is not None else None
+
+        current = {key: row[2] for key, row in self.get_rows(plugin_set).items()}
+        synced = {
+            (plugin, relpath): file_hash
+            for plugin, relpath, file_hash in self.conn.execute(
+                "SELECT plugin, relpath, hash FROM synced"
+            )
+            if plugin_set is None or plugin in plugin_set
+        }
+
+        changes: Dict[PluginName, PluginFileChanges] = {}
+        for key in sorted(current.keys() | synced.keys()):
+            plugin_name, relpath = key
+            if key not in synced:
+                changes.setdefault(plugin_name, PluginFileChanges()).added.append(
+                    relpath
+                )
+            elif key not in current:
+                changes.setdefault(plugin_name, PluginFileChanges()).removed.append(
+                    relpath
+                )
+            elif current[key] != synced[key]:
+                changes.setdefault(plugin_name, PluginFileChanges()).modified.append(
+                    relpath
+                )
+
+        return changes
@@ -0,0 +1,137 @@
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+
+from argparse import ArgumentParser, Namespace
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional
+
+
+class RunStats:
+    """
+    Process wide counters and per phase timers, printed by `--stats`.
+
+    Phase timers measure wall time and accumulate if a phase runs more than once. Counters are
+    safe to bump from worker threads, but hot loops should tally locally and add once at the end.
+    """
+
+    counters: Dict[str, int]
+    timers: Dict[str, float]
+    lock: threading.Lock
+
+    def __init__(self):
+        self.counters = {}
+        self.timers = {}
+        self.lock = threading.Lock()
+
+    def add(self, name: str, count: int = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def add_many(self, **counts: int) -> None:
+        with self.lock:
+            for name, count in counts.items():
+                self.counters[name] = self.counters.get(name, 0) + count
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.timers[name] = self.timers.get(name, 0.0) + elapsed
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counters = {}
+            self.timers = {}
+
+    def as_dict(self) -> Dict[str, Dict]:
+        with self.lock:
+            return {"timers": dict(self.timers), "counters": dict(self.counters)}
+
+    def format(self) -> str:
+        data = self.as_dict()
+        lines = ["Phase timings:"]
+        for name, elapsed in data["timers"].items():
+            lines.append(f"  {name:<24} {elapsed:>10.4f}s")
+        lines.append("Counters:")
+        for name, count in sorted(data["counters"].items()):
+            lines.append(f"  {name:<24} {count:>10}")
+        return "\n".join(lines)
+
+
+run_stats = RunStats()
+
+
+def add_instrumentation_argparse_args(parser: ArgumentParser) -> ArgumentParser:
+    parser.add_argument(
+        "--stats",
+        default=False,
+        action="store_true",
+        help="Print per phase timings and counters to stderr when done.",
+    )
+    parser.add_argument(
+        "--stats-json",
+        default=None,
+        metavar="FILE",
+        help="Write per phase timings and counters to FILE as JSON.",
+    )
+    parser.add_argument(
+        "--profile",
+        default=False,
+        action="store_true",
+        help="Run under cProfile and print the top functions to stderr when done.",
+    )
+    parser.add_argument(
+        "--profile-out",
+        default=None,
+        metavar="FILE",
+        help="Run under cProfile and dump pstats data to FILE.",
+    )
+    return parser
+
+
+def get_profile_target(args: Namespace) -> Optional[str]:
+    """
+    The profile argument for run_instrumented from parsed instrumentation args.
+    """
+    if args.profile_out is not None:
+        return args.profile_out
+    return "-" if args.profile else None
+
+
+def run_instrumented(
+    func: Callable,
+    show_stats: bool = False,
+    stats_json: Optional[str] = None,
+    profile: Optional[str] = None,
+) -> None:
+    """
+    Runs func, reporting stats and profiling output afterwards - even if func raised or exited.
+    """
+    profiler = cProfile.Profile() if profile is not None else None
+    try:
+        with run_stats.phase("total"):
+            if profiler is not None:
+                profiler.runcall(func)
+            else:
+                func()
+    finally:
+        if profiler is not None:
+            if profile == "-":
+                pstats.Stats(profiler, stream=sys.stderr).sort_stats(
+                    "cumulative"
+                ).print_stats(40)
+            else:
+                profiler.dump_stats(profile)
+        if show_stats:
+            print(run_stats.format(), file=sys.stderr)
+        if stats_json is not None:
+            with open(stats_json, "w") as f:
+                json.dump(run_stats.as_dict(), f, indent=2)
@@ -0,0 +1,196 @@
+import os
+import json
+import logging
+import threading
+
+from dataclasses import asdict
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import src.utils as utils
+from src.instrumentation import run_stats
+from src.mytypes import PluginJar, PluginMetadata
+
+logger = logging.getLogger(__name__)
+
+JarCacheKey = Tuple[int, int, int]
+
+CACHE_FORMAT_VERSION = 1
+CACHE_FILENAME = "jar_metadata_cache.json"
+
+
+def get_jar_cache_key(stat_result: os.stat_result) -> JarCacheKey:
+    """
+    (inode, size, mtime_ns) - if any of these change we consider the jar to have changed.
+    """
+    return (stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns)
+
+
+class JarMetadataCache:
+    """
+    On-disk cache of parsed plugin.yml metadata, keyed by jar path + (inode, size, mtime_ns).
+
+    Opening every jar and yaml parsing its plugin.yml is the bulk of our startup time, so we
+    only do so for jars whose key has changed since the last run.
+    """
+
+    cache_path: Path
+    logger: logging.Logger
+
+    entries: Dict[str, Dict]
+    dirty: bool
+    lock: threading.Lock
+
+    hits: int
+    misses: int
+
+    def __init__(self, cache_path: Path, logger: Optional[logging.Logger] = None):
+        self.cache_path = cache_path
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+
+        self.entries = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.load()
+
+    def load(self) -> None:
+        if not self.cache_path.exists():
+            return
+
+        try:
+            with open(self.cache_path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            self.logger.warning(
+                f"Could not read jar cache at {self.cache_path} - Rebuilding. ({e})"
+            )
+            self.dirty = True
+            return
+
+        if data.get("version") != CACHE_FORMAT_VERSION:
+            self.logger.debug(
+                f"Jar cache at {self.cache_path} is an old format - Discarding."
+            )
+            self.dirty = True
+            return
+
+        self.entries = data.get("jars", {})
+
+    def save(self) -> None:
+        with self.lock:
+            self.__save()
+
+    def __save(self) -> None:
+        if not self.dirty:
+            return
+
+        tmp_path = self.cache_path.with_name(self.cache_path.name + ".tmp")
+        try:
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump({"version": CACHE_FORMAT_VERSION, "jars": self.entries}, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            # The cache is purely an optimization. Never fail a command over it.
+            self.logger.warning(f"Could not write jar cache to {self.cache_path}: {e}")
+            return
+
+        self.dirty = False
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries = {}
+            self.dirty = True
+
+    def invalidate(self, jar_path: PluginJar) -> None:
+        with self.lock:
+            if self.entries.pop(str(jar_path), None) is not None:
+                self.dirty = True
+
+    def get_metadata(
+        self, jar_path: PluginJar, stat_result: Optional[os.stat_result] = None
+    ) -> PluginMetadata:
+        """
+        Returns the cached metadata for jar_path, re-reading the jar only if its key changed.
+
+        Pass stat_result if the caller already has one (eg, from os.scandir) to save a stat.
+        Safe to call from multiple threads.
+        """
+        if stat_result is None:
+            stat_result = jar_path.stat()
+        key = list(get_jar_cache_key(stat_result))
+
+        with self.lock:
+            entry = self.entries.get(str(jar_path))
+            if entry is not None and entry["key"] == key:
+                self.hits += 1
+                run_stats.add("jar_reads_avoided")
+                return PluginMetadata(**entry["metadata"])
+            self.misses += 1
+
+        # Read outside the lock so concurrent misses don't serialize on jar IO.
+        self.logger.debug(f"Jar cache miss - Reading plugin.yml from {jar_path}")
+        metadata = utils.get_plugin_metadata_from_jar(jar_path)
+
+        with self.lock:
+            self.entries[str(jar_path)] = {"key": key, "metadata": asdict(metadata)}
+            self.dirty = True
+
+        return metadata
+
+    def get_hash(
+        self, jar_path: PluginJar, stat_result: Optional[os.stat_result] = None
+    ) -> str:
+        """
+        Returns the jar's content hash, only hashing it if its key changed since it was last hashed.
+
+        The hash is kept alongside the jar's metadata, so it's only cached for jars that have been
+        through get_metadata with the same key.
+        """
+        if stat_result is None:
+            stat_result = jar_path.stat()
+        key = list(get_jar_cache_key(stat_result))
+
+        with self.lock:
+            entry = self.entries.get(str(jar_path))
+            if entry is not None and entry["key"] == key and "hash" in entry:
+                run_stats.add("jar_hashes_avoided")
+                return entry["hash"]
+
+        file_hash = utils.hash_file(jar_path)
+
+        with self.lock:
+            entry = self.entries.get(str(jar_path))
+            if entry is not None and entry["key"] == key:
+                entry["hash"] = file_hash
+                self.dirty = True
+
+        return file_hash
+
+    def put(
+        self,
+        jar_path: PluginJar,
+        stat_result: os.stat_result,
+        metadata: PluginMetadata,
+        file_hash: Optional[str] = None,
+    ) -> None:
+        """
+        Records already known metadata for jar_path, eg after copying a jar whose metadata we read.
+        """
+        entry: Dict = {
+            "key": list(get_jar_cache_key(stat_result)),
+            "metadata": asdict(metadata),
+        }
+        if file_hash is not None:
+            entry["hash"] = file_hash
+
+        with self.lock:
+            self.entries[str(jar_path)] = entry
+            self.dirty = True
+
+
+def get_jar_cache_path(cache_dir: str) -> Path:
+    return Path(os.path.expanduser(cache_dir)) / CACHE_FILENAME
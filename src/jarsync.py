@@ -0,0 +1,234 @@
+import os
+import errno
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from zipfile import BadZipFile
+
+import src.utils as utils
+from src.exceptions import InvalidPluginException
+from src.instrumentation import run_stats
+from src.jarcache import JarMetadataCache
+from src.mytypes import PluginJar, PluginMetadata, PluginName
+from src.sync import FileCopier
+
+logger = logging.getLogger(__name__)
+
+# Errors meaning a hardlink isn't possible here, eg across filesystems.
+UNSUPPORTED_LINK_ERRNOS = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP}
+
+
+@dataclass
+class JarSyncStats:
+    copied: int = 0
+    linked: int = 0
+    skipped: int = 0
+    removed: int = 0
+    bytes_copied: int = 0
+
+    def __str__(self) -> str:
+        return (
+            f"copied {self.copied} jars ({self.bytes_copied} bytes), hardlinked {self.linked}, "
+            f"skipped {self.skipped} identical jars, removed {self.removed} other versions"
+        )
+
+
+class JarSyncer:
+    """
+    Brings the jars in a destination plugins dir in line with a source env's jars.
+
+    Jars are matched by plugin name from their plugin.yml, not by filename, so a dest jar of the
+    same plugin with different contents - usually another version - is replaced, and any other
+    jars of that plugin in dest are removed. Identical jars are detected by content hash, which
+    is kept in the jar cache so a jar is only hashed again after it changes.
+
+    New jars are written under a temp name and renamed into place, so a running server never
+    sees a partial jar. They're reflinked where the filesystem allows it, or hardlinked to the
+    source jar if use_hardlinks is set. Hardlinked envs share the jar's inode, which breaks if
+    anything rewrites a jar in place instead of replacing it.
+    """
+
+    jar_cache: Optional[JarMetadataCache]
+    copier: FileCopier
+    use_hardlinks: bool
+    jobs: int
+
+    stats: JarSyncStats
+    lock: threading.Lock
+
+    def __init__(
+        self,
+        jar_cache: Optional[JarMetadataCache],
+        copier: FileCopier,
+        use_hardlinks: bool = False,
+        jobs: int = 1,
+    ):
+        self.jar_cache = jar_cache
+        self.copier = copier
+        self.use_hardlinks = use_hardlinks
+        self.jobs = max(1, jobs)
+        self.stats = JarSyncStats()
+        self.lock = threading.Lock()
+
+    def __get_hash(self, jar_path: PluginJar, jar_stat: os.stat_result) -> str:
+        if self.jar_cache is not None:
+            return self.jar_cache.get_hash(jar_path, jar_stat)
+        return utils.hash_file(jar_path)
+
+    def identify_jars(
+        self, plugin_path_base: Path
+    ) -> Dict[PluginName, List[Tuple[PluginJar, os.stat_result]]]:
+        """
+        Maps each plugin name to every jar of it in plugin_path_base. Unidentifiable jars are
+        left alone.
+        """
+        with os.scandir(plugin_path_base) as it:
+            jar_entries = [
+                entry
+                for entry in it
+                if entry.is_file(follow_symlinks=False) and entry.name.endswith(".jar")
+            ]
+
+        jars: Dict[PluginName, List[Tuple[PluginJar, os.stat_result]]] = {}
+        for jar_entry in jar_entries:
+            jar_path = Path(jar_entry.path)
+            jar_stat = jar_entry.stat()
+            try:
+                metadata = (
+                    self.jar_cache.get_metadata(jar_path, jar_stat)
+                    if self.jar_cache is not None
+                    else utils.get_plugin_metadata_from_jar(jar_path)
+                )
+            except (InvalidPluginException, BadZipFile) as e:
+                logger.warning(
+                    f"Could not identify {jar_path} as a plugin - Leaving it alone."
+                )
+                logger.debug(f"{jar_path}: {e!r}")
+                continue
+            jars.setdefault(metadata.name, []).append((jar_path, jar_stat))
+        return jars
+
+    def __place(
+        self, src_path: PluginJar, src_stat: os.stat_result, dest_path: PluginJar
+    ) -> bool:
+        """
+        Puts src_path at dest_path atomically. Returns True if it was hardlinked.
+        """
+        tmp_path = dest_path.with_name(f".{dest_path.name}.patchouli-tmp")
+        tmp_path.unlink(missing_ok=True)
+        try:
+            if self.use_hardlinks:
+                try:
+                    os.link(src_path, tmp_path)
+                    os.replace(tmp_path, dest_path)
+                    return True
+                except OSError as e:
+                    if e.errno not in UNSUPPORTED_LINK_ERRNOS:
+                        raise
+                    logger.debug(f"Can't hardlink {src_path} ({e}) - Copying instead")
+                    self.use_hardlinks = False
+
+            self.copier.copy_file(src_path, tmp_path, src_stat)
+            os.replace(tmp_path, dest_path)
+            return False
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    def __sync_jar(
+        self,
+        item: Tuple[
+            PluginJar, PluginMetadata, List[Tuple[PluginJar, os.stat_result]], Path
+        ],
+    ) -> None:
+        src_path, metadata, dest_jars, dest_path_base = item
+        src_stat = os.stat(src_path)
+        src_hash: Optional[str] = None
+
+        for dest_path, dest_stat in dest_jars:
+            if (dest_stat.st_dev, dest_stat.st_ino) == (
+                src_stat.st_dev,
+                src_stat.st_ino,
+            ):
+                identical = True
+            elif dest_stat.st_size != src_stat.st_size:
+                identical = False
+            else:
+                if src_hash is None:
+                    src_hash = self.__get_hash(src_path, src_stat)
+                identical = self.__get_hash(dest_path, dest_stat) == src_hash
+
+            if identical:
+                for other_path, _ in dest_jars:
+                    if other_path != dest_path:
+                        self.__remove(other_path)
+                with self.lock:
+                    self.stats.skipped += 1
+                return
+
+        dest_path = dest_path_base / src_path.name
+        linked = self.__place(src_path, src_stat, dest_path)
+        for old_path, _ in dest_jars:
+            if old_path != dest_path:
+                self.__remove(old_path)
+
+        if dest_jars:
+            logger.info(
+                f"Replaced {', '.join(path.name for path, _ in dest_jars)} with {src_path.name} ({metadata.name} {metadata.version})"
+            )
+        else:
+            logger.debug(f"{src_path} => {dest_path}")
+
+        if self.jar_cache is not None:
+            self.jar_cache.put(dest_path, os.stat(dest_path), metadata, src_hash)
+
+        with self.lock:
+            if linked:
+                self.stats.linked += 1
+            else:
+                self.stats.copied += 1
+                self.stats.bytes_copied += src_stat.st_size
+
+    def __remove(self, jar_path: PluginJar) -> None:
+        jar_path.unlink(missing_ok=True)
+        if self.jar_cache is not None:
+            self.jar_cache.invalidate(jar_path)
+        with self.lock:
+            self.stats.removed += 1
+        logger.debug(f"Removed {jar_path}")
+
+    def sync(
+        self,
+        src_jars: Dict[PluginName, Tuple[PluginJar, PluginMetadata]],
+        dest_path_base: Path,
+    ) -> JarSyncStats:
+        """
+        src_jars maps plugin names to their jar and its metadata, eg Patchouli's
+        plugin_jar_mapping and plugin_metadata_mapping. Dest jars of plugins not in src_jars are
+        left alone.
+        """
+        dest_jars = self.identify_jars(dest_path_base)
+        items = [
+            (src_path, metadata, dest_jars.get(plugin_name, []), dest_path_base)
+            for plugin_name, (src_path, metadata) in sorted(src_jars.items())
+        ]
+
+        with run_stats.phase("jar_sync"):
+            if self.jobs <= 1 or len(items) <= 1:
+                for item in items:
+                    self.__sync_jar(item)
+            else:
+                with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                    list(executor.map(self.__sync_jar, items))
+
+        if self.jar_cache is not None:
+            self.jar_cache.save()
+        run_stats.add_many(
+            jars_copied=self.stats.copied,
+            jars_linked=self.stats.linked,
+            jar_copies_avoided=self.stats.skipped,
+        )
+        return self.stats
@@ -1,11 +1,12 @@
 import re
-import enum
 
+from dataclasses import dataclass, field
+from functools import lru_cache
 from pathlib import Path
-from typing import TypeAlias
+from typing import TypeAlias, Dict, Iterator, List, Optional
 
-from src.constants import CONFIG_NAME
-from src.common.config import get_config
+from src.constants import CONFIG_NAME, VCS_ENV
+from src.common.config import Config, get_config
 
 PluginName: TypeAlias = str
 PluginJar: TypeAlias = Path
@@ -13,13 +14,104 @@ PluginDir: TypeAlias = Path
 PluginConfigFile: TypeAlias = Path
 PluginDataFile: TypeAlias = Path
 
-envs = {"VCS": "vcs"}
 
-config = get_config(CONFIG_NAME)
-for env_path in Path(config.base_path).iterdir():
-    env_name = env_path.name
-    if re.match(config.env_name_regex, env_name):
-        envs[env_name.upper()] = env_name.lower()
+@dataclass
+class PluginMetadata:
+    """
+    The subset of a jar's plugin.yml that Patchouli cares about.
+    """
 
-# https://github.com/python/mypy/issues/5317
-Environment: enum.Enum = enum.Enum("Environment", envs)  # type: ignore
+    name: PluginName
+    version: Optional[str] = None
+    depend: List[PluginName] = field(default_factory=list)
+    softdepend: List[PluginName] = field(default_factory=list)
+
+
+# Set by set_patchouli_config to run against a config other than patchouli_config.yml.
+__CONFIG_OVERRIDE: Optional[Config] = None
+
+
+@lru_cache(maxsize=None)
+def get_patchouli_config() -> Config:
+    """
+    Loads patchouli_config.yml on first use rather than at import time.
+    """
+    if __CONFIG_OVERRIDE is not None:
+        return __CONFIG_OVERRIDE
+    return get_config(CONFIG_NAME)
+
+
+def set_patchouli_config(config: Optional[Config]) -> None:
+    """
+    Points the rest of the process at config instead of patchouli_config.yml, eg to run against a
+    generated base path. Pass None to go back to patchouli_config.yml.
+
+    Envs are rediscovered on next use. Callers should also call utils.clear_config_caches.
+    """
+    global __CONFIG_OVERRIDE
+    __CONFIG_OVERRIDE = config
+    get_patchouli_config.cache_clear()
+    _discover_environments.cache_clear()
+
+
+class _EnvironmentMeta(type):
+    """
+    Makes Environment behave like an Enum whose members are only discovered the first time
+    they're needed, so importing this module never touches the filesystem.
+    """
+
+    def _members(cls) -> Dict[str, "Environment"]:
+        return _discover_environments()
+
+    def __call__(cls, value):
+        if isinstance(value, cls):
+            return value
+        for member in cls._members().values():
+            if member.value == value:
+                return member
+        raise ValueError(f"{value!r} is not a valid Environment")
+
+    def __getattr__(cls, name: str) -> "Environment":
+        members = cls._members()
+        if name in members:
+            return members[name]
+        raise AttributeError(name)
+
+    def __iter__(cls) -> Iterator["Environment"]:
+        return iter(list(cls._members().values()))
+
+    def __len__(cls) -> int:
+        return len(cls._members())
+
+
+class Environment(metaclass=_EnvironmentMeta):
+    __slots__ = ("name", "value")
+
+    name: str
+    value: str
+
+    def __init__(self, name: str, value: str):
+        self.name = name
+        self.value = value
+
+    def __repr__(self) -> str:
+        return f"<Environment.{self.name}: {self.value!r}>"
+
+    def __str__(self) -> str:
+        return f"Environment.{self.name}"
+
+
+@lru_cache(maxsize=None)
+def _discover_environments() -> Dict[str, Environment]:
+    config = get_patchouli_config()
+    envs = {VCS_ENV.upper(): VCS_ENV}
+
+    env_name_regex = re.compile(config.env_name_regex)
+    for env_path in Path(config.base_path).iterdir():
+        env_name = env_path.name
+        if env_name_regex.match(env_name):
+            envs[env_name.upper()] = env_name.lower()
+
+    return {
+        name: type.__call__(Environment, name, value) for name, value in envs.items()
+    }
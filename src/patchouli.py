@@ -1,20 +1,55 @@
 #!/usr/bin/env python3
 import os
 import sys
+import json
+import time
 import shutil
 
+import sqlite3
 import logging
 
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
 from pathlib import Path
-from typing import Optional, Set, Dict, List, Tuple
+from typing import (
+    Callable,
+    Iterable,
+    Iterator,
+    Optional,
+    Set,
+    Dict,
+    List,
+    Tuple,
+    Union,
+    TextIO,
+)
 
 import src.utils as utils
 from src.common.config import Config
+from src.jarcache import JarMetadataCache, get_jar_cache_path
+from src.jarsync import JarSyncer
+from src.daemon_client import DaemonClient, get_daemon_socket_path
+from src.discarded import DiscardSummary
+from src.instrumentation import run_stats
+from src.index import EnvIndex, get_env_index_path
+from src.sync import (
+    CopyAction,
+    CopyEngine,
+    CopyPlan,
+    CopyStats,
+    FileCopier,
+    PlannedFile,
+    is_unchanged,
+)
+from src.vcs import GitRepo, get_file_mode
+from src.constants import VCS_ENV
 from src.mytypes import *
 from src.exceptions import (
+    DaemonException,
     UnidentifiablePluginDirException,
     InvalidEnvironmentException,
     InvalidConfigurationException,
+    VcsException,
 )
 
 
@@ -27,19 +62,43 @@ class Patchouli:
 
     target_env: Environment
     base_path: Path
+    plugin_path_base: Path
 
     config_suffixes: Set
-    config_paths_to_ignore: Dict[PluginName, List[Path]]
+    config_paths_to_ignore: Dict[PluginName, List[str]]
+    folders_to_ignore: utils.NameFilter
+    # Compiled once per plugin on first walk.
+    plugin_dir_rules: Dict[PluginName, utils.DirRules]
 
-    plugin_names: Set[PluginName] = set()
-    plugin_jar_mapping: Dict[PluginName, PluginJar] = {}
-    plugin_dir_mapping: Dict[PluginName, PluginDir] = {}
-    plugin_config_mapping: Dict[PluginName, List[PluginConfigFile]] = {}
-    plugin_data_mapping: Dict[PluginName, List[PluginDataFile]] = {}
+    plugin_names: Set[PluginName]
+    plugin_jar_mapping: Dict[PluginName, PluginJar]
+    plugin_metadata_mapping: Dict[PluginName, PluginMetadata]
+    plugin_dir_mapping: Dict[PluginName, PluginDir]
+    plugin_config_mapping: Dict[PluginName, List[PluginConfigFile]]
+    plugin_data_mapping: Dict[PluginName, List[PluginDataFile]]
 
     create_missing_dirs: bool
 
-    discarded_files: Set[Path] = set()
+    jar_cache: Optional[JarMetadataCache]
+
+    jobs: int
+
+    use_file_index: bool
+    file_index: Optional[EnvIndex]
+
+    discover_files: bool
+    use_daemon: bool
+
+    list_discarded: bool
+    plugin_discarded_mapping: Dict[PluginName, DiscardSummary]
+
+    discover_plugins: bool
+    discover_server_configs: bool
+    server_path_base: Optional[Path]
+    server_config_files: List[Path]
+    server_discarded: DiscardSummary
+    # Compiled on first walk.
+    server_dir_rules: Optional[utils.DirRules]
 
     def __init__(
         self,
@@ -49,10 +108,42 @@ class Patchouli:
         create_missing_dirs: Optional[bool] = None,
         plugins_whitelist: Optional[List[PluginName]] = None,
         plugins_blacklist: Optional[List[PluginName]] = None,
+        jar_cache: Optional[JarMetadataCache] = None,
+        use_jar_cache: Optional[bool] = None,
+        jobs: Optional[int] = None,
+        use_file_index: Optional[bool] = None,
+        discover_files: bool = True,
+        list_discarded: bool = False,
+        use_daemon: Optional[bool] = None,
+        discover_plugins: bool = True,
+        discover_server_configs: bool = False,
     ):
+        """
+        If discover_files is False only jars and plugin dirs are mapped up front, and config files
+        are left to be streamed on demand with iter_plugin_files.
+
+        Discarded files are rolled up per directory unless list_discarded is set, in which case
+        every discarded path is kept as well.
+
+        If use_daemon is set and a `git patchy daemon` is running, the mappings are taken from the
+        daemon instead of scanning the env.
+
+        If discover_server_configs is set, the server configs in the env folder are found too - see
+        populate_server_data. discover_plugins can be unset for instances that only deal with those.
+        """
         self.config = config
         self.logger = logger if logger is not None else logging.getLogger(__name__)
 
+        # Per instance so several envs can be scanned in one process.
+        self.plugin_names = set()
+        self.plugin_jar_mapping = {}
+        self.plugin_metadata_mapping = {}
+        self.plugin_dir_mapping = {}
+        self.plugin_config_mapping = {}
+        self.plugin_data_mapping = {}
+        self.plugin_discarded_mapping = {}
+        self.list_discarded = list_discarded
+
         if plugins_whitelist is not None and plugins_blacklist is not None:
             raise InvalidConfigurationException(
                 "Cannot provide both a whitelist and blacklist"
@@ -70,9 +161,18 @@ class Patchouli:
         pluginscfg = self.config.plugins
         self.config_suffixes = set(pluginscfg.configs.suffixes)
         self.config_paths_to_ignore = {
-            plugin_name: [Path(path) for path in paths]
+            plugin_name: [str(path) for path in paths]
             for plugin_name, paths in pluginscfg.configs.paths_to_ignore.items()
         }
+        self.folders_to_ignore = utils.NameFilter(pluginscfg.folders_to_ignore)
+        self.plugin_dir_rules = {}
+
+        self.discover_plugins = discover_plugins
+        self.discover_server_configs = discover_server_configs
+        self.server_path_base = None
+        self.server_config_files = []
+        self.server_discarded = DiscardSummary(keep_paths=list_discarded)
+        self.server_dir_rules = None
 
         self.create_missing_dirs = (
             create_missing_dirs
@@ -80,108 +180,568 @@ class Patchouli:
             else self.config.default_create_missing_dirs
         )
 
-        self.populate_plugin_data(target_env=self.target_env)
-
-    def get_config_files_from_plugin_dir(
-        self, plugin_name: PluginName, plugin_dir: PluginDir
-    ) -> Tuple[List[Path], List[Path]]:
+        use_jar_cache = (
+            use_jar_cache if use_jar_cache is not None else self.config.use_jar_cache
+        )
+        if jar_cache is not None:
+            self.jar_cache = jar_cache
+        elif use_jar_cache:
+            self.jar_cache = JarMetadataCache(
+                get_jar_cache_path(self.config.cache_dir), logger=self.logger
+            )
+        else:
+            self.jar_cache = None
 
-        paths_to_ignore = (
-            []
-            if plugin_name not in self.config_paths_to_ignore
-            else self.config_paths_to_ignore[plugin_name]
+        self.jobs = max(
+            1, jobs if jobs is not None else self.config.default_discovery_jobs
         )
 
-        suffixes_to_search = self.config_suffixes
-        suffixes_override = (
-            self.config.plugins.configs.suffixes_override.get_or_default(plugin_name)
+        self.discover_files = discover_files
+        self.use_daemon = (
+            use_daemon if use_daemon is not None else self.config.use_daemon
+        )
+        self.use_file_index = (
+            discover_plugins
+            and discover_files
+            and (
+                use_file_index
+                if use_file_index is not None
+                else self.config.use_file_index
+            )
+        )
+        self.file_index = (
+            self.open_file_index(self.target_env) if self.use_file_index else None
         )
 
-        (
-            all_valid_config_files,
-            all_ignored_paths_and_dirs,
-        ) = utils.find_all_files_with_exts(
+        try:
+            self.populate_plugin_data(target_env=self.target_env)
+            if self.discover_server_configs:
+                self.populate_server_data(target_env=self.target_env)
+        except OSError:
+            # Most likely the env was removed since it was validated.
+            utils.forget_validated_env(self.target_env)
+            raise
+
+    def get_dir_rules(self, plugin_name: PluginName) -> utils.DirRules:
+        """
+        The plugin's paths_to_ignore and suffixes_override, compiled on first use.
+        """
+        rules = self.plugin_dir_rules.get(plugin_name)
+        if rules is None:
+            rules = self.plugin_dir_rules[plugin_name] = utils.compile_dir_rules(
+                self.config_paths_to_ignore.get(plugin_name, []),
+                self.config.plugins.configs.suffixes_override.get_or_default(
+                    plugin_name
+                ),
+            )
+        return rules
+
+    def get_config_files_from_plugin_dir(
+        self,
+        plugin_name: PluginName,
+        plugin_dir: PluginDir,
+        on_dir: Optional[Callable[[str], None]] = None,
+    ) -> Tuple[List[Path], DiscardSummary]:
+        """
+        on_dir is called with each dir the walk descends into, before it's listed.
+        """
+        discarded = DiscardSummary(keep_paths=self.list_discarded)
+        all_valid_config_files, _ = utils.find_all_files_with_exts(
             base_path=plugin_dir,
-            extensions=suffixes_to_search,
-            paths_to_ignore=paths_to_ignore,
-            suffixes_override=suffixes_override,
+            extensions=self.config_suffixes,
+            paths_to_ignore=[],
+            suffixes_override=None,
+            discarded=discarded,
+            rules=self.get_dir_rules(plugin_name),
+            on_dir=on_dir,
         )
 
-        return all_valid_config_files, all_ignored_paths_and_dirs
+        return all_valid_config_files, discarded
+
+    def scan_config_files(
+        self, plugin_names: Iterable[PluginName], plugin_path_base: Path
+    ) -> Dict[PluginName, List[PluginConfigFile]]:
+        """
+        The config files currently under plugin_path_base for each of plugin_names, by this env's
+        rules. Plugins without a dir there map to no files.
+
+        Used to refresh a file index after writing into an env - a mapping of only the written
+        files would drop the files the env has that the source doesn't.
+        """
+        plugin_names = list(plugin_names)
+        scanned = self.__map(
+            lambda plugin_name: (
+                self.get_config_files_from_plugin_dir(
+                    plugin_name, plugin_path_base / plugin_name
+                )[0]
+                if (plugin_path_base / plugin_name).is_dir()
+                else []
+            ),
+            plugin_names,
+        )
+        return dict(zip(plugin_names, scanned))
 
     def populate_plugin_data(self, target_env: Environment) -> None:
         self.logger.debug("Populating plugin data with:")
         self.logger.debug(f" - Whitelist: {self.plugins_whitelist}")
         self.logger.debug(f" - Blacklist: {self.plugins_blacklist}")
         # Jars
-        jar_paths = [
-            x
-            for x in utils.get_plugin_path_base(
-                target_env, create_missing_dirs=self.create_missing_dirs
-            ).iterdir()
-            if x.is_file() and x.suffix == ".jar"
-        ]
+        plugin_path_base = utils.get_plugin_path_base(
+            target_env, create_missing_dirs=self.create_missing_dirs
+        )
+        self.plugin_path_base = plugin_path_base
+        if not self.discover_plugins:
+            return
 
-        for jar_path in jar_paths:
-            plugin_name = utils.get_plugin_name_from_jar(jar_path)
+        if self.__populate_from_daemon(target_env):
+            scanned_config_mapping = dict(self.plugin_config_mapping)
+        else:
+            scanned_config_mapping = self.__scan_plugin_data(
+                target_env, plugin_path_base
+            )
+            if scanned_config_mapping is None:
+                return
 
-            if self.plugins_whitelist and plugin_name not in self.plugins_whitelist:
-                continue
-            elif self.plugins_blacklist and plugin_name in self.plugins_blacklist:
-                continue
+        if self.file_index is not None:
+            with run_stats.phase("index_refresh"):
+                hashed = self.file_index.refresh(
+                    scanned_config_mapping,
+                    plugin_path_base,
+                    complete=not self.plugins_whitelist and not self.plugins_blacklist,
+                    map_func=self.__map,
+                )
+            self.logger.debug(f"File index refreshed - {hashed} files (re)hashed")
 
-            self.plugin_names.add(plugin_name)
-            self.plugin_jar_mapping[plugin_name] = jar_path
+    def get_server_dir_rules(self) -> utils.DirRules:
+        """
+        server.configs' paths_to_ignore and suffixes_override, compiled on first use. The plugins
+        dir is always ignored since populate_plugin_data covers it.
+        """
+        if self.server_dir_rules is None:
+            servercfg = self.config.server.configs
+            self.server_dir_rules = utils.compile_dir_rules(
+                [
+                    self.config.plugins.relpath_from_env_root,
+                    *[str(path) for path in servercfg.paths_to_ignore],
+                ],
+                (
+                    servercfg.suffixes_override
+                    if "suffixes_override" in servercfg
+                    else None
+                ),
+            )
+        return self.server_dir_rules
+
+    def get_server_config_files(
+        self, server_path_base: Path
+    ) -> Tuple[List[Path], DiscardSummary]:
+        discarded = DiscardSummary(keep_paths=self.list_discarded)
+        if not server_path_base.is_dir():
+            # server/ in the VCS repo, before anything has been copied into it.
+            return [], discarded
+        server_config_files, _ = utils.find_all_files_with_exts(
+            base_path=server_path_base,
+            extensions=set(self.config.server.configs.suffixes),
+            paths_to_ignore=[],
+            suffixes_override=None,
+            discarded=discarded,
+            rules=self.get_server_dir_rules(),
+        )
+        return server_config_files, discarded
+
+    def populate_server_data(self, target_env: Environment) -> None:
+        """
+        Finds the server's own configs - server.properties, bukkit.yml, paper configs, per world
+        configs and so on - under the env folder, by the server.configs rules.
+
+        This is the same walk as for plugin dirs, over the env folder minus the plugins dir, so
+        together with populate_plugin_data each dir of the env is listed at most once. Ignored
+        dirs, such as world region folders, are never descended into.
+        """
+        self.server_path_base = utils.get_server_path_base(
+            target_env, create_missing_dirs=self.create_missing_dirs
+        )
+        with run_stats.phase("server_scan"):
+            (
+                self.server_config_files,
+                self.server_discarded,
+            ) = self.get_server_config_files(self.server_path_base)
+
+    def __scan_plugin_data(
+        self, target_env: Environment, plugin_path_base: Path
+    ) -> Optional[Dict[PluginName, List[PluginConfigFile]]]:
+        """
+        Identifies jars and walks plugin dirs, returning the config files found. Returns None
+        without walking if discover_files is unset.
+        """
+        if not plugin_path_base.is_dir():
+            # Only the VCS repo can be missing plugins/, before anything has been synced into it.
+            return {} if self.discover_files else None
+
+        with run_stats.phase("jar_identify"):
+            with os.scandir(plugin_path_base) as it:
+                jar_entries = [
+                    entry
+                    for entry in it
+                    if entry.is_file() and entry.name.endswith(".jar")
+                ]
+            run_stats.add("jars_identified", len(jar_entries))
+
+            def identify_jar(
+                jar_entry: os.DirEntry,
+            ) -> Tuple[PluginJar, PluginMetadata]:
+                jar_path = Path(jar_entry.path)
+                metadata = (
+                    self.jar_cache.get_metadata(jar_path, jar_entry.stat())
+                    if self.jar_cache is not None
+                    else utils.get_plugin_metadata_from_jar(jar_path)
+                )
+                return jar_path, metadata
+
+            for jar_path, metadata in self.__map(identify_jar, jar_entries):
+                plugin_name = metadata.name
+
+                if self.plugins_whitelist and plugin_name not in self.plugins_whitelist:
+                    continue
+                elif self.plugins_blacklist and plugin_name in self.plugins_blacklist:
+                    continue
+
+                self.plugin_names.add(plugin_name)
+                self.plugin_jar_mapping[plugin_name] = jar_path
+                self.plugin_metadata_mapping[plugin_name] = metadata
+
+            if self.jar_cache is not None:
+                self.logger.debug(
+                    f"Jar cache: {self.jar_cache.hits} hits, {self.jar_cache.misses} misses"
+                )
+                self.jar_cache.save()
 
         # Directories (if created by plugin)
-        plugin_dirs = [
-            x
-            for x in utils.get_plugin_path_base(
-                target_env, create_missing_dirs=self.create_missing_dirs
-            ).iterdir()
-            if x.is_dir() and x.name not in self.config.plugins.folders_to_ignore
-        ]
+        with run_stats.phase("scan"):
+            plugin_dirs = [
+                x
+                for x in plugin_path_base.iterdir()
+                if x.is_dir() and not self.folders_to_ignore.matches(x.name)
+            ]
 
-        for plugin_dir in plugin_dirs:
-            plugin_name = plugin_dir.name
+            for plugin_dir in plugin_dirs:
+                plugin_name = plugin_dir.name
 
+                if self.plugins_whitelist and plugin_name not in self.plugins_whitelist:
+                    continue
+                elif self.plugins_blacklist and plugin_name in self.plugins_blacklist:
+                    continue
+
+                if plugin_name not in self.plugin_names and target_env.value == VCS_ENV:
+                    # The VCS repo only tracks configs, so plugins are identified by folder name.
+                    self.plugin_names.add(plugin_name)
+                elif plugin_name not in self.plugin_names:
+                    raise UnidentifiablePluginDirException(
+                        f"Could not find a plugin to associate with the directory '{plugin_dir}'. Does the .jar file for this plugin exist?"
+                    )
+
+                self.plugin_dir_mapping[plugin_name] = plugin_dir
+
+            if not self.discover_files:
+                return None
+
+            # Config files - if a directory exists.
+            dir_items = list(self.plugin_dir_mapping.items())
+            results = self.__map(
+                lambda item: self.get_config_files_from_plugin_dir(*item), dir_items
+            )
+            scanned_config_mapping = {}
+            for (plugin_name, _), (files, discarded) in zip(dir_items, results):
+                self.plugin_config_mapping[plugin_name] = files
+                self.plugin_discarded_mapping[plugin_name] = discarded
+                scanned_config_mapping[plugin_name] = files
+
+        return scanned_config_mapping
+
+    def __populate_from_daemon(self, target_env: Environment) -> bool:
+        """
+        Loads the mappings from a running daemon. Returns False if there is none, or if this
+        instance needs something the daemon doesn't keep.
+        """
+        if (
+            not self.use_daemon
+            or not self.discover_files
+            or self.list_discarded
+            or target_env.value == VCS_ENV
+        ):
+            return False
+
+        with run_stats.phase("daemon_fetch"):
+            client = DaemonClient(get_daemon_socket_path(self.config))
+            state = client.get_env_state(target_env)
+            if state is None:
+                return False
+            try:
+                self.load_state(state)
+            except DaemonException as e:
+                self.logger.warning(f"Ignoring the daemon's {target_env} data: {e}")
+                return False
+        self.logger.debug(f"Loaded {target_env} plugin data from the daemon")
+        return True
+
+    def dump_state(self) -> Dict:
+        """
+        The plugin mappings as JSON serializable data, for handing a scan to another process.
+        """
+        return {
+            "plugin_path_base": str(self.plugin_path_base),
+            "plugins": {
+                plugin_name: {
+                    "jar": (
+                        str(self.plugin_jar_mapping[plugin_name])
+                        if plugin_name in self.plugin_jar_mapping
+                        else None
+                    ),
+                    "metadata": (
+                        asdict(self.plugin_metadata_mapping[plugin_name])
+                        if plugin_name in self.plugin_metadata_mapping
+                        else None
+                    ),
+                    "folder": (
+                        str(self.plugin_dir_mapping[plugin_name])
+                        if plugin_name in self.plugin_dir_mapping
+                        else None
+                    ),
+                    "config_files": [
+                        str(path)
+                        for path in self.plugin_config_mapping.get(plugin_name, [])
+                    ],
+                    "discarded": (
+                        self.plugin_discarded_mapping[plugin_name].as_dict()
+                        if plugin_name in self.plugin_discarded_mapping
+                        else None
+                    ),
+                }
+                for plugin_name in self.plugin_names
+            },
+        }
+
+    @staticmethod
+    def __validate_state(state: Dict, plugin_path_base: Path) -> None:
+        """
+        Raises DaemonException unless every path in state is where a scan of plugin_path_base
+        could have found it. The state is used as root, so a plugin name like '../..' must never
+        point copies or deletes outside the plugins dir.
+        """
+
+        def normalize(path: str) -> Path:
+            # Lexically, so '..' can't climb out. Symlinks are the daemon user's own.
+            return Path(os.path.normpath(path))
+
+        base = normalize(str(plugin_path_base))
+        try:
+            if normalize(state["plugin_path_base"]) != base:
+                raise DaemonException(
+                    f"Plugins dir {state['plugin_path_base']} is not {plugin_path_base}"
+                )
+            for plugin_name, plugin in state["plugins"].items():
+                if (
+                    not isinstance(plugin_name, str)
+                    or plugin_name in ("", ".", "..")
+                    or Path(plugin_name).name != plugin_name
+                ):
+                    raise DaemonException(f"Invalid plugin name {plugin_name!r}")
+
+                plugin_dir = base / plugin_name
+                jar = plugin["jar"]
+                if jar is not None and normalize(jar).parent != base:
+                    raise DaemonException(f"Jar {jar} is not in {plugin_path_base}")
+                folder = plugin["folder"]
+                if folder is not None and normalize(folder) != plugin_dir:
+                    raise DaemonException(f"Folder {folder} is not {plugin_dir}")
+                for path in plugin["config_files"]:
+                    normalized = normalize(path)
+                    if normalized == plugin_dir or not normalized.is_relative_to(
+                        plugin_dir
+                    ):
+                        raise DaemonException(
+                            f"Config file {path} is not under {plugin_dir}"
+                        )
+        except (KeyError, TypeError, AttributeError) as e:
+            raise DaemonException(f"Malformed state: {e!r}")
+
+    def load_state(self, state: Dict) -> None:
+        """
+        Inverse of dump_state. The whitelist and blacklist are applied while loading.
+
+        Raises DaemonException without loading anything if state has paths outside this
+        instance's plugins dir.
+        """
+        self.__validate_state(state, self.plugin_path_base)
+        for plugin_name, plugin in state["plugins"].items():
             if self.plugins_whitelist and plugin_name not in self.plugins_whitelist:
                 continue
             elif self.plugins_blacklist and plugin_name in self.plugins_blacklist:
                 continue
 
-            if plugin_name not in self.plugin_names:
-                raise UnidentifiablePluginDirException(
-                    f"Could not find a plugin to associate with the directory '{plugin_dir}'. Does the .jar file for this plugin exist?"
+            self.plugin_names.add(plugin_name)
+            if plugin["jar"] is not None:
+                self.plugin_jar_mapping[plugin_name] = Path(plugin["jar"])
+            if plugin["metadata"] is not None:
+                self.plugin_metadata_mapping[plugin_name] = PluginMetadata(
+                    **plugin["metadata"]
                 )
+            if plugin["folder"] is not None:
+                self.plugin_dir_mapping[plugin_name] = Path(plugin["folder"])
+                self.plugin_config_mapping[plugin_name] = [
+                    Path(path) for path in plugin["config_files"]
+                ]
+            if plugin["discarded"] is not None:
+                self.plugin_discarded_mapping[plugin_name] = DiscardSummary.from_dict(
+                    plugin["discarded"]
+                )
+
+    def open_file_index(self, env: Environment) -> Optional[EnvIndex]:
+        """
+        The index is only an optimization for most commands, so failing to open it - eg, running
+        as a user without write access to the base path - only disables it.
+        """
+        index_path = get_env_index_path(self.base_path, env)
+        try:
+            return EnvIndex(index_path)
+        except (OSError, sqlite3.Error) as e:
+            self.logger.warning(f"Could not open file index at {index_path}: {e}")
+            return None
+
+    def close(self) -> None:
+        if self.file_index is not None:
+            self.file_index.close()
+            self.file_index = None
+
+    def __map(self, func: Callable, items: List) -> List:
+        """
+        Maps func over items on a thread pool of self.jobs workers, or serially if jobs is 1.
+
+        Results are returned in the order of items regardless of completion order so discovery
+        stays deterministic. If any call raises, the exception of the earliest item is re-raised.
+        """
+        if self.jobs <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            return list(executor.map(func, items))
+
+    def iter_plugin_files(
+        self, plugin_name: PluginName, discarded: Optional[DiscardSummary] = None
+    ) -> Iterator[Tuple[Path, bool]]:
+        """
+        Streams (path, is_config) for every file in the plugin's dir as the walk finds it, without
+        recording anything in the mappings. Non-configs are rolled up into discarded if given.
+        """
+        if plugin_name not in self.plugin_dir_mapping:
+            return iter(())
+
+        return utils.iter_files_with_exts(
+            base_path=self.plugin_dir_mapping[plugin_name],
+            extensions=self.config_suffixes,
+            paths_to_ignore=[],
+            suffixes_override=None,
+            rules=self.get_dir_rules(plugin_name),
+            discarded=discarded,
+        )
+
+    def __get_plugin_record(self, plugin_name: PluginName) -> Dict:
+        metadata = self.plugin_metadata_mapping.get(plugin_name)
+        jar = self.plugin_jar_mapping.get(plugin_name)
+        folder = self.plugin_dir_mapping.get(plugin_name)
+        return {
+            "type": "plugin",
+            "env": self.target_env.value,
+            "name": plugin_name,
+            "version": metadata.version if metadata is not None else None,
+            "jar": str(jar) if jar is not None else None,
+            "folder": str(folder) if folder is not None else None,
+        }
+
+    def stream_plugin_data(
+        self,
+        out: TextIO = sys.stdout,
+        per_file: bool = False,
+        list_discarded: bool = False,
+    ) -> None:
+        """
+        Writes plugin data as JSON lines, flushing each record as soon as it's discovered.
 
-            self.plugin_dir_mapping[plugin_name] = plugin_dir
+        By default there's one "plugin" record per plugin, including its config files and a
+        per-directory summary of discarded files. With per_file, the "plugin" record is written
+        before its dir is walked and followed by a "config_file" record per file and a
+        "discarded_summary".
 
-        # Config files - if a directory exists.
-        for plugin_name, plugin_dir_path in self.plugin_dir_mapping.items():
-            files, ignored_files_and_dirs = self.get_config_files_from_plugin_dir(
-                plugin_name, plugin_dir_path
+        Discarded files are only summarized unless list_discarded is set, in which case they're
+        listed too - as a "discarded" record each with per_file.
+        """
+
+        def write(record: Dict) -> None:
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+
+        def walk_plugin(plugin_name: PluginName) -> Dict:
+            record = self.__get_plugin_record(plugin_name)
+            record["config_files"] = []
+            discarded = DiscardSummary(keep_paths=list_discarded)
+            for path, is_config in self.iter_plugin_files(plugin_name, discarded):
+                if is_config:
+                    record["config_files"].append(str(path))
+            record["discarded"] = discarded.as_dict()
+            return record
+
+        plugin_names = sorted(self.plugin_names)
+        if not per_file:
+            if self.jobs <= 1:
+                for plugin_name in plugin_names:
+                    write(walk_plugin(plugin_name))
+                return
+
+            # Plugins are walked ahead in the pool, but written in order as each finishes.
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                for record in executor.map(walk_plugin, plugin_names):
+                    write(record)
+            return
+
+        for plugin_name in plugin_names:
+            write(self.__get_plugin_record(plugin_name))
+            discarded = DiscardSummary()
+            for path, is_config in self.iter_plugin_files(plugin_name, discarded):
+                if is_config:
+                    write(
+                        {
+                            "type": "config_file",
+                            "plugin": plugin_name,
+                            "path": str(path),
+                        }
+                    )
+                elif list_discarded:
+                    write(
+                        {"type": "discarded", "plugin": plugin_name, "path": str(path)}
+                    )
+            write(
+                {
+                    "type": "discarded_summary",
+                    "plugin": plugin_name,
+                    **discarded.as_dict(),
+                }
             )
-            self.plugin_config_mapping[plugin_name] = files
-            self.discarded_files.update(ignored_files_and_dirs)
 
     def print_plugin_data(self) -> None:
         self.logger.info(
             f"Printing plugin data for environment: '{self.target_env.value}'"
         )
 
-        self.logger.debug("")
-        self.logger.debug("")
-        for file in self.discarded_files:
-            self.logger.debug(f"Discarded file: {file}")
-
         self.logger.info("")
         self.logger.info("")
 
         for plugin in sorted(list(self.plugin_names)):
             self.logger.info("")
             self.logger.info(f"Plugin: {plugin}")
-            self.logger.info(f"Jar: {self.plugin_jar_mapping[plugin]}")
+            if plugin in self.plugin_jar_mapping:
+                self.logger.info(f"Jar: {self.plugin_jar_mapping[plugin]}")
+            else:
+                self.logger.info("!! Jar: No jar was found for this plugin")
 
             if plugin in self.plugin_dir_mapping:
                 self.logger.info(f"Folder: {self.plugin_dir_mapping[plugin]}")
@@ -196,58 +756,732 @@ class Patchouli:
                 for file in self.plugin_data_mapping[plugin]:
                     self.logger.info(f"- DataFile: {file}")
 
+            discarded = self.plugin_discarded_mapping.get(plugin)
+            if discarded:
+                summary, *rollups = discarded.format_lines()
+                self.logger.info(f"- {summary}")
+                for line in rollups:
+                    self.logger.info(f"    {line}")
+                for file in discarded.paths:
+                    self.logger.info(f"    - DiscardedFile: {file}")
+
+    def log_discarded_summary(self) -> None:
+        """
+        Logs the total of discarded files across all plugins, with the per-directory rollups at
+        debug level. Every discarded file is logged too if list_discarded was set.
+        """
+        total = DiscardSummary(keep_paths=self.list_discarded)
+        for discarded in self.plugin_discarded_mapping.values():
+            total.update(discarded)
+        if not total:
+            return
+
+        summary, *rollups = total.format_lines()
+        self.logger.info(f"{summary} - These are not copied.")
+        for line in rollups:
+            self.logger.debug(line)
+        for file in total.paths:
+            self.logger.info(f"Discarded file: {file}")
+
+    def print_status(self, mark_synced: bool = False) -> None:
+        if self.file_index is None:
+            self.logger.error(
+                f"No file index is available for '{self.target_env.value}' - Cannot show status."
+            )
+            return
+
+        last_synced = self.file_index.get_last_synced()
+        if last_synced is None:
+            self.logger.info(
+                f"Environment '{self.target_env.value}' has never been synced. All files are listed as added."
+            )
+        else:
+            self.logger.info(
+                f"Changes in environment '{self.target_env.value}' since last sync at {time.ctime(last_synced)}:"
+            )
+
+        changes = self.file_index.get_changes_since_sync(
+            self.plugin_config_mapping.keys()
+        )
+        for plugin_name, plugin_changes in changes.items():
+            self.logger.info("")
+            self.logger.info(f"Plugin: {plugin_name}")
+            for relpath in plugin_changes.added:
+                self.logger.info(f"  added:    {relpath}")
+            for relpath in plugin_changes.removed:
+                self.logger.info(f"  removed:  {relpath}")
+            for relpath in plugin_changes.modified:
+                self.logger.info(f"  modified: {relpath}")
+
+        if not changes:
+            self.logger.info("No changes.")
+
+        if mark_synced:
+            self.file_index.mark_synced(
+                self.plugin_config_mapping.keys()
+                if self.plugins_whitelist or self.plugins_blacklist
+                else None
+            )
+            self.logger.info("Marked current state as synced.")
+
     def sync_vcs_with_env(
-        self, src_env: Optional[Environment], dest_env: Optional[Environment]
-    ):
+        self,
+        src_env: Optional[Environment],
+        dest_env: Optional[Environment],
+        overwrite: bool = False,
+    ) -> Optional[str]:
         """
         Direction can go either way, vcs -> env or env -> vcs.
         Direction is defined by src_env and dest_env inputs. Direction should be handled by git-patchy
 
-        One of the src_env or dest_env must be mytypes.Environments.VCS
+        One of the src_env or dest_env must be mytypes.Environments.VCS, and the other must be the
+        target_env this class was initialized with.
+
+        env -> vcs records the env's configs as a commit on refs/patchy/envs/<env>, then merges that
+        commit into the repo's current branch with a merge commit. If overwrite is set, the env's
+        configs replace the repo's instead of being merged. Returns the new commit, if any.
         """
+        is_dest_vcs = self.__is_dest_vcs(src_env, dest_env)
+
+        repo = GitRepo(utils.get_vcs_repo_path())
+        with run_stats.phase("vcs_sync"):
+            if is_dest_vcs:
+                return self.__sync_env_to_vcs(repo, overwrite)
+
+            self.__record_copy_stats(self.__sync_vcs_to_env(repo))
+        return None
+
+    def sync_server_with_vcs(
+        self,
+        src_env: Optional[Environment],
+        dest_env: Optional[Environment],
+        overwrite: bool = False,
+    ) -> Optional[str]:
+        """
+        Like sync_vcs_with_env, but for the server configs found by populate_server_data, which
+        are kept under server/ in the repo. The env's snapshots are recorded on
+        refs/patchy/server/<env>, apart from its plugin config snapshots.
+        """
+        if self.server_path_base is None:
+            raise InvalidConfigurationException(
+                "Server configs were not discovered - Initialize with discover_server_configs"
+            )
+        is_dest_vcs = self.__is_dest_vcs(src_env, dest_env)
+
+        repo = GitRepo(utils.get_vcs_repo_path())
+        with run_stats.phase("vcs_sync"):
+            if is_dest_vcs:
+                self.logger.info(
+                    f"Syncing {self.target_env} server configs => VCS repo at {repo.path}"
+                )
+                return self.__commit_to_vcs(
+                    repo,
+                    self.server_config_files,
+                    [
+                        f"server/{file_path.relative_to(self.server_path_base).as_posix()}"
+                        for file_path in self.server_config_files
+                    ],
+                    env_ref=f"refs/patchy/server/{self.target_env.value}",
+                    replace_prefixes=["server/"],
+                    is_partial=False,
+                    kind="server configs",
+                    overwrite=overwrite,
+                )
+
+            self.__record_copy_stats(self.__sync_server_vcs_to_env(repo))
+        return None
+
+    def __is_dest_vcs(
+        self, src_env: Optional[Environment], dest_env: Optional[Environment]
+    ) -> bool:
+        """
+        Checks that exactly one of src_env and dest_env is VCS and the other this instance's
+        target_env, defaulting either to target_env. Returns whether VCS is the dest.
+        """
+        src_env = src_env if src_env is not None else self.target_env
+        dest_env = dest_env if dest_env is not None else self.target_env
+
+        is_src_vcs = src_env.value == VCS_ENV
+        is_dest_vcs = dest_env.value == VCS_ENV
+        if is_src_vcs == is_dest_vcs:
+            raise InvalidEnvironmentException(
+                f"Exactly one of src_env:{src_env} and dest_env:{dest_env} must be the VCS env"
+            )
+
+        env = dest_env if is_src_vcs else src_env
+        if env != self.target_env:
+            raise InvalidEnvironmentException(
+                f"Cannot sync {env} with VCS from a Patchouli initialized for {self.target_env}"
+            )
+        return is_dest_vcs
+
+    def __get_vcs_path(self, plugin_name: PluginName, file_path: Path) -> str:
+        relpath = file_path.relative_to(self.plugin_path_base / plugin_name)
+        return f"plugins/{plugin_name}/{relpath.as_posix()}"
+
+    def __sync_env_to_vcs(self, repo: GitRepo, overwrite: bool) -> Optional[str]:
+        self.logger.info(f"Syncing {self.target_env} => VCS repo at {repo.path}")
+
+        files = []
+        vcs_paths = []
+        for plugin_name, plugin_files in self.plugin_config_mapping.items():
+            for file_path in plugin_files:
+                files.append(file_path)
+                vcs_paths.append(self.__get_vcs_path(plugin_name, file_path))
+
+        merge_commit = self.__commit_to_vcs(
+            repo,
+            files,
+            vcs_paths,
+            env_ref=f"refs/patchy/envs/{self.target_env.value}",
+            replace_prefixes=[
+                f"plugins/{plugin_name}/" for plugin_name in self.plugin_config_mapping
+            ],
+            is_partial=bool(self.plugins_whitelist or self.plugins_blacklist),
+            kind="plugin configs",
+            overwrite=overwrite,
+        )
+        if self.file_index is not None:
+            self.file_index.mark_synced(self.plugin_config_mapping.keys())
+        return merge_commit
+
+    def __commit_to_vcs(
+        self,
+        repo: GitRepo,
+        files: List[Path],
+        vcs_paths: List[str],
+        env_ref: str,
+        replace_prefixes: List[str],
+        is_partial: bool,
+        kind: str,
+        overwrite: bool,
+    ) -> Optional[str]:
+        """
+        Records files at vcs_paths as a commit on env_ref, then merges that commit into the
+        repo's current branch - see sync_vcs_with_env. Returns the new commit, if any.
+        """
+        env_name = self.target_env.value
+
+        # One hash-object process writes every blob.
+        shas = repo.hash_objects(files)
+        entries = {
+            vcs_path: (get_file_mode(os.stat(file_path)), sha)
+            for vcs_path, file_path, sha in zip(vcs_paths, files, shas)
+        }
+
+        # Snapshot of the env's configs. A partial scan (whitelist/blacklist) only replaces the
+        # scanned prefixes in the previous snapshot.
+        prev_env_commit = repo.rev_parse(env_ref)
+        env_tree = repo.build_tree(
+            entries,
+            base=prev_env_commit if is_partial else None,
+            replace_prefixes=replace_prefixes,
+        )
+
+        if prev_env_commit is not None and repo.get_tree(prev_env_commit) == env_tree:
+            env_commit = prev_env_commit
+        else:
+            env_commit = repo.commit_tree(
+                env_tree,
+                [prev_env_commit] if prev_env_commit is not None else [],
+                f"Snapshot of '{env_name}' {kind}",
+            )
+            repo.update_ref(env_ref, env_commit)
+
+        head = repo.rev_parse("HEAD")
+        if head is None:
+            merged_tree = env_tree
+        elif overwrite:
+            merged_tree = repo.build_tree(
+                entries, base=head, replace_prefixes=replace_prefixes
+            )
+        else:
+            merged_tree, conflicts = repo.merge_tree(head, env_commit)
+            if conflicts:
+                raise VcsException(
+                    f"Merging '{env_name}' {kind} into VCS conflicted on: {', '.join(conflicts)}. "
+                    "Resolve the conflicts in the env or VCS, or sync with overwrite to replace the VCS configs."
+                )
+
+            if merged_tree == repo.get_tree(head):
+                self.logger.info("VCS is already up to date.")
+                return None
+
+        merge_commit = repo.commit_tree(
+            merged_tree,
+            [head, env_commit] if head is not None else [env_commit],
+            f"Merge '{env_name}' {kind} into VCS",
+        )
+
+        # Fast-forwarding onto the merge commit also updates the worktree, and refuses to clobber
+        # uncommitted changes.
+        if head is None:
+            repo.update_ref("HEAD", merge_commit)
+            repo.run("read-tree", "-u", "--reset", "HEAD")
+        else:
+            repo.run("merge", "--ff-only", "-q", merge_commit)
+
+        self.logger.info(
+            f"Created merge commit {merge_commit} with {len(entries)} configs"
+        )
+        return merge_commit
+
+    @utils.ensure_root
+    def __sync_vcs_to_env(self, repo: GitRepo) -> CopyStats:
+        self.logger.info(f"Syncing VCS repo at {repo.path} => {self.target_env}")
+
+        # One ls-tree lists every config in VCS.
+        to_write = []
+        for mode, sha, vcs_path in repo.ls_tree("HEAD", "plugins/"):
+            parts = Path(vcs_path).parts
+            if len(parts) < 3:
+                continue
+            plugin_name = parts[1]
+            if self.plugins_whitelist and plugin_name not in self.plugins_whitelist:
+                continue
+            elif self.plugins_blacklist and plugin_name in self.plugins_blacklist:
+                continue
+            to_write.append(
+                (plugin_name, mode, sha, self.plugin_path_base / Path(*parts[1:]))
+            )
+
+        stats = self.__write_from_vcs(repo, to_write)
+
+        if self.file_index is not None:
+            plugin_names = list(dict.fromkeys(item[0] for item in to_write))
+            self.file_index.refresh(
+                self.scan_config_files(plugin_names, self.plugin_path_base),
+                self.plugin_path_base,
+                complete=False,
+                map_func=self.__map,
+            )
+            self.file_index.mark_synced(plugin_names)
+
+        return stats
 
     @utils.ensure_root
-    def copy_plugin_data(self, dest_env: Optional[Environment]):
+    def __sync_server_vcs_to_env(self, repo: GitRepo) -> CopyStats:
+        self.logger.info(
+            f"Syncing VCS repo at {repo.path} => {self.target_env} server configs"
+        )
+        server_path_base = utils.get_server_path_base(self.target_env)
+
+        to_write = []
+        for mode, sha, vcs_path in repo.ls_tree("HEAD", "server/"):
+            rel_path = Path(*Path(vcs_path).parts[1:])
+            to_write.append(
+                (
+                    self.__get_server_group(rel_path),
+                    mode,
+                    sha,
+                    server_path_base / rel_path,
+                )
+            )
+
+        return self.__write_from_vcs(repo, to_write)
+
+    def __write_from_vcs(
+        self, repo: GitRepo, to_write: List[Tuple[str, str, str, Path]]
+    ) -> CopyStats:
         """
-        The src_env is understood to be the target_env the class was initialized with.
+        Writes each (plugin name or server config group, mode, blob sha, dest path) of to_write,
+        skipping dest files that already have the blob's contents.
+        """
+        user, group = self.config.mc_data_user, self.config.mc_data_group
+        copier = FileCopier(*utils.get_uid_gid(user, group))
+        stats = copier.stats
+
+        # Files that already match are found with a single hash-object over the existing dest files.
+        existing = [item for item in to_write if item[3].exists()]
+        existing_shas = repo.hash_objects([item[3] for item in existing], write=False)
+        unchanged = {
+            item[3] for item, sha in zip(existing, existing_shas) if item[2] == sha
+        }
+        stats.skipped = len(unchanged)
+        changed = [item for item in to_write if item[3] not in unchanged]
+
+        copier.ensure_dirs({item[3].parent for item in changed})
+        # One cat-file process streams every changed blob.
+        blobs = repo.cat_blobs([item[2] for item in changed])
+        for (_, mode, sha, dest_path), (_, data) in zip(changed, blobs):
+            copier.write_file(dest_path, data, int(mode[-3:], 8))
+            self.logger.debug(f"{sha} => {dest_path}")
+
+        self.logger.info(f"Copy summary: {stats}")
+        return stats
+
+    def plan_copy(
+        self,
+        dest_envs: Union[None, Environment, List[Environment]],
+        incremental: Optional[bool] = None,
+        delete_stale: bool = False,
+        dry_run: bool = False,
+    ) -> List[CopyPlan]:
+        """
+        Decides what copy_plugin_data will do in each dest env, without copying anything.
+
+        If incremental, dest files with the same contents as the source are planned as skipped,
+        otherwise every file is rewritten. If delete_stale, config files in dest that the source
+        doesn't have are planned for deletion - only plugins being copied are looked at, and only
+        files this env's rules would count as configs.
+
+        A dry run never prompts to create missing dest dirs, and leaves the mtimes of files found
+        identical by hash alone.
+        """
+        if dest_envs is None:
+            dest_envs = [Environment(self.config.default_copy_to_env)]
+        elif not isinstance(dest_envs, list):
+            dest_envs = [dest_envs]
+        incremental = (
+            incremental
+            if incremental is not None
+            else self.config.default_incremental_copy
+        )
+
+        plans = []
+        for dest_env in dest_envs:
+            if dest_env == self.target_env:
+                raise InvalidEnvironmentException(
+                    f"Cannot copy {self.target_env} onto itself"
+                )
+            if not dry_run:
+                utils.ensure_valid_env(
+                    dest_env,
+                    create_missing_dirs=True,
+                )
+            dest_path_base = utils.get_plugin_path_base(
+                dest_env, create_missing_dirs=self.create_missing_dirs and not dry_run
+            )
+            plans.append(CopyPlan(dest_env, dest_path_base))
+
+        src_files = [
+            (plugin_name, file_path, os.stat(file_path))
+            for plugin_name, files in self.plugin_config_mapping.items()
+            for file_path in files
+        ]
+        run_stats.add("entries_stated", len(src_files))
+
+        with run_stats.phase("plan"):
+            for plan in plans:
+                items = [
+                    (
+                        plugin_name,
+                        file_path,
+                        file_stat,
+                        plan.dest_path_base
+                        / plugin_name
+                        / file_path.relative_to(self.plugin_path_base / plugin_name),
+                    )
+                    for plugin_name, file_path, file_stat in src_files
+                ]
+                plan.files = self.__map(
+                    lambda item: self.__plan_file(item, incremental, dry_run), items
+                )
+                if delete_stale:
+                    for stale in self.__map(
+                        lambda plugin_name: self.__plan_stale(plan, plugin_name),
+                        list(self.plugin_config_mapping),
+                    ):
+                        plan.files.extend(stale)
+
+        return plans
+
+    @staticmethod
+    def __plan_file(
+        item: Tuple[PluginName, Path, os.stat_result, Path],
+        incremental: bool,
+        dry_run: bool,
+    ) -> PlannedFile:
+        """
+        item is (plugin name or server config group, src path, src stat, dest path).
         """
-        dest_env = (
-            dest_env
-            if dest_env is not None
-            else Environment(self.config.default_copy_to_env)
+        plugin_name, src_path, src_stat, dest_path = item
+
+        run_stats.add("entries_stated")
+        try:
+            dest_stat = os.stat(dest_path)
+        except FileNotFoundError:
+            action = CopyAction.CREATE
+        else:
+            if incremental and is_unchanged(
+                src_path, dest_path, src_stat, dest_stat, sync_mtime=not dry_run
+            ):
+                return PlannedFile(
+                    CopyAction.SKIP,
+                    plugin_name,
+                    dest_path,
+                    dest_stat.st_size,
+                    src_path,
+                    src_stat,
+                )
+            action = CopyAction.UPDATE
+
+        return PlannedFile(
+            action, plugin_name, dest_path, src_stat.st_size, src_path, src_stat
         )
-        utils.ensure_valid_env(
-            dest_env,
-            create_missing_dirs=True,
+
+    def __plan_stale(
+        self, plan: CopyPlan, plugin_name: PluginName
+    ) -> List[PlannedFile]:
+        dest_dir = plan.dest_path_base / plugin_name
+        if not dest_dir.is_dir():
+            return []
+
+        src_dir = self.plugin_path_base / plugin_name
+        src_rel_paths = {
+            file_path.relative_to(src_dir)
+            for file_path in self.plugin_config_mapping[plugin_name]
+        }
+        dest_files, _ = self.get_config_files_from_plugin_dir(plugin_name, dest_dir)
+        return [
+            PlannedFile(
+                CopyAction.DELETE, plugin_name, dest_path, os.stat(dest_path).st_size
+            )
+            for dest_path in dest_files
+            if dest_path.relative_to(dest_dir) not in src_rel_paths
+        ]
+
+    def plan_server_copy(
+        self,
+        dest_env: Environment,
+        incremental: Optional[bool] = None,
+        delete_stale: bool = False,
+        dry_run: bool = False,
+    ) -> CopyPlan:
+        """
+        Like plan_copy, but for the server configs found by populate_server_data. Files are grouped
+        by their top dir under the env folder in the plan, or "." if directly in it.
+
+        Neither env may be VCS - see sync_server_with_vcs.
+        """
+        if self.server_path_base is None:
+            raise InvalidConfigurationException(
+                "Server configs were not discovered - Initialize with discover_server_configs"
+            )
+        if VCS_ENV in (self.target_env.value, dest_env.value):
+            raise InvalidEnvironmentException(
+                "Server configs are synced with VCS through sync_server_with_vcs"
+            )
+        if dest_env == self.target_env:
+            raise InvalidEnvironmentException(
+                f"Cannot copy {self.target_env} onto itself"
+            )
+        incremental = (
+            incremental
+            if incremental is not None
+            else self.config.default_incremental_copy
         )
 
-        dest_path_base = utils.get_plugin_path_base(
-            dest_env, create_missing_dirs=self.create_missing_dirs
+        if not dry_run:
+            utils.ensure_valid_env(
+                dest_env,
+                create_missing_dirs=True,
+            )
+        dest_path_base = utils.get_server_path_base(
+            dest_env, create_missing_dirs=self.create_missing_dirs and not dry_run
         )
+        plan = CopyPlan(dest_env, dest_path_base)
+
+        items = []
+        src_rel_paths = set()
+        for file_path in self.server_config_files:
+            rel_path = file_path.relative_to(self.server_path_base)
+            src_rel_paths.add(rel_path)
+            items.append(
+                (
+                    self.__get_server_group(rel_path),
+                    file_path,
+                    os.stat(file_path),
+                    dest_path_base / rel_path,
+                )
+            )
+        run_stats.add("entries_stated", len(items))
 
-        self.logger.info(f"Starting copy from {self.target_env} => {dest_env}")
+        with run_stats.phase("plan"):
+            plan.files = self.__map(
+                lambda item: self.__plan_file(item, incremental, dry_run), items
+            )
+            if delete_stale:
+                dest_files, _ = self.get_server_config_files(dest_path_base)
+                for dest_path in dest_files:
+                    rel_path = dest_path.relative_to(dest_path_base)
+                    if rel_path not in src_rel_paths:
+                        plan.files.append(
+                            PlannedFile(
+                                CopyAction.DELETE,
+                                self.__get_server_group(rel_path),
+                                dest_path,
+                                os.stat(dest_path).st_size,
+                            )
+                        )
+
+        return plan
 
-        for plugin_name in self.plugin_config_mapping:
-            for file_path in self.plugin_config_mapping[plugin_name]:
-                dest_path = dest_path_base / plugin_name
-                rel_path = Path(*file_path.parts[len(dest_path.parts) :])
-                dest_path = dest_path / rel_path
+    @staticmethod
+    def __get_server_group(rel_path: Path) -> str:
+        return rel_path.parts[0] if len(rel_path.parts) > 1 else "."
 
-                os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-                shutil.copy(file_path, dest_path)
+    def copy_server_data(
+        self,
+        dest_env: Environment,
+        incremental: Optional[bool] = None,
+        delete_stale: bool = False,
+    ) -> CopyStats:
+        """
+        Copies the server configs to dest_env with the same plan and copy engine as plugin configs.
+        Copies need root, and chown only what they write to mc_data_user:mc_data_group.
+        """
+        copier = self.__get_env_copier()
+        plan = self.plan_server_copy(
+            dest_env, incremental=incremental, delete_stale=delete_stale
+        )
+
+        self.logger.info(
+            f"Starting server config copy from {self.target_env} => {dest_env}"
+        )
+        self.logger.info(f"Copy plan for {plan.format_lines()[0]}")
+        with run_stats.phase("copy"):
+            CopyEngine(jobs=self.jobs).apply([(plan, copier)])
 
-                self.logger.debug(f"{file_path} => {dest_path}")
+        self.logger.info(f"Copy summary for {dest_env}: {copier.stats}")
+        self.__record_copy_stats(copier.stats)
+        return copier.stats
 
+    @utils.ensure_root
+    def __get_env_copier(self) -> FileCopier:
         user, group = self.config.mc_data_user, self.config.mc_data_group
-        uid, gid = utils.get_uid_gid(user, group)
+        return FileCopier(*utils.get_uid_gid(user, group))
 
+    def print_server_data(self) -> None:
         self.logger.info(
-            f"Recursive chowning dest_env:{dest_env} files to {user}:{group}"
+            f"Printing server configs for environment: '{self.target_env.value}' ({self.server_path_base})"
         )
-        for dirpath, dirnames, filenames in os.walk(dest_path_base):
-            shutil.chown(dirpath, uid, gid)
-            for filename in filenames:
-                self.logger.debug(f"{Path(dirpath) / filename} - {uid}:{gid}")
-                shutil.chown(Path(dirpath) / filename, uid, gid)
+        self.logger.info("")
+        for file in self.server_config_files:
+            self.logger.info(f"- ConfigFile: {file}")
+
+        if self.server_discarded:
+            summary, *rollups = self.server_discarded.format_lines()
+            self.logger.info(f"- {summary}")
+            for line in rollups:
+                self.logger.info(f"    {line}")
+            for file in self.server_discarded.paths:
+                self.logger.info(f"    - DiscardedFile: {file}")
+
+    @utils.ensure_root
+    def copy_plugin_data(
+        self,
+        dest_envs: Union[None, Environment, List[Environment]],
+        incremental: Optional[bool] = None,
+        full_chown: bool = False,
+        include_jars: bool = False,
+        delete_stale: bool = False,
+    ) -> Dict[Environment, CopyStats]:
+        """
+        The src_env is understood to be the target_env the class was initialized with.
+
+        dest_envs may be a single env or a list of envs. Each source file is read once and written
+        to every destination that needs it, so refreshing N envs costs about one pass of source IO.
+
+        What to copy is decided up front by plan_copy - see there for incremental and
+        delete_stale. Only files and dirs the copy creates or modifies are chowned to
+        mc_data_user:mc_data_group, unless full_chown is set in which case the whole destination
+        plugins dir is fixed up.
+
+        If include_jars, each destination's jars are also synced with this env's - see JarSyncer.
+        """
+        plans = self.plan_copy(
+            dest_envs, incremental=incremental, delete_stale=delete_stale
+        )
+
+        self.logger.info(
+            f"Starting copy from {self.target_env} => {', '.join(str(plan.dest_env) for plan in plans)}"
+        )
+        for plan in plans:
+            self.logger.info(f"Copy plan for {plan.format_lines()[0]}")
+
+        user, group = self.config.mc_data_user, self.config.mc_data_group
+        uid, gid = utils.get_uid_gid(user, group)
+        copiers = {plan.dest_env: FileCopier(uid, gid) for plan in plans}
+
+        with run_stats.phase("copy"):
+            CopyEngine(jobs=self.jobs).apply(
+                [(plan, copiers[plan.dest_env]) for plan in plans]
+            )
+
+        if include_jars:
+            src_jars = {
+                plugin_name: (jar_path, self.plugin_metadata_mapping[plugin_name])
+                for plugin_name, jar_path in self.plugin_jar_mapping.items()
+            }
+            for plan in plans:
+                jar_stats = JarSyncer(
+                    self.jar_cache,
+                    FileCopier(uid, gid),
+                    use_hardlinks=self.config.jar_hardlinks,
+                    jobs=self.jobs,
+                ).sync(src_jars, plan.dest_path_base)
+                self.logger.info(f"Jar sync summary for {plan.dest_env}: {jar_stats}")
+
+        all_stats = {}
+        for plan in plans:
+            stats = copiers[plan.dest_env].stats
+            if full_chown:
+                self.logger.info(
+                    f"Recursive chowning dest_env:{plan.dest_env} files to {user}:{group}"
+                )
+                with run_stats.phase("chown"):
+                    stats.chowned += utils.chown_tree(plan.dest_path_base, uid, gid)
+
+            self.logger.info(f"Copy summary for {plan.dest_env}: {stats}")
+            self.__record_copy_stats(stats)
+
+            if self.use_file_index:
+                with run_stats.phase("record_sync"):
+                    self.record_sync(
+                        plan.dest_env,
+                        plan.dest_path_base,
+                        list(self.plugin_config_mapping),
+                    )
+            all_stats[plan.dest_env] = stats
 
         self.logger.info("Copy complete.")
+
+        return all_stats
+
+    @staticmethod
+    def __record_copy_stats(stats: CopyStats) -> None:
+        run_stats.add_many(
+            files_copied=stats.copied,
+            bytes_copied=stats.bytes_copied,
+            copies_avoided=stats.skipped,
+            stale_deleted=stats.deleted,
+            dirs_created=stats.dirs_created,
+            chowned=stats.chowned,
+        )
+
+    def record_sync(
+        self,
+        dest_env: Environment,
+        dest_path_base: Path,
+        plugin_names: List[PluginName],
+    ) -> None:
+        """
+        Marks the synced plugins as in sync in both the src and dest env file indexes. The dest
+        index is refreshed from a scan of the dest plugin dirs, so files only dest has stay in it.
+        """
+        if self.file_index is not None:
+            self.file_index.mark_synced(plugin_names)
+
+        dest_index = self.open_file_index(dest_env)
+        if dest_index is None:
+            return
+
+        dest_index.refresh(
+            self.scan_config_files(plugin_names, dest_path_base),
+            dest_path_base,
+            complete=False,
+            map_func=self.__map,
+        )
+        dest_index.mark_synced(plugin_names)
+        dest_index.close()
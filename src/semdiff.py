@@ -0,0 +1,173 @@
+import re
+import json
+import logging
+import threading
+
+import yaml  # type: ignore
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import src.utils as utils
+from src.instrumentation import run_stats
+
+logger = logging.getLogger(__name__)
+
+# Suffixes that can be diffed by structure, and what they're parsed as.
+STRUCTURED_SUFFIXES = {".yml": "yaml", ".yaml": "yaml", ".json": "json"}
+
+# Keys matching this are joined into key paths with a dot, anything else is quoted in brackets.
+PLAIN_KEY_REGEX = re.compile(r"^[A-Za-z0-9_\-]+$")
+
+# Values longer than this are cut short when printing a change.
+MAX_VALUE_LENGTH = 80
+
+
+class Unparseable:
+    """
+    Cached in place of the tree of a file that failed to parse, so it isn't retried.
+    """
+
+
+UNPARSEABLE = Unparseable()
+
+
+@dataclass
+class KeyChange:
+    # "added", "removed" or "changed"
+    kind: str
+    key_path: str
+    old: Any = None
+    new: Any = None
+
+    def __str__(self) -> str:
+        if self.kind == "added":
+            return f"+ {self.key_path}: {format_value(self.new)}"
+        elif self.kind == "removed":
+            return f"- {self.key_path}: {format_value(self.old)}"
+        return (
+            f"~ {self.key_path}: {format_value(self.old)} -> {format_value(self.new)}"
+        )
+
+
+def is_structured(path: Path) -> bool:
+    return path.suffix in STRUCTURED_SUFFIXES
+
+
+def format_value(value: Any) -> str:
+    text = json.dumps(value, default=str, ensure_ascii=False)
+    if len(text) > MAX_VALUE_LENGTH:
+        return text[: MAX_VALUE_LENGTH - 3] + "..."
+    return text
+
+
+def parse_config(data: bytes, suffix: str) -> Any:
+    if STRUCTURED_SUFFIXES[suffix] == "json":
+        return json.loads(data)
+    return utils.load_yaml(data)
+
+
+def __join_key(key_path: str, key: Any) -> str:
+    if isinstance(key, str) and PLAIN_KEY_REGEX.match(key):
+        return f"{key_path}.{key}" if key_path else key
+    return f"{key_path}[{json.dumps(key, default=str)}]"
+
+
+def __diff_into(old: Any, new: Any, key_path: str, changes: List[KeyChange]) -> None:
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in old:
+            if key not in new:
+                changes.append(
+                    KeyChange("removed", __join_key(key_path, key), old=old[key])
+                )
+            else:
+                __diff_into(old[key], new[key], __join_key(key_path, key), changes)
+        for key in new:
+            if key not in old:
+                changes.append(
+                    KeyChange("added", __join_key(key_path, key), new=new[key])
+                )
+    elif isinstance(old, list) and isinstance(new, list):
+        for i in range(min(len(old), len(new))):
+            __diff_into(old[i], new[i], f"{key_path}[{i}]", changes)
+        for i in range(len(new), len(old)):
+            changes.append(KeyChange("removed", f"{key_path}[{i}]", old=old[i]))
+        for i in range(len(old), len(new)):
+            changes.append(KeyChange("added", f"{key_path}[{i}]", new=new[i]))
+    elif type(old) is not type(new) or old != new:
+        # Type is checked too so eg `true` -> `1` isn't taken as unchanged.
+        changes.append(KeyChange("changed", key_path, old=old, new=new))
+
+
+def diff_trees(old: Any, new: Any) -> List[KeyChange]:
+    """
+    Key paths that differ between two parsed config trees. Mapping key order never matters,
+    list order does.
+    """
+    changes: List[KeyChange] = []
+    __diff_into(old, new, "", changes)
+    return changes
+
+
+class ParseCache:
+    """
+    In memory cache of parsed config trees, keyed by content hash and the format the suffix says
+    to parse it as - the same bytes can be valid yaml and invalid json.
+
+    A file is only parsed once per process however many envs or env pairs it shows up in, and
+    if the caller already knows its hash (eg from the file index) a hit doesn't even read it.
+    """
+
+    trees: Dict[Tuple[str, str], Any]
+    lock: threading.Lock
+
+    hits: int
+    misses: int
+
+    def __init__(self):
+        self.trees = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __lookup(self, key: Tuple[str, str]) -> Tuple[bool, Any]:
+        """
+        Returns (found, tree). An empty file parses to None, so None alone can't mean a miss.
+        """
+        with self.lock:
+            if key not in self.trees:
+                return False, None
+            self.hits += 1
+            return True, self.trees[key]
+
+    def get_tree(self, path: Path, file_hash: Optional[str] = None) -> Any:
+        """
+        Returns path's parsed contents, or UNPARSEABLE if it isn't valid for its suffix.
+        """
+        file_format = STRUCTURED_SUFFIXES[path.suffix]
+        if file_hash is not None:
+            found, tree = self.__lookup((file_hash, file_format))
+            if found:
+                run_stats.add("parses_avoided")
+                return tree
+
+        data = path.read_bytes()
+        if file_hash is None:
+            file_hash = utils.hash_bytes(data)
+            found, tree = self.__lookup((file_hash, file_format))
+            if found:
+                run_stats.add("parses_avoided")
+                return tree
+
+        try:
+            tree = parse_config(data, path.suffix)
+        except (ValueError, yaml.YAMLError) as e:
+            logger.debug(f"Could not parse {path}: {e}")
+            tree = UNPARSEABLE
+        run_stats.add("configs_parsed")
+
+        with self.lock:
+            self.misses += 1
+            self.trees[(file_hash, file_format)] = tree
+        return tree
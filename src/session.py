@@ -0,0 +1,165 @@
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from src.common.config import Config
+from src.diff import EnvDiffer, EnvDiffStats
+from src.index import PluginFileChanges
+from src.jarcache import JarMetadataCache, get_jar_cache_path
+from src.mytypes import Environment, PluginName
+from src.patchouli import Patchouli
+from src.semdiff import ParseCache
+from src.utils import forget_validated_env
+
+
+class PatchouliSession:
+    """
+    Holds the scan results of several envs in one process.
+
+    Envs are scanned concurrently and share one jar metadata cache, so jars common to several envs
+    are only read once. Semantic diffs likewise share one parse cache. Each env is its own
+    Patchouli instance and can be refreshed or dropped without touching the others.
+
+        with PatchouliSession(config) as session:
+            prod, dev1 = session.load([Environment.PROD, Environment.DEV1])
+            ...
+            dev1 = session.refresh(Environment.DEV1)
+
+    Extra keyword arguments are passed to every Patchouli the session creates.
+    """
+
+    config: Config
+    logger: logging.Logger
+    jar_cache: Optional[JarMetadataCache]
+    parse_cache: ParseCache
+    patchouli_kwargs: Dict
+
+    envs: Dict[Environment, Patchouli]
+    lock: threading.Lock
+
+    def __init__(
+        self,
+        config: Config,
+        logger: Optional[logging.Logger] = None,
+        use_jar_cache: Optional[bool] = None,
+        **patchouli_kwargs,
+    ):
+        self.config = config
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+
+        if use_jar_cache is None:
+            use_jar_cache = config.use_jar_cache
+        self.jar_cache = (
+            JarMetadataCache(get_jar_cache_path(config.cache_dir), logger=self.logger)
+            if use_jar_cache
+            else None
+        )
+        self.parse_cache = ParseCache()
+        self.patchouli_kwargs = {
+            **patchouli_kwargs,
+            "use_jar_cache": use_jar_cache,
+        }
+
+        self.envs = {}
+        self.lock = threading.Lock()
+
+    def __enter__(self) -> "PatchouliSession":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def __scan(self, env: Environment) -> Patchouli:
+        return Patchouli(
+            config=self.config,
+            logger=self.logger,
+            target_env=env,
+            jar_cache=self.jar_cache,
+            **self.patchouli_kwargs,
+        )
+
+    def __scan_all(self, envs: List[Environment]) -> List[Patchouli]:
+        if len(envs) <= 1:
+            return [self.__scan(env) for env in envs]
+
+        with ThreadPoolExecutor(max_workers=len(envs)) as executor:
+            return list(executor.map(self.__scan, envs))
+
+    def __replace(self, env: Environment, patchy: Patchouli) -> None:
+        with self.lock:
+            previous = self.envs.get(env)
+            self.envs[env] = patchy
+        if previous is not None and previous is not patchy:
+            previous.close()
+
+    def load(self, envs: Iterable[Environment]) -> List[Patchouli]:
+        """
+        Returns the scan of each env in order, concurrently scanning any not yet loaded.
+        """
+        envs = list(envs)
+        with self.lock:
+            missing = list(dict.fromkeys(env for env in envs if env not in self.envs))
+
+        for env, patchy in zip(missing, self.__scan_all(missing)):
+            self.__replace(env, patchy)
+
+        with self.lock:
+            return [self.envs[env] for env in envs]
+
+    def get(self, env: Environment) -> Patchouli:
+        return self.load([env])[0]
+
+    def refresh(self, env: Environment) -> Patchouli:
+        """
+        Rescans env, replacing its previous results. Other loaded envs are left as they are.
+        The env is validated again, since its dirs may have changed since it was loaded.
+        """
+        forget_validated_env(env)
+        patchy = self.__scan(env)
+        self.__replace(env, patchy)
+        return patchy
+
+    def refresh_all(self) -> List[Patchouli]:
+        with self.lock:
+            envs = list(self.envs)
+
+        for env in envs:
+            forget_validated_env(env)
+        patchies = self.__scan_all(envs)
+        for env, patchy in zip(envs, patchies):
+            self.__replace(env, patchy)
+        return patchies
+
+    def unload(self, env: Environment) -> None:
+        with self.lock:
+            patchy = self.envs.pop(env, None)
+        if patchy is not None:
+            patchy.close()
+
+    def diff(
+        self, src_env: Environment, dest_env: Environment, semantic: bool = False
+    ) -> Tuple[Dict[PluginName, PluginFileChanges], EnvDiffStats]:
+        """
+        Diffs two envs, loading whichever of them isn't loaded yet. See EnvDiffer for semantic.
+        """
+        src, dest = self.load([src_env, dest_env])
+        differ = EnvDiffer(
+            src, dest, jobs=src.jobs, semantic=semantic, parse_cache=self.parse_cache
+        )
+        return differ.diff(), differ.stats
+
+    def loaded_envs(self) -> List[Environment]:
+        with self.lock:
+            return list(self.envs)
+
+    def close(self) -> None:
+        with self.lock:
+            patchies = list(self.envs.values())
+            self.envs = {}
+
+        for patchy in patchies:
+            patchy.close()
+        if self.jar_cache is not None:
+            self.jar_cache.save()
@@ -0,0 +1,461 @@
+import os
+import re
+import json
+import time
+import uuid
+import fcntl
+import logging
+import threading
+
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import src.utils as utils
+from src.common.config import Config
+from src.exceptions import SnapshotException
+from src.index import INDEX_DIRNAME, IndexRows
+from src.instrumentation import run_stats
+from src.mytypes import Environment, PluginName
+from src.patchouli import Patchouli
+from src.sync import CopyStats, FileCopier
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_DIRNAME = "snapshots"
+SNAPSHOT_MANIFEST_VERSION = 1
+SNAPSHOT_ID_REGEX = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]*$")
+LATEST_SNAPSHOT = "latest"
+SNAPSHOT_LOCK_FILENAME = "lock"
+
+# Objects are shared by every snapshot referencing them, so they're never written to in place.
+OBJECT_MODE = 0o444
+
+
+def get_snapshot_store_path(config: Config) -> Path:
+    if config.snapshot_store_path:
+        return Path(os.path.expanduser(config.snapshot_store_path))
+    return Path(config.base_path) / INDEX_DIRNAME / SNAPSHOT_DIRNAME
+
+
+@dataclass
+class SnapshotEntry:
+    plugin: PluginName
+    relpath: str
+    hash: str
+    size: int
+    mode: int
+    mtime_ns: int
+
+
+@dataclass
+class SnapshotManifest:
+    snapshot_id: str
+    env: Environment
+    created: float
+    # Every plugin that was scanned, including ones without config files, so restore knows which
+    # plugins the snapshot covers.
+    plugins: List[PluginName]
+    entries: List[SnapshotEntry] = field(default_factory=list)
+
+    @property
+    def size(self) -> int:
+        return sum(entry.size for entry in self.entries)
+
+    def as_dict(self) -> Dict:
+        return {
+            "version": SNAPSHOT_MANIFEST_VERSION,
+            "snapshot_id": self.snapshot_id,
+            "env": self.env.value,
+            "created": self.created,
+            "plugins": self.plugins,
+            "entries": [asdict(entry) for entry in self.entries],
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "SnapshotManifest":
+        if data.get("version") != SNAPSHOT_MANIFEST_VERSION:
+            raise SnapshotException(
+                f"Unsupported snapshot manifest version {data.get('version')}"
+            )
+        return cls(
+            snapshot_id=data["snapshot_id"],
+            env=Environment(data["env"]),
+            created=data["created"],
+            plugins=data["plugins"],
+            entries=[SnapshotEntry(**entry) for entry in data["entries"]],
+        )
+
+
+@dataclass
+class SnapshotStats:
+    files: int = 0
+    bytes: int = 0
+    objects_stored: int = 0
+    bytes_stored: int = 0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.files} files ({self.bytes} bytes), of which {self.objects_stored} new objects "
+            f"({self.bytes_stored} bytes) were stored"
+        )
+
+
+class SnapshotStore:
+    """
+    Content addressed store of config file snapshots.
+
+    Every file's contents are stored once under objects/, keyed by the same hash the file index
+    uses, no matter how many snapshots or envs it appears in. A snapshot is only a manifest under
+    manifests/<env>/ listing each file's plugin, relpath, hash, mode and mtime.
+
+    Objects are written with reflinks where the filesystem supports them, so storing a file that
+    is new to the store usually doesn't copy its data either. Restores reflink out of the store for
+    the same reason. Objects are never hardlinked into an env - plugins rewrite their configs in
+    place, which would silently change every snapshot sharing that object.
+    """
+
+    root: Path
+    objects_path: Path
+    manifests_path: Path
+    tmp_path: Path
+    lock_path: Path
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.objects_path = root / "objects"
+        self.manifests_path = root / "manifests"
+        self.tmp_path = root / "tmp"
+        self.lock_path = root / SNAPSHOT_LOCK_FILENAME
+
+    @contextmanager
+    def __locked(self) -> Iterator[None]:
+        """
+        Holds an exclusive lock on the store, across processes. Taken by snapshot and gc, so gc
+        can't delete an object, or a tmp file, that a running snapshot is about to reference.
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def get_object_path(self, file_hash: str) -> Path:
+        return self.objects_path / file_hash[:2] / file_hash[2:]
+
+    def get_manifest_path(self, env: Environment, snapshot_id: str) -> Path:
+        return self.manifests_path / env.value / f"{snapshot_id}.json"
+
+    def __store_object(
+        self, copier: FileCopier, file_path: Path, file_stat: os.stat_result
+    ) -> Tuple[str, bool]:
+        """
+        Copies file_path into the store and returns (hash, whether the object was new).
+
+        The hash is taken from the stored copy rather than the source, so a file modified while
+        the snapshot runs can never be stored under a hash that doesn't match its contents.
+        """
+        self.tmp_path.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.tmp_path / uuid.uuid4().hex
+        try:
+            copier.copy_file(file_path, tmp_path, file_stat)
+            file_hash = utils.hash_file(tmp_path)
+            object_path = self.get_object_path(file_hash)
+            if object_path.exists():
+                return file_hash, False
+
+            os.chmod(tmp_path, OBJECT_MODE)
+            object_path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp_path, object_path)
+            return file_hash, True
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    def snapshot(
+        self, patchy: Patchouli, snapshot_id: Optional[str] = None
+    ) -> Tuple[SnapshotManifest, SnapshotStats]:
+        """
+        Snapshots the config files patchy found in its target env.
+
+        Hashes are taken from the file index where the size and mtime still match, so only files
+        that changed since the last scan are hashed. Only files whose contents aren't in the store
+        yet are copied into it.
+        """
+        if snapshot_id is None:
+            snapshot_id = time.strftime("%Y%m%d-%H%M%S")
+        self.validate_snapshot_id(snapshot_id)
+        with self.__locked():
+            manifest_path = self.get_manifest_path(patchy.target_env, snapshot_id)
+            if manifest_path.exists():
+                raise SnapshotException(
+                    f"Snapshot {snapshot_id} of {patchy.target_env} already exists"
+                )
+
+            rows: IndexRows = (
+                patchy.file_index.get_rows() if patchy.file_index is not None else {}
+            )
+            copier = FileCopier()
+            stats = SnapshotStats()
+            lock = threading.Lock()
+
+            def snapshot_file(item: Tuple[PluginName, Path]) -> SnapshotEntry:
+                plugin_name, file_path = item
+                relpath = str(
+                    file_path.relative_to(patchy.plugin_path_base / plugin_name)
+                )
+                file_stat = os.stat(file_path)
+
+                row = rows.get((plugin_name, relpath))
+                if (
+                    row is not None
+                    and row[0] == file_stat.st_size
+                    and row[1] == file_stat.st_mtime_ns
+                ):
+                    file_hash = row[2]
+                else:
+                    file_hash = utils.hash_file(file_path)
+
+                is_new = False
+                if not self.get_object_path(file_hash).exists():
+                    file_hash, is_new = self.__store_object(
+                        copier, file_path, file_stat
+                    )
+
+                with lock:
+                    stats.files += 1
+                    stats.bytes += file_stat.st_size
+                    if is_new:
+                        stats.objects_stored += 1
+                        stats.bytes_stored += file_stat.st_size
+                return SnapshotEntry(
+                    plugin=plugin_name,
+                    relpath=relpath,
+                    hash=file_hash,
+                    size=file_stat.st_size,
+                    # Permission bits only - setuid, setgid and sticky bits are never restored.
+                    mode=file_stat.st_mode & 0o777,
+                    mtime_ns=file_stat.st_mtime_ns,
+                )
+
+            items = [
+                (plugin_name, file_path)
+                for plugin_name, files in sorted(patchy.plugin_config_mapping.items())
+                for file_path in files
+            ]
+            with run_stats.phase("snapshot"):
+                if patchy.jobs <= 1 or len(items) <= 1:
+                    entries = [snapshot_file(item) for item in items]
+                else:
+                    with ThreadPoolExecutor(max_workers=patchy.jobs) as executor:
+                        entries = list(executor.map(snapshot_file, items))
+
+            manifest = SnapshotManifest(
+                snapshot_id=snapshot_id,
+                env=patchy.target_env,
+                created=time.time(),
+                plugins=sorted(patchy.plugin_config_mapping),
+                entries=entries,
+            )
+            self.__write_manifest(manifest_path, manifest)
+            run_stats.add_many(
+                objects_stored=stats.objects_stored,
+                objects_deduped=stats.files - stats.objects_stored,
+            )
+            return manifest, stats
+
+    def __write_manifest(self, manifest_path: Path, manifest: SnapshotManifest) -> None:
+        manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = manifest_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(manifest.as_dict(), f)
+        os.replace(tmp_path, manifest_path)
+
+    @staticmethod
+    def validate_snapshot_id(snapshot_id: str) -> None:
+        if snapshot_id == LATEST_SNAPSHOT or not SNAPSHOT_ID_REGEX.match(snapshot_id):
+            raise SnapshotException(
+                f"Invalid snapshot id '{snapshot_id}' - Use letters, digits, '.', '_' and '-'."
+            )
+
+    def list_snapshots(self, env: Environment) -> List[SnapshotManifest]:
+        """
+        Oldest first.
+        """
+        env_path = self.manifests_path / env.value
+        if not env_path.is_dir():
+            return []
+
+        manifests = []
+        for manifest_path in env_path.glob("*.json"):
+            with open(manifest_path) as f:
+                manifests.append(SnapshotManifest.from_dict(json.load(f)))
+        return sorted(manifests, key=lambda manifest: manifest.created)
+
+    def load_manifest(self, env: Environment, snapshot_id: str) -> SnapshotManifest:
+        """
+        snapshot_id may be 'latest' for the newest snapshot of env.
+        """
+        if snapshot_id == LATEST_SNAPSHOT:
+            manifests = self.list_snapshots(env)
+            if not manifests:
+                raise SnapshotException(f"{env} has no snapshots")
+            return manifests[-1]
+
+        self.validate_snapshot_id(snapshot_id)
+        manifest_path = self.get_manifest_path(env, snapshot_id)
+        try:
+            with open(manifest_path) as f:
+                return SnapshotManifest.from_dict(json.load(f))
+        except FileNotFoundError:
+            raise SnapshotException(f"{env} has no snapshot {snapshot_id}")
+
+    def delete_snapshot(self, env: Environment, snapshot_id: str) -> None:
+        self.validate_snapshot_id(snapshot_id)
+        try:
+            self.get_manifest_path(env, snapshot_id).unlink()
+        except FileNotFoundError:
+            raise SnapshotException(f"{env} has no snapshot {snapshot_id}")
+
+    def gc(self) -> Tuple[int, int]:
+        """
+        Deletes objects no snapshot of any env references, along with leftovers of interrupted
+        snapshots. Returns the number of objects and bytes freed.
+        """
+        with self.__locked():
+            referenced: Set[str] = set()
+            for manifest_path in self.manifests_path.glob("*/*.json"):
+                with open(manifest_path) as f:
+                    referenced.update(
+                        entry["hash"] for entry in json.load(f)["entries"]
+                    )
+
+            freed = freed_bytes = 0
+            for object_path in self.objects_path.glob("*/*"):
+                if object_path.parent.name + object_path.name in referenced:
+                    continue
+                freed_bytes += object_path.stat().st_size
+                object_path.unlink()
+                freed += 1
+
+            if self.tmp_path.is_dir():
+                for tmp_path in self.tmp_path.iterdir():
+                    tmp_path.unlink(missing_ok=True)
+            return freed, freed_bytes
+
+    @utils.ensure_root
+    def restore(
+        self, patchy: Patchouli, manifest: SnapshotManifest, prune: bool = False
+    ) -> Tuple[CopyStats, List[Path]]:
+        """
+        Restores manifest's files into patchy's target env, which needn't be the env it was taken
+        of. Files already matching the snapshot are skipped, and only what's written is chowned.
+
+        If prune is set, config files in the snapshot's plugins that the snapshot doesn't have
+        are deleted. Returns the copy stats and the pruned paths.
+        """
+        entries = [
+            entry
+            for entry in manifest.entries
+            if not (
+                patchy.plugins_whitelist
+                and entry.plugin not in patchy.plugins_whitelist
+            )
+            and not (
+                patchy.plugins_blacklist and entry.plugin in patchy.plugins_blacklist
+            )
+        ]
+        for entry in entries:
+            if not self.get_object_path(entry.hash).exists():
+                raise SnapshotException(
+                    f"Snapshot {manifest.snapshot_id} is missing the object for {entry.plugin}/{entry.relpath}"
+                )
+
+        user, group = patchy.config.mc_data_user, patchy.config.mc_data_group
+        copier = FileCopier(*utils.get_uid_gid(user, group))
+        plugin_path_base = patchy.plugin_path_base
+
+        def restore_entry(entry: SnapshotEntry) -> None:
+            dest_path = plugin_path_base / entry.plugin / entry.relpath
+            if is_restored(dest_path, entry):
+                with copier.lock:
+                    copier.stats.skipped += 1
+                return
+
+            object_path = self.get_object_path(entry.hash)
+            object_fd = os.open(object_path, os.O_RDONLY)
+            try:
+                copier.copy_from_fd(
+                    object_fd,
+                    dest_path,
+                    os.fstat(object_fd),
+                    mode=entry.mode & 0o777,
+                    times_ns=(entry.mtime_ns, entry.mtime_ns),
+                )
+            finally:
+                os.close(object_fd)
+            logger.debug(f"{entry.hash[:12]} => {dest_path}")
+
+        copier.ensure_dirs(
+            {
+                (plugin_path_base / entry.plugin / entry.relpath).parent
+                for entry in entries
+            }
+        )
+        with run_stats.phase("restore"):
+            if patchy.jobs <= 1 or len(entries) <= 1:
+                for entry in entries:
+                    restore_entry(entry)
+            else:
+                with ThreadPoolExecutor(max_workers=patchy.jobs) as executor:
+                    list(executor.map(restore_entry, entries))
+
+        pruned: List[Path] = []
+        if prune:
+            restored = {(entry.plugin, entry.relpath) for entry in entries}
+            for plugin_name in (
+                set(manifest.plugins) & patchy.plugin_config_mapping.keys()
+            ):
+                plugin_dir = plugin_path_base / plugin_name
+                for file_path in patchy.plugin_config_mapping[plugin_name]:
+                    if (
+                        plugin_name,
+                        str(file_path.relative_to(plugin_dir)),
+                    ) in restored:
+                        continue
+                    file_path.unlink(missing_ok=True)
+                    pruned.append(file_path)
+                    logger.debug(f"Pruned {file_path}")
+
+        if patchy.file_index is not None:
+            patchy.file_index.refresh(
+                patchy.scan_config_files(
+                    dict.fromkeys(entry.plugin for entry in entries), plugin_path_base
+                ),
+                plugin_path_base,
+                complete=False,
+            )
+
+        return copier.stats, pruned
+
+
+def is_restored(dest_path: Path, entry: SnapshotEntry) -> bool:
+    """
+    Like sync.is_unchanged, but against a snapshot entry - a matching size and mtime is trusted,
+    and only a matching size with a different mtime needs dest_path hashed.
+    """
+    run_stats.add("entries_stated")
+    try:
+        dest_stat = os.stat(dest_path)
+    except FileNotFoundError:
+        return False
+
+    if dest_stat.st_size != entry.size:
+        return False
+    if dest_stat.st_mtime_ns == entry.mtime_ns:
+        return True
+    if utils.hash_file(dest_path) != entry.hash:
+        return False
+
+    os.utime(dest_path, ns=(dest_stat.st_atime_ns, entry.mtime_ns))
+    return True
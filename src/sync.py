@@ -0,0 +1,608 @@
+import os
+import sys
+import stat
+import errno
+import shutil
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from enum import Enum
+from pathlib import Path
+from typing import BinaryIO, Dict, Optional, Set, List, Tuple
+
+if sys.platform == "linux":
+    import fcntl
+
+import src.utils as utils
+from src.instrumentation import run_stats
+from src.mytypes import Environment, PluginName
+
+logger = logging.getLogger(__name__)
+
+# From linux/fs.h - _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# Errors meaning "this copy method isn't supported here", as opposed to a real IO failure.
+UNSUPPORTED_COPY_ERRNOS = {
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.EBADF,
+    errno.ETXTBSY,
+}
+
+# Files up to this size are read into memory once when copying to several destinations.
+FAN_OUT_BUFFER_LIMIT = 8 * 1024 * 1024
+
+# (dest FileCopier, dest path)
+CopyTarget = Tuple["FileCopier", Path]
+# (src path, src stat, every destination to copy it to)
+CopyItem = Tuple[Path, os.stat_result, List[CopyTarget]]
+
+
+@dataclass
+class CopyStats:
+    copied: int = 0
+    skipped: int = 0
+    bytes_copied: int = 0
+    dirs_created: int = 0
+    chowned: int = 0
+    deleted: int = 0
+
+    def __str__(self) -> str:
+        summary = (
+            f"copied {self.copied} files ({self.bytes_copied} bytes), skipped {self.skipped} unchanged files, "
+            f"created {self.dirs_created} dirs, chowned {self.chowned} files and dirs"
+        )
+        if self.deleted:
+            summary += f", deleted {self.deleted} stale files"
+        return summary
+
+
+class CopyAction(Enum):
+    CREATE = "create"
+    UPDATE = "update"
+    SKIP = "skip"
+    DELETE = "delete"
+
+
+# Actions that write a file to the destination.
+WRITE_ACTIONS = {CopyAction.CREATE, CopyAction.UPDATE}
+
+
+@dataclass
+class PlannedFile:
+    action: CopyAction
+    plugin_name: PluginName
+    dest_path: Path
+    # Bytes written for a create or update, otherwise the size of the file already in dest.
+    size: int
+    src_path: Optional[Path] = None
+    src_stat: Optional[os.stat_result] = None
+
+
+@dataclass
+class ActionTotals:
+    files: int = 0
+    bytes: int = 0
+
+
+@dataclass
+class CopyPlan:
+    """
+    Everything a copy into dest_env will do, decided before anything is written.
+
+    Plans are built by Patchouli.plan_copy and applied by CopyEngine.apply, so a plan can be
+    printed on its own to see how much IO a copy costs before running it.
+    """
+
+    dest_env: Environment
+    dest_path_base: Path
+    files: List[PlannedFile] = field(default_factory=list)
+
+    def get_totals(self) -> Dict[CopyAction, ActionTotals]:
+        return self.__sum_totals(self.files)
+
+    def get_plugin_totals(self) -> Dict[PluginName, Dict[CopyAction, ActionTotals]]:
+        per_plugin: Dict[PluginName, List[PlannedFile]] = {}
+        for planned in self.files:
+            per_plugin.setdefault(planned.plugin_name, []).append(planned)
+        return {
+            plugin_name: self.__sum_totals(files)
+            for plugin_name, files in sorted(per_plugin.items())
+        }
+
+    @property
+    def bytes_to_write(self) -> int:
+        return sum(
+            planned.size for planned in self.files if planned.action in WRITE_ACTIONS
+        )
+
+    @property
+    def has_changes(self) -> bool:
+        return any(planned.action != CopyAction.SKIP for planned in self.files)
+
+    def format_lines(self, list_files: bool = False) -> List[str]:
+        """
+        A summary line for the whole plan, then one per plugin with anything to do, and with
+        list_files one per file that would be written or deleted.
+        """
+        lines = [
+            f"{self.dest_env.value} ({self.dest_path_base}): {self.__describe(self.get_totals())} - "
+            f"{self.bytes_to_write} bytes to write"
+        ]
+        for plugin_name, totals in self.get_plugin_totals().items():
+            if set(totals) == {CopyAction.SKIP}:
+                continue
+            lines.append(f"  {plugin_name}: {self.__describe(totals)}")
+            if list_files:
+                for planned in self.files:
+                    if (
+                        planned.plugin_name == plugin_name
+                        and planned.action != CopyAction.SKIP
+                    ):
+                        lines.append(
+                            f"    {planned.action.value:<6} {planned.dest_path.relative_to(self.dest_path_base)} ({planned.size} bytes)"
+                        )
+        return lines
+
+    @staticmethod
+    def __sum_totals(files: List[PlannedFile]) -> Dict[CopyAction, ActionTotals]:
+        totals: Dict[CopyAction, ActionTotals] = {}
+        for planned in files:
+            action_totals = totals.get(planned.action)
+            if action_totals is None:
+                action_totals = totals[planned.action] = ActionTotals()
+            action_totals.files += 1
+            action_totals.bytes += planned.size
+        return totals
+
+    @staticmethod
+    def __describe(totals: Dict[CopyAction, ActionTotals]) -> str:
+        empty = ActionTotals()
+        create = totals.get(CopyAction.CREATE, empty)
+        update = totals.get(CopyAction.UPDATE, empty)
+        skip = totals.get(CopyAction.SKIP, empty)
+        delete = totals.get(CopyAction.DELETE, empty)
+
+        parts = [
+            f"{create.files} new ({create.bytes} bytes)",
+            f"{update.files} changed ({update.bytes} bytes)",
+            f"{skip.files} unchanged",
+        ]
+        if delete.files:
+            parts.append(f"{delete.files} stale to delete ({delete.bytes} bytes)")
+        return ", ".join(parts)
+
+
+def is_unchanged(
+    src_path: Path,
+    dest_path: Path,
+    src_stat: Optional[os.stat_result] = None,
+    dest_stat: Optional[os.stat_result] = None,
+    sync_mtime: bool = True,
+) -> bool:
+    """
+    Cheaply checks whether dest_path already has the same contents as src_path.
+
+    Size and mtime decide most cases. Only when sizes match but mtimes differ do we fall back to
+    hashing both files. If those hashes match and sync_mtime is set we also copy the src mtime
+    onto dest so the next comparison doesn't need to hash again.
+    """
+    if dest_stat is None:
+        run_stats.add("entries_stated")
+        try:
+            dest_stat = os.stat(dest_path)
+        except FileNotFoundError:
+            return False
+
+    if src_stat is None:
+        src_stat = os.stat(src_path)
+
+    if src_stat.st_size != dest_stat.st_size:
+        return False
+    if src_stat.st_mtime_ns == dest_stat.st_mtime_ns:
+        return True
+
+    if utils.hash_file(src_path) != utils.hash_file(dest_path):
+        return False
+
+    if not sync_mtime:
+        return True
+    logger.debug(f"{dest_path} matched by hash - Syncing mtime from {src_path}")
+    os.utime(dest_path, ns=(dest_stat.st_atime_ns, src_stat.st_mtime_ns))
+    return True
+
+
+class FileCopier:
+    """
+    Copies files while fixing ownership of only what it writes.
+
+    Ownership is set with fchown on the destination handle we already have open, and only if
+    the file's uid/gid don't already match. Directories are chowned only if we created them.
+    If uid/gid are None, ownership is left alone.
+
+    File contents are copied with the cheapest method the platform and filesystems support:
+    a reflink (FICLONE), then copy_file_range, then sendfile, then a plain read/write loop.
+    Once a method reports it's unsupported it isn't attempted again by this copier.
+    """
+
+    uid: Optional[int]
+    gid: Optional[int]
+    stats: CopyStats
+
+    known_dirs: Set[Path]
+    lock: threading.Lock
+
+    use_reflink: bool
+    use_copy_file_range: bool
+    use_sendfile: bool
+
+    def __init__(
+        self,
+        uid: Optional[int] = None,
+        gid: Optional[int] = None,
+        stats: Optional[CopyStats] = None,
+    ):
+        self.uid = uid
+        self.gid = gid
+        self.stats = stats if stats is not None else CopyStats()
+        self.known_dirs = set()
+        self.lock = threading.Lock()
+
+        is_linux = sys.platform == "linux"
+        self.use_reflink = is_linux
+        self.use_copy_file_range = is_linux and hasattr(os, "copy_file_range")
+        self.use_sendfile = is_linux and hasattr(os, "sendfile")
+
+    def ensure_dir(self, path: Path, mode: int = 0o755) -> None:
+        """
+        Creates path and any missing parents, chowning only the directories created here.
+        """
+        if path in self.known_dirs:
+            return
+
+        missing = []
+        parent = path
+        while parent not in self.known_dirs and not parent.is_dir():
+            missing.append(parent)
+            parent = parent.parent
+
+        for dir_path in reversed(missing):
+            try:
+                os.mkdir(dir_path, mode)
+            except FileExistsError:
+                continue
+            created = 1
+            chowned = 0
+            if self.uid is not None and self.gid is not None:
+                os.chown(dir_path, self.uid, self.gid)
+                chowned = 1
+            with self.lock:
+                self.stats.dirs_created += created
+                self.stats.chowned += chowned
+
+        with self.lock:
+            self.known_dirs.add(path)
+
+    def ensure_dirs(self, paths: Set[Path]) -> None:
+        """
+        Creates every dir in paths up front. Parents sort before their children so each missing
+        dir is only checked once.
+        """
+        for path in sorted(paths):
+            self.ensure_dir(path)
+
+    def fix_ownership_fd(self, fd: int) -> None:
+        if self.uid is None or self.gid is None:
+            return
+
+        fd_stat = os.fstat(fd)
+        if fd_stat.st_uid == self.uid and fd_stat.st_gid == self.gid:
+            run_stats.add("chowns_avoided")
+            return
+
+        os.fchown(fd, self.uid, self.gid)
+        with self.lock:
+            self.stats.chowned += 1
+
+    def copy_contents(self, src_fd: int, dest_fd: int, size: int) -> None:
+        """
+        Copies size bytes from src_fd to dest_fd. dest_fd must be empty.
+        """
+        if self.use_reflink:
+            try:
+                fcntl.ioctl(dest_fd, FICLONE, src_fd)
+                return
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_COPY_ERRNOS:
+                    raise
+                logger.debug(f"Reflinks unsupported ({e}) - Falling back")
+                self.use_reflink = False
+
+        if self.use_copy_file_range:
+            try:
+                self.__copy_with(os.copy_file_range, src_fd, dest_fd, size)
+                return
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_COPY_ERRNOS:
+                    raise
+                logger.debug(f"copy_file_range unsupported ({e}) - Falling back")
+                self.use_copy_file_range = False
+                self.__rewind(src_fd, dest_fd)
+
+        if self.use_sendfile:
+            try:
+                self.__copy_with(
+                    lambda src, dest, count: os.sendfile(dest, src, None, count),
+                    src_fd,
+                    dest_fd,
+                    size,
+                )
+                return
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_COPY_ERRNOS:
+                    raise
+                logger.debug(f"sendfile unsupported ({e}) - Falling back")
+                self.use_sendfile = False
+                self.__rewind(src_fd, dest_fd)
+
+        while True:
+            chunk = os.read(src_fd, shutil.COPY_BUFSIZE)
+            if not chunk:
+                break
+            view = memoryview(chunk)
+            while view:
+                count = os.write(dest_fd, view)
+                view = view[count:]
+
+    @staticmethod
+    def __copy_with(copy_func, src_fd: int, dest_fd: int, size: int) -> None:
+        """
+        copy_func(src_fd, dest_fd, count) -> bytes copied, advancing both file offsets.
+
+        Loops until EOF rather than trusting size, in case the source is still being written.
+        """
+        count = max(size, shutil.COPY_BUFSIZE)
+        while copy_func(src_fd, dest_fd, count) > 0:
+            pass
+
+    @staticmethod
+    def __rewind(src_fd: int, dest_fd: int) -> None:
+        os.lseek(src_fd, 0, os.SEEK_SET)
+        os.lseek(dest_fd, 0, os.SEEK_SET)
+        os.ftruncate(dest_fd, 0)
+
+    def copy_file(
+        self, src_path: Path, dest_path: Path, src_stat: Optional[os.stat_result] = None
+    ) -> None:
+        """
+        Equivalent to shutil.copy2 followed by a chown, but without re-resolving dest_path.
+        """
+        if src_stat is None:
+            src_stat = os.stat(src_path)
+
+        src_fd = os.open(src_path, os.O_RDONLY)
+        try:
+            self.copy_from_fd(src_fd, dest_path, src_stat)
+        finally:
+            os.close(src_fd)
+
+    def copy_from_fd(
+        self,
+        src_fd: int,
+        dest_path: Path,
+        src_stat: os.stat_result,
+        mode: Optional[int] = None,
+        times_ns: Optional[Tuple[int, int]] = None,
+    ) -> None:
+        """
+        Copies from the start of an already open src_fd, so one source can feed many copies.
+
+        mode and times_ns override the mode and (atime_ns, mtime_ns) otherwise taken from src_stat.
+        """
+        self.ensure_dir(dest_path.parent)
+        os.lseek(src_fd, 0, os.SEEK_SET)
+        dest_fd = os.open(dest_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            self.copy_contents(src_fd, dest_fd, src_stat.st_size)
+            os.fchmod(
+                dest_fd, mode if mode is not None else stat.S_IMODE(src_stat.st_mode)
+            )
+            self.fix_ownership_fd(dest_fd)
+            os.utime(
+                dest_fd,
+                ns=(
+                    times_ns
+                    if times_ns is not None
+                    else (src_stat.st_atime_ns, src_stat.st_mtime_ns)
+                ),
+            )
+        finally:
+            os.close(dest_fd)
+
+        with self.lock:
+            self.stats.copied += 1
+            self.stats.bytes_copied += src_stat.st_size
+
+    def write_file(
+        self,
+        dest_path: Path,
+        data: bytes,
+        mode: int = 0o644,
+        times_ns: Optional[Tuple[int, int]] = None,
+    ) -> None:
+        """
+        Writes data to dest_path, fixing ownership on the open handle like copy_file.
+        times_ns is an optional (atime_ns, mtime_ns) to set on the written file.
+        """
+        self.ensure_dir(dest_path.parent)
+        dest_fd = os.open(dest_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        try:
+            view = memoryview(data)
+            while view:
+                written = os.write(dest_fd, view)
+                view = view[written:]
+            os.fchmod(dest_fd, mode)
+            self.fix_ownership_fd(dest_fd)
+            if times_ns is not None:
+                os.utime(dest_fd, ns=times_ns)
+        finally:
+            os.close(dest_fd)
+
+        with self.lock:
+            self.stats.copied += 1
+            self.stats.bytes_copied += len(data)
+
+    def write_stream(
+        self,
+        dest_path: Path,
+        stream: BinaryIO,
+        mode: int = 0o644,
+        times_ns: Optional[Tuple[int, int]] = None,
+    ) -> int:
+        """
+        Like write_file, but reads the contents from stream until EOF instead of from memory.
+        Returns the number of bytes written.
+        """
+        self.ensure_dir(dest_path.parent)
+        written = 0
+        dest_fd = os.open(dest_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        try:
+            while True:
+                chunk = stream.read(shutil.COPY_BUFSIZE)
+                if not chunk:
+                    break
+                view = memoryview(chunk)
+                while view:
+                    count = os.write(dest_fd, view)
+                    view = view[count:]
+                written += len(chunk)
+            os.fchmod(dest_fd, mode)
+            self.fix_ownership_fd(dest_fd)
+            if times_ns is not None:
+                os.utime(dest_fd, ns=times_ns)
+        finally:
+            os.close(dest_fd)
+
+        with self.lock:
+            self.stats.copied += 1
+            self.stats.bytes_copied += written
+        return written
+
+    def remove_file(self, dest_path: Path) -> None:
+        dest_path.unlink(missing_ok=True)
+        with self.lock:
+            self.stats.deleted += 1
+        logger.debug(f"Removed {dest_path}")
+
+
+class CopyEngine:
+    """
+    Runs a batch of file copies on a bounded thread pool.
+
+    Each item is one source file and every destination it should be written to, each with its
+    own FileCopier so stats and ownership are tracked per destination. Sources are opened once
+    per item and small ones are read once into memory no matter how many destinations there are.
+
+    All destination dirs are created in a single pass before any file is copied, so workers
+    never race on or repeatedly stat parent dirs.
+    """
+
+    jobs: int
+
+    def __init__(self, jobs: int = 1):
+        self.jobs = max(1, jobs)
+
+    @staticmethod
+    def __read_all(fd: int, size: int) -> bytes:
+        """
+        Reads fd until EOF. A single read can come back short, and the file may have changed size
+        since it was stat'ed.
+        """
+        chunks = []
+        chunk = os.read(fd, size + 1)
+        while chunk:
+            chunks.append(chunk)
+            chunk = os.read(fd, shutil.COPY_BUFSIZE)
+        return b"".join(chunks)
+
+    def __copy_one(self, item: CopyItem) -> None:
+        src_path, src_stat, targets = item
+        if not targets:
+            return
+
+        src_fd = os.open(src_path, os.O_RDONLY)
+        try:
+            if len(targets) > 1 and src_stat.st_size <= FAN_OUT_BUFFER_LIMIT:
+                data = self.__read_all(src_fd, src_stat.st_size)
+                run_stats.add("source_reads_avoided", len(targets) - 1)
+                for copier, dest_path in targets:
+                    copier.write_file(
+                        dest_path,
+                        data,
+                        stat.S_IMODE(src_stat.st_mode),
+                        (src_stat.st_atime_ns, src_stat.st_mtime_ns),
+                    )
+            else:
+                for copier, dest_path in targets:
+                    copier.copy_from_fd(src_fd, dest_path, src_stat)
+        finally:
+            os.close(src_fd)
+
+        for _, dest_path in targets:
+            logger.debug(f"{src_path} => {dest_path}")
+
+    def run(self, items: List[CopyItem]) -> None:
+        dirs_per_copier: Dict[FileCopier, Set[Path]] = {}
+        for _, _, targets in items:
+            for copier, dest_path in targets:
+                dirs_per_copier.setdefault(copier, set()).add(dest_path.parent)
+        for copier, dirs in dirs_per_copier.items():
+            copier.ensure_dirs(dirs)
+
+        if self.jobs <= 1 or len(items) <= 1:
+            for item in items:
+                self.__copy_one(item)
+        else:
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                # Consume the results so any worker exception is re-raised here.
+                list(executor.map(self.__copy_one, items))
+
+    def apply(self, plans: List[Tuple[CopyPlan, FileCopier]]) -> None:
+        """
+        Carries out each plan with its dest's FileCopier.
+
+        Writes of the same source file are merged across plans so it's still read once for
+        every dest, and the largest files are started first so a big file doesn't run alone at
+        the end. Stale files are only deleted once every copy has succeeded.
+        """
+        items_by_src: Dict[Path, CopyItem] = {}
+        for plan, copier in plans:
+            for planned in plan.files:
+                if planned.action == CopyAction.SKIP:
+                    copier.stats.skipped += 1
+                elif planned.action in WRITE_ACTIONS:
+                    assert planned.src_path is not None and planned.src_stat is not None
+                    item = items_by_src.get(planned.src_path)
+                    if item is None:
+                        item = items_by_src[planned.src_path] = (
+                            planned.src_path,
+                            planned.src_stat,
+                            [],
+                        )
+                    item[2].append((copier, planned.dest_path))
+
+        items = sorted(
+            items_by_src.values(), key=lambda item: item[1].st_size, reverse=True
+        )
+        self.run(items)
+
+        for plan, copier in plans:
+            for planned in plan.files:
+                if planned.action == CopyAction.DELETE:
+                    copier.remove_file(planned.dest_path)
@@ -4,6 +4,9 @@ import sys
 import pwd
 import grp
 import getpass
+import subprocess
+import mmap
+import hashlib
 import yaml  # type: ignore
 import logging
 
@@ -11,15 +14,17 @@ logger = logging.getLogger(__name__)
 
 from zipfile import ZipFile
 from pathlib import Path
+from dataclasses import dataclass, field
+from functools import lru_cache
 from argparse import ArgumentParser
 
-from typing import Optional, Tuple, List, Dict, Callable, Set
-
+from typing import Optional, Tuple, List, Dict, Callable, Iterable, Iterator, Set, Union
 
 import src.constants as consts
 from src.mytypes import *
-from src.common.config import Config, get_config
-from src.constants import CONFIG_NAME
+from src.common.config import Config
+from src.discarded import DiscardSummary
+from src.instrumentation import run_stats, add_instrumentation_argparse_args
 from src.exceptions import (
     InvalidPathException,
     InvalidPluginException,
@@ -27,8 +32,36 @@ from src.exceptions import (
     MustBeRunAsRootException,
 )
 
-__CONFIG = get_config(CONFIG_NAME)
-__BASE_PATH = Path(__CONFIG.base_path)
+# Envs that already passed ensure_valid_env in this process.
+__VALIDATED_ENVS: Set[str] = set()
+
+
+@lru_cache(maxsize=None)
+def get_base_path() -> Path:
+    return Path(get_patchouli_config().base_path)
+
+
+@lru_cache(maxsize=None)
+def get_env_name_regex() -> re.Pattern:
+    return re.compile(get_patchouli_config().env_name_regex)
+
+
+def clear_config_caches() -> None:
+    """
+    Drops everything derived from the patchouli config, for use after set_patchouli_config.
+    """
+    get_base_path.cache_clear()
+    get_env_name_regex.cache_clear()
+    get_vcs_repo_path.cache_clear()
+    __VALIDATED_ENVS.clear()
+
+
+def forget_validated_env(env: Environment) -> None:
+    """
+    Drops env's memoized ensure_valid_env result so it's checked again on next use. Long lived
+    processes call this when an env's dirs may have gone away, eg after a scan of it failed.
+    """
+    __VALIDATED_ENVS.discard(env.value)
 
 
 def ensure_root(func: Callable) -> Callable:
@@ -48,13 +81,49 @@ def __create_dir(path: Path, mode=0o755):
         os.umask(original_umask)
 
 
+@lru_cache(maxsize=None)
+def get_vcs_repo_path() -> Path:
+    """
+    The VCS "env" is the git repo at vcs_repo_path, or the repo git-patchy was run from if unset.
+    """
+    configured = get_patchouli_config().vcs_repo_path
+    if configured:
+        return Path(os.path.expanduser(configured))
+
+    result = subprocess.run(
+        ["git", "rev-parse", "--show-toplevel"], capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise InvalidEnvironmentException(
+            "The VCS env requires either vcs_repo_path to be configured or running git-patchy from inside the config repo."
+        )
+    return Path(result.stdout.strip())
+
+
 def ensure_valid_env(env: Environment, create_missing_dirs: bool = False):
+    """
+    Validation results are memoized per process - each env is only checked once, unless
+    forget_validated_env drops it.
+    """
     env_str = env.value
-    if not re.match(__CONFIG.env_name_regex, env_str):
+    if env_str in __VALIDATED_ENVS:
+        return
+
+    if env_str == consts.VCS_ENV:
+        repo_path = get_vcs_repo_path()
+        if not (repo_path / ".git").exists():
+            raise InvalidEnvironmentException(
+                f"The VCS env path {repo_path} is not a git repository!"
+            )
+        __VALIDATED_ENVS.add(env_str)
+        return
+
+    env_name_regex = get_env_name_regex()
+    if not env_name_regex.match(env_str):
         raise InvalidEnvironmentException(
-            f"Got '{env_str}' which was not a valid env name. Env names must satisfy the regex: {__CONFIG.env_name_regex}"
+            f"Got '{env_str}' which was not a valid env name. Env names must satisfy the regex: {env_name_regex.pattern}"
         )
-    env_path = __BASE_PATH / env_str
+    env_path = get_base_path() / env_str
 
     if not env_path.exists():
         if create_missing_dirs:
@@ -94,9 +163,39 @@ def ensure_valid_env(env: Environment, create_missing_dirs: bool = False):
                 f"Env '{env_str}' was a valid env name but could not find a plugin directory for it! Please create {plugins_path} first."
             )
 
+    __VALIDATED_ENVS.add(env_str)
+
 
 def add_default_argparse_args(parser: ArgumentParser) -> ArgumentParser:
     parser.add_argument("--create-missing-dirs", default=None, action="store_true")
+    parser.add_argument(
+        "--no-jar-cache",
+        dest="use_jar_cache",
+        default=None,
+        action="store_false",
+        help="Read every jar's plugin.yml instead of using the jar metadata cache.",
+    )
+    parser.add_argument(
+        "--no-file-index",
+        dest="use_file_index",
+        default=None,
+        action="store_false",
+        help="Don't read or update the per-env file index.",
+    )
+    parser.add_argument(
+        "--no-daemon",
+        dest="use_daemon",
+        default=None,
+        action="store_false",
+        help="Scan envs directly even if a git patchy daemon is running.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=None,
+        type=int,
+        help="Number of worker threads used for plugin discovery and copying. Defaults to default_discovery_jobs in the config.",
+    )
     parser.add_argument(
         "-w",
         "--plugins-whitelist",
@@ -111,6 +210,8 @@ def add_default_argparse_args(parser: ArgumentParser) -> ArgumentParser:
         nargs="+",
         help="Plugins to ignore. Case sensitive. Incompatible with --plugins-whitelist",
     )
+    # Handled by the Runner for every subcommand, added here so they show up in --help.
+    add_instrumentation_argparse_args(parser)
     return parser
 
 
@@ -118,191 +219,610 @@ def get_uid_gid(user: str, group: str) -> Tuple[int, int]:
     return pwd.getpwnam(user).pw_uid, grp.getgrnam(group).gr_gid
 
 
+def chown_tree(path: Path, uid: int, gid: int) -> int:
+    """
+    Recursively chowns path, skipping anything that is already owned by uid:gid.
+
+    Returns the number of files and directories that were changed.
+    """
+    changed = 0
+    checked = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in [""] + filenames:
+            entry_path = os.path.join(dirpath, name) if name else dirpath
+            entry_stat = os.stat(entry_path)
+            checked += 1
+            if entry_stat.st_uid == uid and entry_stat.st_gid == gid:
+                continue
+
+            logger.debug(f"{entry_path} - {uid}:{gid}")
+            os.chown(entry_path, uid, gid)
+            changed += 1
+
+    run_stats.add_many(entries_stated=checked, chowns_avoided=checked - changed)
+    return changed
+
+
 def get_plugin_path_base(env: Environment, create_missing_dirs: bool = False) -> Path:
-    if env == consts.VCS_ENV:
+    ensure_valid_env(
+        env,
+        create_missing_dirs=create_missing_dirs,
+    )
+
+    if env.value == consts.VCS_ENV:
         """
         The VCS "env" is a special env that refers to the VCS repo instead of an env folder under config.base_path
+
+        plugins/ may not exist yet. It isn't created here since read-only commands end up here too - whatever
+        writes into it creates it.
         """
-        raise NotImplementedError("Aaaaaa")
+        return get_vcs_repo_path() / "plugins"
+
+    return get_base_path() / env.value / "plugins"
+
+
+def get_server_path_base(env: Environment, create_missing_dirs: bool = False) -> Path:
+    """
+    Where an env's server configs live - the env folder itself, or server/ in the VCS repo's
+    worktree. The worktree is only ever read, by `server show vcs`; copies to and from VCS go
+    through git, see Patchouli.sync_server_with_vcs.
+    """
     ensure_valid_env(
         env,
         create_missing_dirs=create_missing_dirs,
     )
 
-    return __BASE_PATH / env.value / "plugins"
+    if env.value == consts.VCS_ENV:
+        # May not exist yet, see get_plugin_path_base.
+        return get_vcs_repo_path() / "server"
 
+    return get_base_path() / env.value
 
-def get_plugin_name_from_jar(jar_path: PluginJar) -> str:
+
+# libyaml's loader is several times faster than the pure Python one, if PyYAML was built with it.
+YamlSafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def load_yaml(stream):
+    """
+    yaml.safe_load, but with libyaml when available.
+    """
+    return yaml.load(stream, Loader=YamlSafeLoader)
+
+
+def __as_list(value) -> List[str]:
+    """
+    plugin.yml allows `depend`/`softdepend` to be either a single string or a list.
+    """
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return [str(v) for v in value]
+    return [str(value)]
+
+
+def get_plugin_metadata_from_jar(jar_path: PluginJar) -> PluginMetadata:
     if jar_path.suffix != ".jar":
         raise InvalidPathException(
             f"Got '{jar_path}' as a jar path but path did not end in a '.jar'!"
         )
 
+    run_stats.add("jars_read")
     try:
         with ZipFile(jar_path, "r").open("plugin.yml") as f:
-            yaml_as_dict = yaml.safe_load(f)
+            yaml_as_dict = load_yaml(f)
             if "name" not in yaml_as_dict:
                 raise KeyError(
                     f"{jar_path}'s plugin.yml did not contain a 'name' field!"
                 )
-            return yaml_as_dict["name"]
+            version = yaml_as_dict.get("version")
+            return PluginMetadata(
+                name=yaml_as_dict["name"],
+                version=str(version) if version is not None else None,
+                depend=__as_list(yaml_as_dict.get("depend")),
+                softdepend=__as_list(yaml_as_dict.get("softdepend")),
+            )
     except KeyError as e:
         # KeyError can be raised from both ZipFile().open() as well as the explicit raise
         raise InvalidPluginException from e
 
 
+def get_plugin_name_from_jar(jar_path: PluginJar) -> str:
+    return get_plugin_metadata_from_jar(jar_path).name
+
+
+MMAP_HASH_THRESHOLD = 4 * 1024 * 1024
+
+
+def hash_file(path: Path, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Hashes the file with blake2b without holding it in memory. Small files are streamed in
+    chunks, large ones are mmap'd and hashed in place to skip the copies into Python buffers.
+    """
+    digest = hashlib.blake2b()
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_HASH_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                digest.update(mapped)
+        else:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+    run_stats.add_many(files_hashed=1, bytes_hashed=size)
+    return digest.hexdigest()
+
+
+def hash_bytes(data: bytes) -> str:
+    """
+    The hash_file hash of data already in memory.
+    """
+    run_stats.add_many(files_hashed=1, bytes_hashed=len(data))
+    return hashlib.blake2b(data).hexdigest()
+
+
 def filter_ignored_paths(path: Path) -> bool:
     return not any([path_to_ignore in str(path) for path_to_ignore in []])  # type: ignore
 
 
-def __chop_prefix_from_paths(paths: List[Path], next_dirname: str) -> List[Path]:
-    rtn = []
+# Characters that make a paths_to_ignore, folders_to_ignore or suffixes_override path a pattern.
+GLOB_CHARS = set("*?[")
 
-    for path in paths:
-        if path.name != next_dirname:
-            continue
 
-        logger.info([path, next_dirname])
-        chopped = Path(*path.parts[1:])
-        if len(chopped.parts) > 0:
-            rtn.append(chopped)
+def is_glob_pattern(pattern: str) -> bool:
+    """
+    Anything else is a literal path, matched relative to the plugin dir as it always has been.
+    """
+    return (
+        pattern.startswith("!")
+        or pattern.endswith("/")
+        or any(char in GLOB_CHARS for char in pattern)
+    )
 
-    return rtn
 
+class GlobMatcher:
+    """
+    gitignore-style patterns, eg '**/cache', '*.log' or 'logs/*.gz', compiled into one regex so
+    matching a path costs a single regex match however many patterns there are.
 
-def __chop_prefix_from_suffixes_override(
-    suffixes_override: Optional[Dict[str, List[Dict]]], next_dirname: str
-) -> Optional[Dict[str, List[Dict]]]:
-    """ """
-    if suffixes_override is None:
-        return None
+    Paths are relative and '/' separated. Patterns without a '/' match at any depth, and patterns
+    ending in '/' only match dirs. Patterns starting with '!' are exceptions - a path matching
+    any of them never matches, regardless of where they appear in the list.
+    """
 
-    rtn = {}
-    for op in ["add", "rem"]:
-        if op not in suffixes_override:
-            continue
+    include: Optional[re.Pattern]
+    exclude: Optional[re.Pattern]
 
-        objs = []
-        for obj in suffixes_override[op]:
-            path = Path(obj["path"])
-            if path.parts and path.parts[0] != next_dirname:
-                logger.debug(
-                    f"[__chop_pre_suf_over] Dropping path:{path} as it does not match next_dirname:{next_dirname}"
-                )
-                continue
-            if len(path.parts) <= 1:
-                logger.debug(
-                    f"[__chop_pre_suf_over] Dropping path:{path} as it is <= len of 1"
-                )
+    def __init__(self, patterns: Iterable[str]):
+        include: List[str] = []
+        exclude: List[str] = []
+        for pattern in patterns:
+            compiled = self.__to_regex(pattern)
+            if compiled is None:
                 continue
+            regex, is_include = compiled
+            (include if is_include else exclude).append(regex)
 
-            # Icky hardcoded literals.
-            # TODO: Eventually make dataclass defs for config shape.
-            objs.append(
-                {
-                    "suffix": obj["suffix"],
-                    "path": str(Path(*path.parts[1:])),  # :thinking:
-                }
-            )
+        self.include = self.__compile(include)
+        self.exclude = self.__compile(exclude)
 
-        rtn[op] = objs
+    @staticmethod
+    def __to_regex(pattern: str) -> Optional[Tuple[str, bool]]:
+        """
+        Translates a pattern into (regex, is_include), or None for blank lines and comments.
 
-    return rtn
+        The regex fullmatches a path itself - a dir's path with a trailing '/'. Unlike gitignore,
+        it never matches what's under a matched dir, since the walk never descends into one.
+        """
+        if pattern.endswith("\\ "):
+            pattern = pattern.rstrip() + " "
+        else:
+            pattern = pattern.rstrip()
+        if not pattern or pattern.startswith("#"):
+            return None
+
+        is_include = not pattern.startswith("!")
+        if not is_include:
+            pattern = pattern[1:]
+        elif pattern.startswith(("\\!", "\\#")):
+            pattern = pattern[1:]
+
+        is_dir_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        # A '/' anywhere but the end anchors the pattern to the base dir.
+        is_anchored = "/" in pattern
+        segments = pattern.lstrip("/").split("/")
+        if segments == [""]:
+            return None
+
+        parts = [] if is_anchored else ["(?:.*/)?"]
+        for i, segment in enumerate(segments):
+            is_last = i == len(segments) - 1
+            if segment == "**":
+                # Any number of dirs, or everything under a dir when last.
+                parts.append(".+" if is_last else "(?:.*/)?")
+            else:
+                parts.append(GlobMatcher.__translate_segment(segment))
+                if not is_last:
+                    parts.append("/")
 
+        parts.append("/" if is_dir_only else "/?")
+        return "".join(parts), is_include
 
-def __process_paths_and_suffixes_for_child_dir(
-    extensions: Set[str],
-    paths_to_ignore: List[Path],
+    @staticmethod
+    def __translate_segment(segment: str) -> str:
+        """
+        One path component of a pattern - '*', '?' and '[...]' never match a '/', and a component
+        is never empty, so eg 'a/*' doesn't match 'a/'.
+        """
+        regex = ["(?=[^/])"]
+        i = 0
+        while i < len(segment):
+            char = segment[i]
+            i += 1
+            if char == "*":
+                regex.append("[^/]*")
+            elif char == "?":
+                regex.append("[^/]")
+            elif char == "\\" and i < len(segment):
+                regex.append(re.escape(segment[i]))
+                i += 1
+            elif char == "[":
+                start = i + 1 if segment[i : i + 1] in ("!", "^") else i
+                # A ']' right after the '[' or its negation is a member, not the end.
+                end = segment.find("]", start + 1)
+                if end == -1:
+                    regex.append(re.escape(char))
+                    continue
+                members = re.sub(r"([\\\[\]^])", r"\\\1", segment[start:end])
+                regex.append(f"(?!/)[{'^' if start != i else ''}{members}]")
+                i = end + 1
+            else:
+                regex.append(re.escape(char))
+        return "".join(regex)
+
+    @staticmethod
+    def __compile(regexes: List[str]) -> Optional[re.Pattern]:
+        if not regexes:
+            return None
+        return re.compile("|".join(f"(?:{regex})" for regex in regexes))
+
+    def __bool__(self) -> bool:
+        return self.include is not None
+
+    def matches(self, relpath: str, is_dir: bool = False) -> bool:
+        if self.include is None:
+            return False
+        path = relpath + "/" if is_dir else relpath
+        if self.include.fullmatch(path) is None:
+            return False
+        return self.exclude is None or self.exclude.fullmatch(path) is None
+
+
+class NameFilter:
+    """
+    Matches dir names against a list of literal names and gitignore-style patterns, eg
+    folders_to_ignore.
+    """
+
+    names: Set[str]
+    globs: GlobMatcher
+
+    def __init__(self, patterns: Iterable[str]):
+        patterns = [str(pattern) for pattern in patterns]
+        self.names = {pattern for pattern in patterns if not is_glob_pattern(pattern)}
+        self.globs = GlobMatcher(
+            pattern for pattern in patterns if is_glob_pattern(pattern)
+        )
+
+    def matches(self, name: str, is_dir: bool = True) -> bool:
+        return name in self.names or self.globs.matches(name, is_dir)
+
+
+@dataclass
+class GlobRules:
+    """
+    The pattern rules of a plugin, checked against each entry's path relative to the plugin dir.
+    """
+
+    ignore: GlobMatcher
+    # (matcher, "add" or "rem", suffix) of each suffixes_override entry whose path is a pattern.
+    overrides: List[Tuple[GlobMatcher, str, str]]
+    # Every override pattern in one matcher, so dirs no override applies to cost one match.
+    any_override: GlobMatcher
+
+    def get_child_extensions(self, extensions: Set[str], relpath: str) -> Set[str]:
+        if not self.any_override.matches(relpath, is_dir=True):
+            return extensions
+
+        adds = set()
+        rems = set()
+        for matcher, op, suffix in self.overrides:
+            if matcher.matches(relpath, is_dir=True):
+                (adds if op == "add" else rems).add(suffix)
+        return (extensions | adds) - rems
+
+
+@dataclass
+class DirRules:
+    """
+    A node in the compiled prefix trie of per-directory rules for find_all_files_with_exts.
+
+    Only directories that have rules get a node. Any directory without one inherits the
+    extensions of its parent and needs no further checks, which is the common case.
+    """
+
+    # Names of entries directly in this directory to skip entirely.
+    ignored: Set[str] = field(default_factory=set)
+    # Suffix overrides applied when entering any immediate child dir. ie, override path "."
+    any_child_add: List[str] = field(default_factory=list)
+    any_child_rem: List[str] = field(default_factory=list)
+    # Suffix overrides applied when entering this directory.
+    add: List[str] = field(default_factory=list)
+    rem: List[str] = field(default_factory=list)
+    children: Dict[str, "DirRules"] = field(default_factory=dict)
+    # Only set on the root, if any rule is a pattern rather than a literal path.
+    globs: Optional[GlobRules] = None
+
+    def get_child(self, name: str) -> "DirRules":
+        if name not in self.children:
+            self.children[name] = DirRules()
+        return self.children[name]
+
+    def get_child_extensions(
+        self, extensions: Set[str], child_rules: Optional["DirRules"]
+    ) -> Set[str]:
+        """
+        All "add"s are evaluated before any "rem"s, so a suffix both added and removed for the
+        same directory ends up removed.
+        """
+        adds = self.any_child_add + (child_rules.add if child_rules else [])
+        rems = self.any_child_rem + (child_rules.rem if child_rules else [])
+        if not adds and not rems:
+            return extensions
+
+        return (extensions | set(adds)) - set(rems)
+
+
+def compile_dir_rules(
+    paths_to_ignore: Iterable[Union[str, Path]],
     suffixes_override: Optional[Dict[str, List[Dict]]],
-    child_dirname: str,
-):
-    extensions = set(extensions)
+) -> DirRules:
+    """
+    Compiles paths_to_ignore and suffixes_override into a prefix trie of DirRules so the
+    directory walk never has to re-evaluate rules that can't apply to the current subtree.
+
+    Literal paths go into the trie. Paths that are gitignore-style patterns are compiled into
+    the root's GlobRules instead.
+    """
+    root = DirRules()
+    ignore_patterns: List[str] = []
+    overrides: List[Tuple[GlobMatcher, str, str]] = []
+    override_patterns: List[str] = []
+
+    for ignored_path in paths_to_ignore:
+        if is_glob_pattern(str(ignored_path)):
+            ignore_patterns.append(str(ignored_path))
+            continue
+
+        parts = Path(ignored_path).parts
+        if not parts:
+            continue
+        node = root
+        for part in parts[:-1]:
+            node = node.get_child(part)
+        node.ignored.add(parts[-1])
 
     if suffixes_override:
-        if "add" in suffixes_override:
-            for suffix_override in suffixes_override["add"]:
-                suffix = suffix_override["suffix"]
+        for op in ["add", "rem"]:
+            if op not in suffixes_override:
+                continue
 
-                if suffix_override["path"] in [".", child_dirname]:
-                    logger.debug(
-                        f"Adding suffix:{suffix} to extensions for path:{suffix_override['path']}"
-                    )
-                    extensions.add(suffix)
-
-        if "rem" in suffixes_override:
-            for suffix_override in suffixes_override["rem"]:
-                suffix = suffix_override["suffix"]
-
-                if (
-                    suffix_override["path"] in [".", child_dirname]
-                    and suffix in extensions
-                ):
-                    logger.debug(
-                        f"Removing suffix:{suffix} from extensions for path:{suffix_override['path']}"
-                    )
-                    extensions.remove(suffix)
+            # Icky hardcoded literals.
+            # TODO: Eventually make dataclass defs for config shape.
+            for obj in suffixes_override[op]:
+                suffix = obj["suffix"]
+                if is_glob_pattern(str(obj["path"])):
+                    overrides.append((GlobMatcher([obj["path"]]), op, suffix))
+                    override_patterns.append(obj["path"])
+                    continue
 
-    paths_to_ignore = __chop_prefix_from_paths(paths_to_ignore, child_dirname)
+                parts = Path(obj["path"]).parts
+                if not parts:
+                    # Path "." applies to every directory under the plugin dir.
+                    getattr(root, f"any_child_{op}").append(suffix)
+                    continue
 
-    suffixes_override = __chop_prefix_from_suffixes_override(
-        suffixes_override, child_dirname
-    )
+                node = root
+                for part in parts:
+                    node = node.get_child(part)
+                getattr(node, op).append(suffix)
 
-    return extensions, paths_to_ignore, suffixes_override
+    if ignore_patterns or overrides:
+        root.globs = GlobRules(
+            ignore=GlobMatcher(ignore_patterns),
+            overrides=overrides,
+            any_override=GlobMatcher(override_patterns),
+        )
+    return root
 
 
-def find_all_files_with_exts(
+def get_suffix(name: str) -> str:
+    """
+    Same as Path(name).suffix, without constructing a Path.
+    """
+    i = name.rfind(".")
+    if 0 < i < len(name) - 1:
+        return name[i:]
+    return ""
+
+
+def iter_files_with_exts(
     base_path: Path,
     extensions: Set[str],
-    paths_to_ignore: List[Path],
+    paths_to_ignore: Iterable[Union[str, Path]],
     suffixes_override: Optional[Dict[str, List[Dict]]],
-) -> Tuple[List[Path], List[Path]]:
+    rules: Optional[DirRules] = None,
+    discarded: Optional[DiscardSummary] = None,
+    on_dir: Optional[Callable[[str], None]] = None,
+) -> Iterator[Tuple[Path, bool]]:
     """
     Extensions should have a dot in front, eg [".yml", ".yaml"]
-    """
-    extensions = set(extensions)
 
-    all_valid_files = []
-    all_invalid_files_and_dirs = []
+    Walks base_path depth first with os.scandir, yielding (path, matched) for every file as soon
+    as it's found, in the same order as a recursive walk would. Ignored paths are yielded as-is
+    as unmatched and never descended into.
+
+    Pass rules from compile_dir_rules to reuse them across walks, in which case paths_to_ignore
+    and suffixes_override are unused.
+
+    If discarded is given, unmatched paths are also rolled up into it, sized from their DirEntry.
+    on_dir is called with each dir's path just before it's listed. Ignored dirs are never listed,
+    so it's never called for them.
+    """
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if rules is None:
+        rules = compile_dir_rules(paths_to_ignore, suffixes_override)
+    globs = rules.globs
+
+    dirs_visited = 0
+    entries_listed = 0
+    files_matched = 0
+    files_discarded = 0
+
+    def list_dir(path: str) -> Optional[List[os.DirEntry]]:
+        nonlocal dirs_visited, entries_listed
+        if on_dir is not None:
+            on_dir(path)
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+                dirs_visited += 1
+                entries_listed += len(entries)
+                return entries
+        except PermissionError:
+            logger.warning(f"Skipping {path} due to a permission error!!")
+            return None
+
+    def discard(entry: os.DirEntry) -> Path:
+        nonlocal files_discarded
+        files_discarded += 1
+        path = Path(entry.path)
+        if discarded is not None:
+            # Neither is_dir nor stat follow links, so a link is counted by its own size.
+            is_dir = entry.is_dir(follow_symlinks=False)
+            size = 0
+            if not is_dir:
+                try:
+                    size = entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    pass
+            discarded.add(path, is_dir=is_dir, size=size)
+        return path
 
     try:
-        for child in base_path.iterdir():
-            next_dirname = child.name
-            if any(
-                [next_dirname == str(ignored_path) for ignored_path in paths_to_ignore]
-            ):
-                logger.debug(f"Ignored path - Skipping: {child}")
-                all_invalid_files_and_dirs.append(child)
+        root_entries = list_dir(str(base_path))
+        if root_entries is None:
+            files_discarded += 1
+            if discarded is not None:
+                discarded.add(base_path, is_dir=True)
+            yield base_path, False
+            return
+
+        # Each frame is (entries, next entry index, rules for this dir, extensions for this dir,
+        # this dir's path relative to base_path with a trailing '/').
+        # Entries are listed eagerly so we never hold more than one directory fd open at a time.
+        stack = [(root_entries, 0, rules, set(extensions), "")]
+        while stack:
+            entries, i, dir_rules, dir_extensions, dir_relpath = stack[-1]
+            if i >= len(entries):
+                stack.pop()
+                continue
+            stack[-1] = (entries, i + 1, dir_rules, dir_extensions, dir_relpath)
+
+            entry = entries[i]
+            name = entry.name
+            if dir_rules is not None and name in dir_rules.ignored:
+                if debug:
+                    logger.debug(f"Ignored path - Skipping: {entry.path}")
+                yield discard(entry), False
                 continue
 
-            if child.is_dir():
+            is_dir = entry.is_dir()
+            # Relpaths are only built for plugins with pattern rules.
+            relpath = dir_relpath + name if globs is not None else ""
+            if globs is not None and globs.ignore.matches(relpath, is_dir):
+                if debug:
+                    logger.debug(f"Ignored pattern - Skipping: {entry.path}")
+                yield discard(entry), False
+                continue
 
-                (
-                    new_extensions,
-                    new_paths_to_ignore,
-                    new_suffixes_override,
-                ) = __process_paths_and_suffixes_for_child_dir(
-                    extensions, paths_to_ignore, suffixes_override, next_dirname
-                )
+            if is_dir:
+                child_entries = list_dir(entry.path)
+                if child_entries is None:
+                    yield discard(entry), False
+                    continue
 
-                rec_valid_files, rec_invalid_files = find_all_files_with_exts(
-                    base_path=child,
-                    extensions=new_extensions,
-                    paths_to_ignore=new_paths_to_ignore,
-                    suffixes_override=new_suffixes_override,
-                )
+                if dir_rules is not None:
+                    child_rules = dir_rules.children.get(name)
+                    child_extensions = dir_rules.get_child_extensions(
+                        dir_extensions, child_rules
+                    )
+                else:
+                    child_rules, child_extensions = None, dir_extensions
+                if globs is not None:
+                    child_extensions = globs.get_child_extensions(
+                        child_extensions, relpath
+                    )
 
-                all_valid_files.extend(rec_valid_files)
-                all_invalid_files_and_dirs.extend(rec_invalid_files)
+                stack.append(
+                    (child_entries, 0, child_rules, child_extensions, relpath + "/")
+                )
+            elif get_suffix(name) not in dir_extensions:
+                if debug:
+                    logger.debug(f"Invalid suffix - Skipping: {entry.path}")
+                yield discard(entry), False
             else:
-                if child.suffix not in extensions:
-                    logger.debug(f"Invalid suffix - Skipping: {child}")
-                    all_invalid_files_and_dirs.append(child)
-                    continue
-                all_valid_files.append(child)
+                files_matched += 1
+                yield Path(entry.path), True
+    finally:
+        # Also reached if the caller stops iterating early.
+        run_stats.add_many(
+            dirs_visited=dirs_visited,
+            entries_listed=entries_listed,
+            files_matched=files_matched,
+            files_discarded=files_discarded,
+        )
 
-        return all_valid_files, all_invalid_files_and_dirs
 
-    except PermissionError as e:
-        logger.warning(f"Skipping {base_path} due to a permission error!!")
-        return [], [base_path]
+def find_all_files_with_exts(
+    base_path: Path,
+    extensions: Set[str],
+    paths_to_ignore: Iterable[Union[str, Path]],
+    suffixes_override: Optional[Dict[str, List[Dict]]],
+    discarded: Optional[DiscardSummary] = None,
+    rules: Optional[DirRules] = None,
+    on_dir: Optional[Callable[[str], None]] = None,
+) -> Tuple[List[Path], List[Path]]:
+    """
+    iter_files_with_exts, split into (valid files, invalid files and dirs).
+
+    If discarded is given, invalid files and dirs are rolled up into it instead and the invalid
+    list is returned empty.
+    """
+    all_valid_files: List[Path] = []
+    all_invalid_files_and_dirs: List[Path] = []
+    for path, matched in iter_files_with_exts(
+        base_path,
+        extensions,
+        paths_to_ignore,
+        suffixes_override,
+        rules,
+        discarded,
+        on_dir,
+    ):
+        if matched:
+            all_valid_files.append(path)
+        elif discarded is None:
+            all_invalid_files_and_dirs.append(path)
+
+    return all_valid_files, all_invalid_files_and_dirs
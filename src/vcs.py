@@ -0,0 +1,220 @@
+import os
+import tempfile
+import threading
+import subprocess
+import logging
+
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from src.exceptions import VcsException
+
+logger = logging.getLogger(__name__)
+
+NULL_SHA = "0" * 40
+
+# path in repo -> (mode, blob sha)
+TreeEntries = Dict[str, Tuple[str, str]]
+
+
+def get_file_mode(file_stat: os.stat_result) -> str:
+    return "100755" if file_stat.st_mode & 0o111 else "100644"
+
+
+class GitRepo:
+    """
+    Thin wrapper over git plumbing commands.
+
+    Everything that touches many files is done in a single git process - eg, one
+    `hash-object --stdin-paths` to write every blob, one `update-index --index-info` to build a
+    tree, one `cat-file --batch` to read every blob - rather than running git once per file.
+    """
+
+    path: Path
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    def run(
+        self,
+        *args: str,
+        input: Optional[bytes] = None,
+        env: Optional[Dict[str, str]] = None,
+    ) -> bytes:
+        result = subprocess.run(
+            ["git", "-C", str(self.path), *args],
+            input=input,
+            env=env,
+            capture_output=True,
+        )
+        if result.returncode != 0:
+            raise VcsException(
+                f"'git {' '.join(args)}' failed with exit code {result.returncode}: {result.stderr.decode(errors='replace').strip()}"
+            )
+        return result.stdout
+
+    def rev_parse(self, rev: str) -> Optional[str]:
+        try:
+            return self.run("rev-parse", "--verify", "-q", rev).decode().strip()
+        except VcsException:
+            return None
+
+    def get_tree(self, rev: str) -> str:
+        return self.run("rev-parse", f"{rev}^{{tree}}").decode().strip()
+
+    def hash_objects(self, paths: List[Path], write: bool = True) -> List[str]:
+        """
+        Hashes every path in a single `git hash-object` process, writing blobs if write is set.
+        """
+        if not paths:
+            return []
+
+        args = ["hash-object", "--no-filters", "--stdin-paths"]
+        if write:
+            args.append("-w")
+        stdout = self.run(*args, input="".join(f"{path}\n" for path in paths).encode())
+        return stdout.decode().split()
+
+    def build_tree(
+        self,
+        entries: TreeEntries,
+        base: Optional[str] = None,
+        replace_prefixes: Optional[List[str]] = None,
+    ) -> str:
+        """
+        Writes a tree of entries on top of base in a throwaway index, without touching the
+        repo's own index or worktree. Entries of base under replace_prefixes are dropped first.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            env = {**os.environ, "GIT_INDEX_FILE": os.path.join(tmp_dir, "index")}
+
+            records = []
+            if base is not None:
+                self.run("read-tree", base, env=env)
+                if replace_prefixes:
+                    stale = self.run(
+                        "ls-files", "-z", "--", *replace_prefixes, env=env
+                    ).split(b"\0")
+                    records.extend(
+                        f"0 {NULL_SHA}\t{path.decode()}" for path in stale if path
+                    )
+
+            records.extend(
+                f"{mode} {sha}\t{path}" for path, (mode, sha) in entries.items()
+            )
+            if records:
+                self.run(
+                    "update-index",
+                    "-z",
+                    "--index-info",
+                    input="".join(f"{record}\0" for record in records).encode(),
+                    env=env,
+                )
+
+            return self.run("write-tree", env=env).decode().strip()
+
+    def commit_tree(self, tree: str, parents: List[str], message: str) -> str:
+        args = ["commit-tree", tree, "-m", message]
+        for parent in parents:
+            args.extend(["-p", parent])
+        return self.run(*args).decode().strip()
+
+    def update_ref(self, ref: str, new: str, old: Optional[str] = None) -> None:
+        args = ["update-ref", ref, new]
+        if old is not None:
+            args.append(old)
+        self.run(*args)
+
+    def merge_tree(self, ours: str, theirs: str) -> Tuple[str, List[str]]:
+        """
+        Merges two commits without a worktree. Returns the merged tree and any conflicted paths.
+
+        Requires git >= 2.38 for `merge-tree --write-tree`.
+        """
+        result = subprocess.run(
+            [
+                "git",
+                "-C",
+                str(self.path),
+                "merge-tree",
+                "--write-tree",
+                "--allow-unrelated-histories",
+                "--name-only",
+                "-z",
+                ours,
+                theirs,
+            ],
+            capture_output=True,
+        )
+        # Exit code 1 means the merge had conflicts, anything else non-zero is an actual error.
+        if result.returncode not in (0, 1):
+            raise VcsException(
+                f"'git merge-tree' failed: {result.stderr.decode(errors='replace').strip()}"
+            )
+
+        # Output is "<tree>\0<conflicted path>\0...\0\0<messages>"
+        sections = result.stdout.split(b"\0\0", 1)
+        fields = sections[0].split(b"\0")
+        tree = fields[0].decode().strip()
+        conflicts = [field.decode() for field in fields[1:] if field]
+        if result.returncode == 1 and not conflicts:
+            conflicts = ["<unknown>"]
+
+        return tree, conflicts
+
+    def ls_tree(self, rev: str, prefix: str) -> List[Tuple[str, str, str]]:
+        """
+        Returns (mode, sha, path) for every blob under prefix in rev.
+        """
+        stdout = self.run("ls-tree", "-r", "-z", rev, "--", prefix)
+
+        entries = []
+        for record in stdout.split(b"\0"):
+            if not record:
+                continue
+            meta, path = record.split(b"\t", 1)
+            mode, obj_type, sha = meta.decode().split()
+            if obj_type == "blob":
+                entries.append((mode, sha, path.decode()))
+        return entries
+
+    def cat_blobs(self, shas: List[str]) -> Iterator[Tuple[str, bytes]]:
+        """
+        Streams the contents of every sha through a single `git cat-file --batch` process.
+        """
+        if not shas:
+            return
+
+        proc = subprocess.Popen(
+            ["git", "-C", str(self.path), "cat-file", "--batch"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        assert proc.stdin is not None and proc.stdout is not None
+
+        # Feed requests from a thread so a full stdout pipe can't deadlock us against git.
+        def feed():
+            assert proc.stdin is not None
+            try:
+                for sha in shas:
+                    proc.stdin.write(f"{sha}\n".encode())
+                proc.stdin.close()
+            except BrokenPipeError:
+                # The reader stopped early and git has exited.
+                pass
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        try:
+            for _ in shas:
+                header = proc.stdout.readline().decode().split()
+                if len(header) != 3:
+                    raise VcsException(f"Unexpected cat-file output: {header}")
+                sha, _, size = header
+                data = proc.stdout.read(int(size))
+                proc.stdout.read(1)  # Trailing newline
+                yield sha, data
+        finally:
+            proc.stdout.close()
+            proc.wait()
+            feeder.join()
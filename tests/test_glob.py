@@ -0,0 +1,179 @@
+import tempfile
+import unittest
+
+from pathlib import Path
+from typing import List
+
+import src.utils as utils
+from src.utils import GlobMatcher, NameFilter, is_glob_pattern
+
+
+class GlobMatcherTest(unittest.TestCase):
+    def assertMatches(self, patterns: List[str], relpath: str, is_dir: bool = False):
+        self.assertTrue(
+            GlobMatcher(patterns).matches(relpath, is_dir),
+            f"{patterns} should match {relpath}{'/' if is_dir else ''}",
+        )
+
+    def assertNotMatches(self, patterns: List[str], relpath: str, is_dir: bool = False):
+        self.assertFalse(
+            GlobMatcher(patterns).matches(relpath, is_dir),
+            f"{patterns} should not match {relpath}{'/' if is_dir else ''}",
+        )
+
+    def test_unanchored_patterns_match_at_any_depth(self):
+        self.assertMatches(["*.log"], "latest.log")
+        self.assertMatches(["*.log"], "logs/old/latest.log")
+        self.assertNotMatches(["*.log"], "latest.log.gz")
+        self.assertMatches(["cache"], "cache", is_dir=True)
+        self.assertMatches(["cache"], "worlds/world/cache", is_dir=True)
+
+    def test_double_star(self):
+        self.assertMatches(["**/cache"], "cache", is_dir=True)
+        self.assertMatches(["**/cache"], "a/b/cache", is_dir=True)
+        self.assertMatches(["worlds/**/data"], "worlds/data", is_dir=True)
+        self.assertMatches(["worlds/**/data"], "worlds/a/b/data", is_dir=True)
+        self.assertNotMatches(["worlds/**/data"], "other/data", is_dir=True)
+
+    def test_bare_wildcards(self):
+        for pattern in ["*", "**", "**/*"]:
+            self.assertMatches([pattern], "config.yml")
+            self.assertMatches([pattern], "a/b/config.yml")
+            self.assertMatches([pattern], "a", is_dir=True)
+        self.assertMatches(["*/"], "a", is_dir=True)
+        self.assertMatches(["*/"], "a/b", is_dir=True)
+        self.assertNotMatches(["*/"], "config.yml")
+        self.assertMatches(["/*"], "config.yml")
+        self.assertMatches(["/*"], "a", is_dir=True)
+        self.assertNotMatches(["/*"], "a/config.yml")
+
+    def test_dir_contents(self):
+        self.assertMatches(["data/**"], "data/a.json")
+        self.assertMatches(["data/**"], "data/a", is_dir=True)
+        self.assertNotMatches(["data/**"], "data", is_dir=True)
+        self.assertNotMatches(["data/**"], "other/data/a.json")
+        self.assertMatches(["data/**/*"], "data/a/b.json")
+
+    def test_patterns_with_a_slash_are_anchored(self):
+        self.assertMatches(["logs/*.gz"], "logs/2021-01-01.gz")
+        self.assertNotMatches(["logs/*.gz"], "old/logs/2021-01-01.gz")
+        self.assertNotMatches(["logs/*.gz"], "logs/old/2021-01-01.gz")
+        self.assertMatches(["/top.yml"], "top.yml")
+        self.assertNotMatches(["/top.yml"], "sub/top.yml")
+
+    def test_trailing_slash_only_matches_dirs(self):
+        self.assertMatches(["cache/"], "cache", is_dir=True)
+        self.assertMatches(["cache/"], "a/cache", is_dir=True)
+        self.assertNotMatches(["cache/"], "cache")
+
+    def test_paths_under_a_matched_dir_are_not_matched(self):
+        """
+        The walk never descends into a matched dir, so entries under it are never asked about.
+        """
+        self.assertNotMatches(["cache/"], "cache/entry.yml")
+        self.assertNotMatches(["cache"], "cache/entry.yml")
+        self.assertNotMatches(["logs/*"], "logs/a/b.yml")
+
+    def test_brackets_and_escapes(self):
+        self.assertMatches(["log[0-9].txt"], "log1.txt")
+        self.assertNotMatches(["log[0-9].txt"], "logx.txt")
+        self.assertMatches(["log[!0-9].txt"], "logx.txt")
+        self.assertNotMatches(["log[!0-9].txt"], "log1.txt")
+        self.assertNotMatches(["a[!x]b"], "a/b")
+        self.assertMatches(["[]]"], "]")
+        self.assertMatches(["a[b"], "a[b")
+        self.assertMatches(["\\*.yml"], "*.yml")
+        self.assertNotMatches(["\\*.yml"], "a.yml")
+        self.assertMatches(["\\!keep.yml"], "!keep.yml")
+        self.assertMatches(["\\#notes.yml"], "#notes.yml")
+
+    def test_exceptions(self):
+        self.assertNotMatches(["*.log", "!keep.log"], "keep.log")
+        self.assertNotMatches(["*.log", "!keep.log"], "a/keep.log")
+        self.assertMatches(["*.log", "!keep.log"], "other.log")
+        # Exceptions apply wherever they are in the list.
+        self.assertNotMatches(["!keep.log", "*.log"], "keep.log")
+        self.assertNotMatches(["*", "!keep/"], "keep", is_dir=True)
+        self.assertMatches(["*", "!keep/"], "keep")
+
+    def test_empty_matchers(self):
+        self.assertFalse(GlobMatcher([]))
+        self.assertFalse(GlobMatcher(["", "# comment"]))
+        self.assertFalse(GlobMatcher(["!only-an-exception"]))
+        self.assertNotMatches(["!only-an-exception"], "anything")
+        self.assertTrue(GlobMatcher(["*.log"]))
+
+
+class NameFilterTest(unittest.TestCase):
+    def test_is_glob_pattern(self):
+        for pattern in ["*.log", "**/cache", "logs/?.gz", "[ab]", "dir/", "!keep"]:
+            self.assertTrue(is_glob_pattern(pattern), pattern)
+        for pattern in ["cache", "logs/old", "a.yml", ".hidden"]:
+            self.assertFalse(is_glob_pattern(pattern), pattern)
+
+    def test_literal_names_and_patterns(self):
+        name_filter = NameFilter(["dynmap", "*-backup", "tmp/"])
+        self.assertTrue(name_filter.matches("dynmap"))
+        self.assertTrue(name_filter.matches("Essentials-backup"))
+        self.assertTrue(name_filter.matches("tmp"))
+        self.assertFalse(name_filter.matches("tmp", is_dir=False))
+        self.assertFalse(name_filter.matches("Essentials"))
+
+
+class GlobRulesWalkTest(unittest.TestCase):
+    """
+    Pattern rules through compile_dir_rules and the walker, next to literal ones.
+    """
+
+    def test_walk_with_patterns(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            base_path = Path(tmp_dir)
+            for relpath in [
+                "config.yml",
+                "latest.log",
+                "cache/entry.yml",
+                "worlds/world/cache/entry.yml",
+                "worlds/world/data/state.json",
+                "worlds/world/settings.yml",
+                "lang/en.yml",
+                "lang/en.json",
+                "keep/keep.yml",
+            ]:
+                path = base_path / relpath
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_text("x")
+
+            rules = utils.compile_dir_rules(
+                ["**/cache", "*.log", "keep"],
+                {
+                    "add": [
+                        {"suffix": ".json", "path": "worlds/*/data"},
+                        {"suffix": ".json", "path": "lang"},
+                    ]
+                },
+            )
+            walked = {
+                path.relative_to(base_path).as_posix(): matched
+                for path, matched in utils.iter_files_with_exts(
+                    base_path, {".yml"}, [], None, rules=rules
+                )
+            }
+
+        self.assertEqual(
+            walked,
+            {
+                "config.yml": True,
+                "latest.log": False,
+                "cache": False,
+                "worlds/world/cache": False,
+                "worlds/world/data/state.json": True,
+                "worlds/world/settings.yml": True,
+                "lang/en.yml": True,
+                "lang/en.json": True,
+                "keep": False,
+            },
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,380 @@
+import errno
+import getpass
+import grp
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from pathlib import Path
+from typing import Dict, Tuple
+from unittest import mock
+
+import src.sync as sync
+import src.utils as utils
+from src.constants import VCS_ENV
+from src.mytypes import Environment, get_patchouli_config, set_patchouli_config
+from src.patchouli import Patchouli
+from src.sync import CopyAction, CopyEngine, CopyPlan, FileCopier, PlannedFile
+from benchmarks.envgen import write_jar
+from benchmarks.run import BenchConfig
+
+# Several copy chunks, and not a multiple of one.
+DATA = bytes(range(256)) * (3 * shutil.COPY_BUFSIZE // 256) + b"tail"
+MODE = 0o640
+MTIME_NS = 1_600_000_000_123_456_789
+
+
+def patch_unsupported(target, name: str, err: int):
+    """
+    Makes target.name fail the way it does on a filesystem or kernel without support for it.
+    create is set since eg os.copy_file_range is missing on older kernels and libcs.
+    """
+
+    def raise_error(*args, **kwargs):
+        raise OSError(err, os.strerror(err))
+
+    return mock.patch.object(target, name, side_effect=raise_error, create=True)
+
+
+def make_copier() -> FileCopier:
+    """
+    A FileCopier that starts the chain at FICLONE whatever this platform supports.
+    """
+    copier = FileCopier()
+    copier.use_reflink = copier.use_copy_file_range = copier.use_sendfile = True
+    return copier
+
+
+def read_tree(base_path: Path) -> Dict[str, Tuple[bytes, int]]:
+    """
+    relpath -> (contents, permission bits) of every file under base_path.
+    """
+    return {
+        path.relative_to(base_path).as_posix(): (
+            path.read_bytes(),
+            stat.S_IMODE(path.stat().st_mode),
+        )
+        for path in base_path.rglob("*")
+        if path.is_file()
+    }
+
+
+class CopyTestCase(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_path = Path(tmp_dir.name)
+
+        self.src_path = self.tmp_path / "src.yml"
+        self.src_path.write_bytes(DATA)
+        os.chmod(self.src_path, MODE)
+        os.utime(self.src_path, ns=(MTIME_NS, MTIME_NS))
+
+    def assertCopied(self, dest_path: Path):
+        self.assertEqual(dest_path.read_bytes(), DATA)
+        dest_stat = dest_path.stat()
+        self.assertEqual(stat.S_IMODE(dest_stat.st_mode), MODE)
+        self.assertEqual(dest_stat.st_mtime_ns, MTIME_NS)
+
+
+@unittest.skipUnless(sys.platform == "linux", "The copy fallbacks are Linux only")
+class FileCopierFallbackTest(CopyTestCase):
+    """
+    Forces each step of the FICLONE -> copy_file_range -> sendfile -> read/write chain.
+    """
+
+    def copy(self, copier: FileCopier, name: str) -> Path:
+        dest_path = self.tmp_path / "dest" / name
+        copier.copy_file(self.src_path, dest_path)
+        self.assertCopied(dest_path)
+        return dest_path
+
+    def test_cheapest_supported_method(self):
+        self.copy(FileCopier(), "a.yml")
+
+    @unittest.skipUnless(hasattr(os, "copy_file_range"), "No os.copy_file_range")
+    def test_copy_file_range(self):
+        copier = make_copier()
+        with patch_unsupported(sync.fcntl, "ioctl", errno.EOPNOTSUPP):
+            self.copy(copier, "a.yml")
+        self.assertFalse(copier.use_reflink)
+        self.assertTrue(copier.use_copy_file_range)
+
+    def test_sendfile(self):
+        copier = make_copier()
+        with patch_unsupported(
+            sync.fcntl, "ioctl", errno.EOPNOTSUPP
+        ), patch_unsupported(os, "copy_file_range", errno.EXDEV):
+            self.copy(copier, "a.yml")
+        self.assertFalse(copier.use_copy_file_range)
+        self.assertTrue(copier.use_sendfile)
+
+    def test_read_write(self):
+        copier = make_copier()
+        with patch_unsupported(
+            sync.fcntl, "ioctl", errno.EOPNOTSUPP
+        ), patch_unsupported(os, "copy_file_range", errno.EXDEV), patch_unsupported(
+            os, "sendfile", errno.EINVAL
+        ):
+            self.copy(copier, "a.yml")
+        self.assertFalse(copier.use_sendfile)
+
+    def test_fallback_after_a_partial_copy(self):
+        """
+        A method that fails after writing some bytes leaves nothing behind for the next one.
+        """
+
+        def write_then_fail(src_fd, dest_fd, count):
+            os.write(dest_fd, b"partial")
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+        with patch_unsupported(
+            sync.fcntl, "ioctl", errno.EOPNOTSUPP
+        ), mock.patch.object(
+            os, "copy_file_range", side_effect=write_then_fail, create=True
+        ):
+            self.copy(make_copier(), "a.yml")
+
+    def test_unsupported_methods_are_not_retried(self):
+        copier = make_copier()
+        with patch_unsupported(
+            sync.fcntl, "ioctl", errno.EOPNOTSUPP
+        ) as ioctl, patch_unsupported(
+            os, "copy_file_range", errno.EXDEV
+        ) as copy_file_range:
+            self.copy(copier, "a.yml")
+            self.copy(copier, "b.yml")
+        self.assertEqual(ioctl.call_count, 1)
+        self.assertEqual(copy_file_range.call_count, 1)
+
+    def test_other_errors_are_raised(self):
+        copier = make_copier()
+        with patch_unsupported(
+            sync.fcntl, "ioctl", errno.EOPNOTSUPP
+        ), patch_unsupported(os, "copy_file_range", errno.ENOSPC):
+            with self.assertRaises(OSError):
+                copier.copy_file(self.src_path, self.tmp_path / "a.yml")
+        self.assertTrue(copier.use_copy_file_range)
+
+
+class CopyEngineTest(CopyTestCase):
+    def fan_out(self, dest_count: int) -> Tuple[list, mock.MagicMock]:
+        targets = [
+            (FileCopier(), self.tmp_path / f"dest{i}" / "nested" / "src.yml")
+            for i in range(dest_count)
+        ]
+        with mock.patch.object(os, "open", wraps=os.open) as os_open:
+            CopyEngine().run([(self.src_path, os.stat(self.src_path), targets)])
+        for copier, dest_path in targets:
+            self.assertCopied(dest_path)
+            self.assertEqual(copier.stats.copied, 1)
+            self.assertEqual(copier.stats.bytes_copied, len(DATA))
+        return targets, os_open
+
+    def count_source_reads(self, os_open: mock.MagicMock) -> int:
+        return sum(
+            1 for call in os_open.call_args_list if call.args[0] == self.src_path
+        )
+
+    def test_fan_out_reads_source_once(self):
+        with mock.patch.object(
+            FileCopier, "copy_from_fd", side_effect=AssertionError("Not buffered")
+        ):
+            _, os_open = self.fan_out(3)
+        self.assertEqual(self.count_source_reads(os_open), 1)
+
+    def test_fan_out_of_large_sources(self):
+        """
+        Sources too large to buffer are copied from the same handle into every dest.
+        """
+        with mock.patch.object(sync, "FAN_OUT_BUFFER_LIMIT", len(DATA) - 1):
+            _, os_open = self.fan_out(3)
+        self.assertEqual(self.count_source_reads(os_open), 1)
+
+    def test_apply_merges_plans(self):
+        src_stat = os.stat(self.src_path)
+        plans = []
+        for name in ["dev1", "dev2"]:
+            dest_path_base = self.tmp_path / name
+            stale_path = dest_path_base / "Plug" / "stale.yml"
+            stale_path.parent.mkdir(parents=True)
+            stale_path.write_text("stale")
+            # apply never looks at the env.
+            plan = CopyPlan(mock.sentinel.dest_env, dest_path_base)
+            plan.files = [
+                PlannedFile(
+                    CopyAction.CREATE,
+                    "Plug",
+                    dest_path_base / "Plug" / "a" / "src.yml",
+                    len(DATA),
+                    self.src_path,
+                    src_stat,
+                ),
+                PlannedFile(
+                    CopyAction.SKIP, "Plug", dest_path_base / "Plug" / "b.yml", 0
+                ),
+                PlannedFile(CopyAction.DELETE, "Plug", stale_path, 5),
+            ]
+            plans.append((plan, FileCopier()))
+
+        with mock.patch.object(os, "open", wraps=os.open) as os_open:
+            CopyEngine(jobs=4).apply(plans)
+
+        self.assertEqual(self.count_source_reads(os_open), 1)
+        for plan, copier in plans:
+            self.assertCopied(plan.dest_path_base / "Plug" / "a" / "src.yml")
+            self.assertFalse((plan.dest_path_base / "Plug" / "stale.yml").exists())
+            self.assertEqual(
+                (copier.stats.copied, copier.stats.skipped, copier.stats.deleted),
+                (1, 1, 1),
+            )
+
+
+@unittest.skipUnless(
+    getpass.getuser() == "root", "Syncing from VCS into an env must be run as root"
+)
+@unittest.skipUnless(shutil.which("git"), "git is not installed")
+class VcsRoundTripTest(unittest.TestCase):
+    """
+    env -> vcs -> env through a throwaway git repo.
+    """
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        tmp_path = Path(tmp_dir.name)
+
+        self.base_path = tmp_path / "base"
+        for env_name in ["prod", "dev1"]:
+            plugin_path_base = self.base_path / env_name / "plugins"
+            plugin_path_base.mkdir(parents=True)
+            write_jar(plugin_path_base / "Plug.jar", "Plug", "1.0", [])
+
+        self.prod_plugin_path = self.base_path / "prod" / "plugins" / "Plug"
+        self.dev1_plugin_path = self.base_path / "dev1" / "plugins" / "Plug"
+        (self.prod_plugin_path / "sub").mkdir(parents=True)
+        (self.prod_plugin_path / "config.yml").write_text("a: 1\n")
+        (self.prod_plugin_path / "sub" / "run.yml").write_text("b: 2\n")
+        os.chmod(self.prod_plugin_path / "sub" / "run.yml", 0o755)
+        (self.base_path / "prod" / "server.properties").write_text("motd=prod\n")
+        (self.base_path / "prod" / "config").mkdir()
+        (self.base_path / "prod" / "config" / "paper-global.yml").write_text("c: 3\n")
+
+        self.repo_path = tmp_path / "vcs"
+        self.repo_path.mkdir()
+        for args in [
+            ["init", "-q"],
+            ["config", "user.name", "patchouli"],
+            ["config", "user.email", "patchouli@example.com"],
+        ]:
+            self.git(*args)
+
+        set_patchouli_config(
+            BenchConfig(
+                get_patchouli_config(),
+                base_path=str(self.base_path),
+                cache_dir=str(tmp_path / "cache"),
+                vcs_repo_path=str(self.repo_path),
+                default_env="prod",
+                default_copy_to_env="dev1",
+                default_create_missing_dirs=False,
+                use_daemon=False,
+                mc_data_user=getpass.getuser(),
+                mc_data_group=grp.getgrgid(os.getgid()).gr_name,
+            )
+        )
+        utils.clear_config_caches()
+        self.addCleanup(utils.clear_config_caches)
+        self.addCleanup(set_patchouli_config, None)
+
+        self.vcs = Environment(VCS_ENV)
+        self.prod = Environment("prod")
+        self.dev1 = Environment("dev1")
+
+    def git(self, *args: str) -> str:
+        return subprocess.run(
+            ["git", "-C", str(self.repo_path), *args],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+
+    def patchy(self, env: Environment, **kwargs) -> Patchouli:
+        return Patchouli(
+            config=get_patchouli_config(),
+            target_env=env,
+            use_jar_cache=False,
+            use_daemon=False,
+            **kwargs,
+        )
+
+    def assertWorktreeClean(self):
+        self.assertEqual(self.git("status", "--porcelain"), "")
+
+    def test_plugin_configs(self):
+        self.assertIsNotNone(
+            self.patchy(self.prod).sync_vcs_with_env(self.prod, self.vcs)
+        )
+        self.assertWorktreeClean()
+        self.assertEqual(
+            read_tree(self.repo_path / "plugins" / "Plug"),
+            read_tree(self.prod_plugin_path),
+        )
+
+        self.patchy(self.dev1).sync_vcs_with_env(self.vcs, self.dev1)
+        self.assertEqual(
+            read_tree(self.dev1_plugin_path), read_tree(self.prod_plugin_path)
+        )
+
+        # A change on each side is merged, and the merge carried back into the env.
+        (self.repo_path / "plugins" / "Plug" / "config.yml").write_text("a: 2\n")
+        self.git("commit", "-qam", "Edit in VCS")
+        (self.prod_plugin_path / "new.yml").write_text("d: 4\n")
+        self.assertIsNotNone(
+            self.patchy(self.prod).sync_vcs_with_env(self.prod, self.vcs)
+        )
+        self.assertWorktreeClean()
+        self.assertEqual(
+            len(self.git("rev-list", "--parents", "-n1", "HEAD").split()), 3
+        )
+
+        self.patchy(self.dev1).sync_vcs_with_env(self.vcs, self.dev1)
+        dev1_tree = read_tree(self.dev1_plugin_path)
+        self.assertEqual(dev1_tree["config.yml"], (b"a: 2\n", 0o644))
+        self.assertEqual(dev1_tree["new.yml"], (b"d: 4\n", 0o644))
+        self.assertEqual(dev1_tree["sub/run.yml"], (b"b: 2\n", 0o755))
+
+        # Nothing changed since - no new commit.
+        self.assertIsNone(self.patchy(self.prod).sync_vcs_with_env(self.prod, self.vcs))
+
+    def test_server_configs(self):
+        def server_patchy(env: Environment) -> Patchouli:
+            return self.patchy(
+                env, discover_plugins=False, discover_server_configs=True
+            )
+
+        self.assertIsNotNone(
+            server_patchy(self.prod).sync_server_with_vcs(self.prod, self.vcs)
+        )
+        self.assertWorktreeClean()
+        self.assertEqual(
+            sorted(self.git("ls-tree", "-r", "--name-only", "HEAD").split()),
+            ["server/config/paper-global.yml", "server/server.properties"],
+        )
+
+        server_patchy(self.dev1).sync_server_with_vcs(self.vcs, self.dev1)
+        self.assertEqual(
+            (self.base_path / "dev1" / "server.properties").read_text(), "motd=prod\n"
+        )
+        self.assertEqual(
+            (self.base_path / "dev1" / "config" / "paper-global.yml").read_text(),
+            "c: 3\n",
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
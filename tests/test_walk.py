@@ -0,0 +1,158 @@
+import random
+import tempfile
+import unittest
+
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+import src.utils as utils
+
+# Names for the generated trees. Names with a dot are files, the rest dirs.
+NAMES = [
+    "a",
+    "b",
+    "c",
+    "users",
+    "x.yml",
+    "y.json",
+    "z.conf",
+    "w.txt",
+    ".hidden",
+    "q.db",
+]
+DIR_PATHS = [".", "a", "b", "c", "users", "a/b", "b/users", "a/b/c", "c/a"]
+IGNORE_PATHS = ["a", "users", "x.yml", "c", "q.db", "a/b", "b/users"]
+OVERRIDE_SUFFIXES = [".json", ".yml", ".db", ".conf"]
+EXTENSIONS = {".yml", ".conf", ".txt"}
+
+MAX_DEPTH = 4
+SEEDS = 300
+
+
+def reference_walk(
+    base_path: Path,
+    extensions: Set[str],
+    paths_to_ignore: List[str],
+    suffixes_override: Optional[Dict[str, List[Dict]]],
+) -> Tuple[List[Path], List[Path]]:
+    """
+    The plain recursive walk find_all_files_with_exts replaced, re-evaluating every rule at
+    every directory.
+    """
+    ignored = {Path(path).as_posix() for path in paths_to_ignore}
+    overrides = [
+        (op, obj["suffix"], Path(obj["path"]).as_posix())
+        for op in ["add", "rem"]
+        for obj in (suffixes_override or {}).get(op, [])
+    ]
+    valid: List[Path] = []
+    invalid: List[Path] = []
+
+    def walk(path: Path, rel_parts: List[str], dir_extensions: Set[str]) -> None:
+        for child in path.iterdir():
+            relpath = "/".join(rel_parts + [child.name])
+            if relpath in ignored:
+                invalid.append(child)
+            elif child.is_dir():
+                child_extensions = set(dir_extensions)
+                # All adds before any rems. "." applies to every top level dir.
+                for op, suffix, override_path in overrides:
+                    if override_path == relpath or (
+                        override_path == "." and not rel_parts
+                    ):
+                        if op == "add":
+                            child_extensions.add(suffix)
+                        else:
+                            child_extensions.discard(suffix)
+                walk(child, rel_parts + [child.name], child_extensions)
+            elif child.suffix in dir_extensions:
+                valid.append(child)
+            else:
+                invalid.append(child)
+
+    walk(base_path, [], set(extensions))
+    return valid, invalid
+
+
+def build_tree(path: Path, depth: int, rnd: random.Random) -> None:
+    for name in rnd.sample(NAMES, rnd.randint(0, 6)):
+        if "." in name:
+            (path / name).write_text("x")
+        elif depth < MAX_DEPTH:
+            (path / name).mkdir()
+            build_tree(path / name, depth + 1, rnd)
+
+
+def random_rules(
+    rnd: random.Random,
+) -> Tuple[List[str], Optional[Dict[str, List[Dict]]]]:
+    suffixes_override = {}
+    for op in ["add", "rem"]:
+        if rnd.random() < 0.8:
+            suffixes_override[op] = [
+                {
+                    "suffix": rnd.choice(OVERRIDE_SUFFIXES),
+                    "path": rnd.choice(DIR_PATHS),
+                }
+                for _ in range(rnd.randint(1, 4))
+            ]
+    paths_to_ignore = rnd.sample(IGNORE_PATHS, rnd.randint(0, 2))
+    return paths_to_ignore, suffixes_override or None
+
+
+class WalkerEquivalenceTest(unittest.TestCase):
+    """
+    Differential test of the scandir walker against reference_walk over random trees and rules.
+    """
+
+    def test_find_all_files_with_exts(self):
+        for seed in range(SEEDS):
+            rnd = random.Random(seed)
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                base_path = Path(tmp_dir)
+                build_tree(base_path, 0, rnd)
+                paths_to_ignore, suffixes_override = random_rules(rnd)
+
+                expected = reference_walk(
+                    base_path, EXTENSIONS, paths_to_ignore, suffixes_override
+                )
+                actual = utils.find_all_files_with_exts(
+                    base_path, EXTENSIONS, paths_to_ignore, suffixes_override
+                )
+                self.assertEqual(
+                    expected,
+                    actual,
+                    f"seed={seed} paths_to_ignore={paths_to_ignore} suffixes_override={suffixes_override}",
+                )
+
+    def test_iter_files_with_compiled_rules(self):
+        """
+        Rules compiled once give the same results on every tree they're reused for.
+        """
+        for seed in range(0, SEEDS, 10):
+            rnd = random.Random(seed)
+            paths_to_ignore, suffixes_override = random_rules(rnd)
+            rules = utils.compile_dir_rules(paths_to_ignore, suffixes_override)
+            for _ in range(3):
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    base_path = Path(tmp_dir)
+                    build_tree(base_path, 0, rnd)
+
+                    valid, invalid = reference_walk(
+                        base_path, EXTENSIONS, paths_to_ignore, suffixes_override
+                    )
+                    walked = list(
+                        utils.iter_files_with_exts(
+                            base_path, EXTENSIONS, [], None, rules=rules
+                        )
+                    )
+                    self.assertEqual(
+                        valid, [path for path, matched in walked if matched]
+                    )
+                    self.assertEqual(
+                        invalid, [path for path, matched in walked if not matched]
+                    )
+
+
+if __name__ == "__main__":
+    unittest.main()